@@ -0,0 +1,136 @@
+"""Índice de prefixo em memória para o autocompletar dos históricos.
+
+Textos normalizados (minúsculas, sem acento) em listas ordenadas, uma por escopo (todos
+os itens e cada cliente_id); a busca é um bisect até o prefixo + varredura do intervalo.
+Cada palavra do texto também entra como chave, então "silva" encontra "João da Silva".
+O ranking usa a frequência de uso (quantos relatórios citam o item).
+
+Sem dependência de main.py/banco: quem usa fornece os itens e as frequências.
+"""
+import bisect
+import threading
+import time
+import unicodedata
+from typing import Callable, Iterable, Optional
+
+_ALL = "*"  # escopo com todos os itens
+
+
+def normalize(texto) -> str:
+    t = unicodedata.normalize("NFKD", str(texto or "")).casefold()
+    t = "".join(ch for ch in t if not unicodedata.combining(ch))
+    return " ".join(t.split())
+
+
+def _keys(norm: str) -> set[str]:
+    # Texto inteiro + cada sufixo a partir de uma palavra
+    words = norm.split(" ") if norm else []
+    return {" ".join(words[i:]) for i in range(len(words))}
+
+
+class PrefixIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loaded_at: float | None = None
+        # id → (payload, texto normalizado, cliente_id)
+        self._items: dict[int, tuple[dict, str, Optional[int]]] = {}
+        # escopo → lista ordenada de (chave, id)
+        self._scopes: dict = {}
+        self._freq: dict[str, int] = {}
+
+    def is_stale(self, ttl_seconds: float) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= ttl_seconds
+
+    def load(self, items: Iterable[tuple[int, str, Optional[int], dict]], freq: dict[str, int]):
+        """Recria o índice. items: (id, texto, cliente_id, payload); freq: texto → usos."""
+        novos: dict[int, tuple[dict, str, Optional[int]]] = {}
+        scopes: dict = {_ALL: []}
+        for item_id, texto, cliente_id, payload in items:
+            norm = normalize(texto)
+            novos[item_id] = (payload, norm, cliente_id)
+            for key in _keys(norm):
+                scopes[_ALL].append((key, item_id))
+                if cliente_id is not None:
+                    scopes.setdefault(cliente_id, []).append((key, item_id))
+        for lst in scopes.values():
+            lst.sort()
+        contagem: dict[str, int] = {}
+        for texto, n in freq.items():
+            norm = normalize(texto)
+            contagem[norm] = contagem.get(norm, 0) + int(n or 0)
+        with self._lock:
+            self._items = novos
+            self._scopes = scopes
+            self._freq = contagem
+            self.loaded_at = time.monotonic()
+
+    def reset(self):
+        with self._lock:
+            self.loaded_at = None
+            self._items = {}
+            self._scopes = {}
+            self._freq = {}
+
+    def add(self, item_id: int, texto: str, cliente_id: Optional[int], payload: dict):
+        if self.loaded_at is None:
+            return  # a primeira busca fará a carga completa
+        self.remove(item_id)
+        norm = normalize(texto)
+        with self._lock:
+            self._items[item_id] = (payload, norm, cliente_id)
+            for key in _keys(norm):
+                bisect.insort(self._scopes.setdefault(_ALL, []), (key, item_id))
+                if cliente_id is not None:
+                    bisect.insort(self._scopes.setdefault(cliente_id, []), (key, item_id))
+
+    def remove(self, item_id: int):
+        with self._lock:
+            entry = self._items.pop(item_id, None)
+            if entry is None:
+                return
+            _, norm, cliente_id = entry
+            for scope in (_ALL, cliente_id):
+                lst = self._scopes.get(scope)
+                if not lst:
+                    continue
+                for key in _keys(norm):
+                    i = bisect.bisect_left(lst, (key, item_id))
+                    if i < len(lst) and lst[i] == (key, item_id):
+                        del lst[i]
+
+    def add_usage(self, textos: Iterable[str]):
+        with self._lock:
+            for texto in textos:
+                norm = normalize(texto)
+                if norm:
+                    self._freq[norm] = self._freq.get(norm, 0) + 1
+
+    def search(
+        self,
+        q: Optional[str],
+        cliente_id: Optional[int] = None,
+        limit: int = 20,
+        predicate: Optional[Callable[[dict], bool]] = None,
+    ) -> list[dict]:
+        """Itens cujo texto (ou alguma palavra) começa com q, mais usados primeiro."""
+        prefix = normalize(q)
+        with self._lock:
+            lst = self._scopes.get(_ALL if cliente_id is None else cliente_id, [])
+            if prefix:
+                ids = set()
+                i = bisect.bisect_left(lst, (prefix,))
+                while i < len(lst) and lst[i][0].startswith(prefix):
+                    ids.add(lst[i][1])
+                    i += 1
+            else:
+                ids = {item_id for _, item_id in lst}
+            candidatos = []
+            for item_id in ids:
+                payload, norm, _ = self._items[item_id]
+                if predicate is not None and not predicate(payload):
+                    continue
+                # Mais usados; depois quem começa pelo prefixo (não só uma palavra do meio)
+                rank = (-self._freq.get(norm, 0), 0 if norm.startswith(prefix) else 1, norm, item_id)
+                candidatos.append((rank, payload))
+        candidatos.sort(key=lambda c: c[0])
+        return [payload for _, payload in candidatos[:limit]]
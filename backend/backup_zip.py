@@ -0,0 +1,381 @@
+"""Montagem do zip do backup completo com compressão paralela.
+
+Roda num processo separado (ProcessPoolExecutor "spawn" em main.py), então o event loop
+da API não disputa CPU/GIL com a compressão. Dentro desse processo cada arquivo é
+comprimido (deflate cru + CRC) por um pool de threads — o zlib libera o GIL, então isso
+usa vários núcleos — e o escritor grava as entradas já comprimidas no zip, na ordem dos
+caminhos. Mídias e formatos já comprimidos entram como ZIP_STORED (recomprimir só gasta CPU).
+
+Progresso e cancelamento usam os mesmos arquivos do backup antigo (progress.json e
+cancel.flag), passados por caminho. Sem dependência de main.py/database.py.
+
+Também tem um escritor de zip em streaming (iter_stream_zip) para downloads: as entradas
+são emitidas conforme os arquivos são lidos, sem montar o zip em memória nem em disco.
+Os dois usam o mesmo gerador de cabeçalhos (seção "formato zip"), sem internals do zipfile.
+"""
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 1024 * 1024
+# Comprimidos em memória até este tamanho; acima disso vão para arquivo temporário
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+PROGRESS_EVERY = 20
+
+# Conteúdo que já vem comprimido: gravado sem compressão
+STORED_EXTS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp4", ".mov", ".m4v", ".webm", ".avi", ".mkv", ".3gp", ".mp3", ".m4a", ".ogg",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".xlsx", ".docx", ".pptx", ".odt", ".ods", ".woff", ".woff2",
+}
+
+
+def compress_type_for(path: str) -> int:
+    return zipfile.ZIP_STORED if os.path.splitext(path)[1].lower() in STORED_EXTS else zipfile.ZIP_DEFLATED
+
+
+# ---------------- formato zip ----------------
+# Escritor próprio, usado pelo backup completo e pelo download em streaming: cabeçalho local
+# com flag 0x08 (CRC/tamanhos no data descriptor após os dados), diretório central no fim e
+# registros zip64 quando tamanhos/offsets passam de 4 GiB.
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_MAX32 = 0xFFFFFFFF
+
+
+@dataclass
+class StreamEntry:
+    path: str
+    arcname: str
+    size: int
+    mtime: float
+    mode: int
+    compress_type: int
+
+
+def _dos_datetime(mtime: float) -> tuple[int, int]:
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01 00:00
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _entry_zip64(e: StreamEntry) -> bool:
+    # Mesmo critério do zipfile para entradas de tamanho conhecido
+    return e.size * (1 if e.compress_type == zipfile.ZIP_STORED else 1.05) > zipfile.ZIP64_LIMIT
+
+
+def _local_header(e: StreamEntry) -> bytes:
+    name = e.arcname.encode("utf-8")
+    zip64 = _entry_zip64(e)
+    extra = struct.pack("<HHQQ", 1, 16, 0, 0) if zip64 else b""
+    sizes = _MAX32 if zip64 else 0
+    dos_time, dos_date = _dos_datetime(e.mtime)
+    return struct.pack(
+        "<LHHHHHLLLHH", 0x04034B50, 45 if zip64 else 20, _FLAG_DATA_DESCRIPTOR | _FLAG_UTF8,
+        e.compress_type, dos_time, dos_date, 0, sizes, sizes, len(name), len(extra),
+    ) + name + extra
+
+
+def _data_descriptor(e: StreamEntry, crc: int, csize: int, usize: int) -> bytes:
+    if _entry_zip64(e):
+        return struct.pack("<LLQQ", 0x08074B50, crc, csize, usize)
+    return struct.pack("<LLLL", 0x08074B50, crc, csize, usize)
+
+
+def _central_header(e: StreamEntry, crc: int, csize: int, usize: int, offset: int) -> bytes:
+    name = e.arcname.encode("utf-8")
+    extra_fields = []
+    if usize >= _MAX32:
+        extra_fields.append(usize)
+    if csize >= _MAX32:
+        extra_fields.append(csize)
+    if offset >= _MAX32:
+        extra_fields.append(offset)
+    extra = struct.pack(f"<HH{len(extra_fields)}Q", 1, 8 * len(extra_fields), *extra_fields) if extra_fields else b""
+    zip64 = bool(extra_fields) or _entry_zip64(e)
+    dos_time, dos_date = _dos_datetime(e.mtime)
+    return struct.pack(
+        "<LHHHHHHLLLHHHHHLL", 0x02014B50, (3 << 8) | 45 if zip64 else (3 << 8) | 20, 45 if zip64 else 20,
+        _FLAG_DATA_DESCRIPTOR | _FLAG_UTF8, e.compress_type, dos_time, dos_date, crc,
+        min(csize, _MAX32), min(usize, _MAX32), len(name), len(extra), 0, 0, 0, (e.mode & 0xFFFF) << 16,
+        min(offset, _MAX32),
+    ) + name + extra
+
+
+def _end_records(count: int, cd_offset: int, cd_size: int) -> bytes:
+    out = b""
+    if count >= 0xFFFF or cd_offset >= _MAX32 or cd_size >= _MAX32:
+        zip64_offset = cd_offset + cd_size
+        out += struct.pack("<LQHHLLQQQQ", 0x06064B50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        out += struct.pack("<LLQL", 0x07064B50, 0, zip64_offset, 1)
+    out += struct.pack(
+        "<LHHHHLLH", 0x06054B50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+        min(cd_size, _MAX32), min(cd_offset, _MAX32), 0,
+    )
+    return out
+
+
+class _Entry:
+    __slots__ = ("meta", "crc", "compress_size", "data")
+
+    def __init__(self, meta: "StreamEntry", crc: int, compress_size: int, data):
+        self.meta = meta
+        self.crc = crc
+        self.compress_size = compress_size
+        self.data = data
+
+
+def _compress_file(abs_fp: str, arcname: str, compresslevel: int) -> Optional[_Entry]:
+    """Lê e comprime um arquivo (thread do pool). None se o arquivo sumiu/não pôde ser lido."""
+    try:
+        st = os.stat(abs_fp)
+    except OSError:
+        return None
+    meta = StreamEntry(abs_fp, arcname.replace(os.sep, "/"), st.st_size, st.st_mtime, st.st_mode, compress_type_for(arcname))
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    crc = 0
+    size = 0
+    comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -15) if meta.compress_type == zipfile.ZIP_DEFLATED else None
+    try:
+        with open(abs_fp, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                out.write(comp.compress(chunk) if comp else chunk)
+        if comp:
+            out.write(comp.flush())
+    except OSError:
+        out.close()
+        return None
+    meta.size = size  # o que foi lido, não o stat (arquivo pode ter mudado no meio)
+    compress_size = out.tell()
+    out.seek(0)
+    return _Entry(meta, crc, compress_size, out)
+
+
+def _write_entry(fp, entry: _Entry, offset: int) -> tuple[int, bytes]:
+    """Grava cabeçalho + dados já comprimidos + data descriptor em fp.
+
+    Retorna (bytes gravados, registro do diretório central da entrada).
+    """
+    e = entry.meta
+    header = _local_header(e)
+    descriptor = _data_descriptor(e, entry.crc, entry.compress_size, e.size)
+    fp.write(header)
+    with entry.data:
+        shutil.copyfileobj(entry.data, fp, CHUNK_BYTES)
+    fp.write(descriptor)
+    return len(header) + entry.compress_size + len(descriptor), _central_header(e, entry.crc, entry.compress_size, e.size, offset)
+
+
+def _save_progress(progress_file: Optional[str], data: dict) -> None:
+    if not progress_file:
+        return
+    tmp = progress_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, progress_file)
+
+
+def build_backup_zip(
+    root_dir: str,
+    rel_paths: Iterable[str],
+    zip_path: str,
+    extra_files: Optional[dict[str, str]] = None,
+    progress_file: Optional[str] = None,
+    cancel_file: Optional[str] = None,
+    workers: Optional[int] = None,
+    compresslevel: int = 6,
+) -> Optional[dict]:
+    """Gera zip_path com rel_paths (relativos a root_dir) + extra_files (nome no zip → arquivo).
+
+    Retorna {"files", "bytes", "compressed_bytes"} ou None se cancelado (zip parcial removido).
+    """
+    root_dir = os.path.abspath(root_dir)
+    jobs = []
+    for rel in rel_paths:
+        abs_fp = os.path.abspath(os.path.join(root_dir, rel))
+        if abs_fp.startswith(root_dir + os.sep):
+            jobs.append((abs_fp, rel))
+    jobs.extend((abs_fp, arcname) for arcname, abs_fp in (extra_files or {}).items())
+    total = len(jobs)
+    zip_name = os.path.basename(zip_path)
+    workers = max(1, workers or os.cpu_count() or 1)
+
+    def _progress(processed: int, current: Optional[str]) -> None:
+        percent = 0 if total == 0 else round(processed * 100 / total, 2)
+        _save_progress(progress_file, {
+            "running": True, "percent": percent, "processed": processed, "total": total,
+            "current": current, "file": zip_name, "canceled": False,
+        })
+
+    written = 0
+    offset = 0
+    central: list[bytes] = []
+    raw_bytes = 0
+    compressed_bytes = 0
+    processed = 0
+    canceled = False
+    pending: deque = deque()
+    it = iter(jobs)
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backup-zip") as pool, \
+                open(zip_path, "wb") as fp:
+            # Janela limitada de arquivos comprimidos aguardando o escritor
+            for abs_fp, rel in it:
+                pending.append((rel, pool.submit(_compress_file, abs_fp, rel, compresslevel)))
+                if len(pending) >= workers * 2:
+                    break
+            while pending:
+                if cancel_file and os.path.exists(cancel_file):
+                    canceled = True
+                    break
+                rel, fut = pending.popleft()
+                entry = fut.result()
+                if entry is not None:
+                    n, record = _write_entry(fp, entry, offset)
+                    central.append(record)
+                    offset += n
+                    written += 1
+                    raw_bytes += entry.meta.size
+                    compressed_bytes += entry.compress_size
+                processed += 1
+                if processed % PROGRESS_EVERY == 0 or processed == total:
+                    _progress(processed, rel)
+                nxt = next(it, None)
+                if nxt is not None:
+                    pending.append((nxt[1], pool.submit(_compress_file, nxt[0], nxt[1], compresslevel)))
+            if canceled:
+                for _, fut in pending:
+                    fut.cancel()
+                for _, fut in pending:
+                    if not fut.cancelled():
+                        entry = fut.result()
+                        if entry is not None:
+                            entry.data.close()
+            else:
+                cd = b"".join(central)
+                fp.write(cd)
+                fp.write(_end_records(written, offset, len(cd)))
+    except Exception:
+        try:
+            os.remove(zip_path)
+        except OSError:
+            pass
+        raise
+    if canceled:
+        try:
+            os.remove(zip_path)
+        except OSError:
+            pass
+        return None
+    return {"files": written, "bytes": raw_bytes, "compressed_bytes": compressed_bytes}
+
+
+# ---------------- zip em streaming ----------------
+
+
+def stream_entries(root_dir: str) -> list[StreamEntry]:
+    """Arquivos de root_dir (recursivo, ordem estável) prontos para iter_stream_zip."""
+    root_dir = os.path.abspath(root_dir)
+    entries: list[StreamEntry] = []
+    for root, dirs, files in os.walk(root_dir):
+        dirs.sort()
+        for fn in sorted(files):
+            abs_fp = os.path.join(root, fn)
+            # Segurança: garantir que está dentro de root_dir
+            if not os.path.abspath(abs_fp).startswith(root_dir + os.sep):
+                continue
+            try:
+                st = os.stat(abs_fp)
+            except OSError:
+                continue
+            arcname = os.path.relpath(abs_fp, root_dir).replace(os.sep, "/")
+            entries.append(StreamEntry(abs_fp, arcname, st.st_size, st.st_mtime, st.st_mode, compress_type_for(fn)))
+    return entries
+
+
+def stream_zip_size(entries: list[StreamEntry]) -> Optional[int]:
+    """Tamanho exato do zip gerado por iter_stream_zip, se todas as entradas forem ZIP_STORED."""
+    if any(e.compress_type != zipfile.ZIP_STORED for e in entries):
+        return None
+    offset = 0
+    cd_size = 0
+    for e in entries:
+        cd_size += len(_central_header(e, 0, e.size, e.size, offset))
+        offset += len(_local_header(e)) + e.size + len(_data_descriptor(e, 0, e.size, e.size))
+    return offset + cd_size + len(_end_records(len(entries), offset, cd_size))
+
+
+class StreamZipError(OSError):
+    """Arquivo sumiu ou mudou de tamanho durante o download em streaming."""
+
+
+def iter_stream_zip(entries: list[StreamEntry]) -> Iterator[bytes]:
+    """Gera o zip em blocos, lendo cada arquivo só quando sua entrada é emitida.
+
+    Entradas ZIP_STORED precisam ter exatamente e.size bytes (o Content-Length de
+    stream_zip_size depende disso). Se um arquivo sumiu, encolheu ou cresceu desde o stat,
+    o erro é logado e StreamZipError interrompe o stream: o cliente recebe um download
+    visivelmente incompleto em vez de um zip válido com conteúdo inventado.
+    """
+    offset = 0
+    central: list[bytes] = []
+    for e in entries:
+        try:
+            f = open(e.path, "rb")
+        except OSError as exc:
+            logger.error(f"[ZIP] {e.arcname}: arquivo indisponível durante o download ({exc})")
+            raise StreamZipError(f"{e.arcname}: arquivo indisponível") from exc
+        with f:
+            header = _local_header(e)
+            yield header
+            crc = 0
+            usize = 0
+            csize = 0
+            stored = e.compress_type == zipfile.ZIP_STORED
+            comp = None if stored else zlib.compressobj(6, zlib.DEFLATED, -15)
+            while True:
+                want = min(CHUNK_BYTES, e.size - usize) if stored else CHUNK_BYTES
+                if want <= 0:
+                    break
+                chunk = f.read(want)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                usize += len(chunk)
+                data = chunk if stored else comp.compress(chunk)
+                if data:
+                    csize += len(data)
+                    yield data
+            if stored and (usize != e.size or f.read(1)):
+                logger.error(f"[ZIP] {e.arcname}: tamanho mudou durante o download (esperado {e.size} bytes)")
+                raise StreamZipError(f"{e.arcname}: tamanho mudou durante o download")
+            if comp:
+                data = comp.flush()
+                csize += len(data)
+                if data:
+                    yield data
+        yield _data_descriptor(e, crc, csize, usize)
+        central.append(_central_header(e, crc, csize, usize, offset))
+        offset += len(header) + csize + len(_data_descriptor(e, crc, csize, usize))
+    cd = b"".join(central)
+    yield cd
+    yield _end_records(len(entries), offset, len(cd))
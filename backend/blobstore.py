@@ -0,0 +1,138 @@
+"""Armazenamento de arquivos endereçado por conteúdo (SHA-256).
+
+Os arquivos enviados em POST /uploads/{entidade} ficam fora do SQLite, em
+BLOB_STORE_DIR/<aa>/<bb>/<sha256>; a tabela arquivos_importados guarda só o hash,
+tamanho e metadados. Como a chave é o próprio hash, reenvios da mesma planilha
+reaproveitam o mesmo arquivo em disco.
+"""
+import hashlib
+import os
+import tempfile
+from typing import BinaryIO
+
+from sqlalchemy import text
+
+from database import DB_PATH
+
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR") or os.path.join(os.path.dirname(DB_PATH), "blobs")
+BLOB_CHUNK_BYTES = 1024 * 1024
+# Linhas migradas por transação na remoção dos blobs legados do SQLite
+BLOB_MIGRATION_BATCH = int(os.getenv("BLOB_MIGRATION_BATCH", "20"))
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_STORE_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def exists(sha256: str) -> bool:
+    return os.path.exists(blob_path(sha256))
+
+
+def _commit_tmp(tmp_path: str, sha256: str) -> None:
+    dest = blob_path(sha256)
+    if os.path.exists(dest):
+        # Conteúdo idêntico já armazenado
+        os.remove(tmp_path)
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(tmp_path, dest)
+
+
+def _tmp_file():
+    os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".incoming-", dir=BLOB_STORE_DIR)
+    return os.fdopen(fd, "wb"), tmp_path
+
+
+def put_stream(src: BinaryIO) -> tuple[str, int]:
+    """Copia src para o store em blocos, calculando o hash no caminho. Retorna (sha256, tamanho)."""
+    h = hashlib.sha256()
+    size = 0
+    f, tmp_path = _tmp_file()
+    try:
+        with f:
+            while True:
+                chunk = src.read(BLOB_CHUNK_BYTES)
+                if not chunk:
+                    break
+                h.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        sha256 = h.hexdigest()
+        _commit_tmp(tmp_path, sha256)
+        return sha256, size
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def put_bytes(data: bytes) -> tuple[str, int]:
+    sha256 = hashlib.sha256(data).hexdigest()
+    if exists(sha256):
+        return sha256, len(data)
+    f, tmp_path = _tmp_file()
+    try:
+        with f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        _commit_tmp(tmp_path, sha256)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return sha256, len(data)
+
+
+def read_bytes(sha256: str) -> bytes:
+    with open(blob_path(sha256), "rb") as f:
+        return f.read()
+
+
+def upload_content(up) -> bytes:
+    """Conteúdo de um ArquivoImportado, do store ou (registros ainda não migrados) da coluna legada."""
+    if up.sha256:
+        return read_bytes(up.sha256)
+    return up.conteudo or b""
+
+
+def migrate_db_blobs(engine) -> int:
+    """Move o conteúdo legado de arquivos_importados.conteudo para o store.
+
+    Idempotente: processa só linhas sem sha256 e com conteúdo, em lotes pequenos (um blob
+    por vez em memória). A coluna fica com x'' (é NOT NULL em bancos antigos).
+    Retorna a quantidade de registros migrados.
+    """
+    moved = 0
+    while True:
+        with engine.begin() as conn:
+            ids = [
+                r[0]
+                for r in conn.execute(
+                    text(
+                        "SELECT id FROM arquivos_importados "
+                        "WHERE sha256 IS NULL AND conteudo IS NOT NULL AND length(conteudo) > 0 "
+                        "ORDER BY id LIMIT :n"
+                    ),
+                    {"n": BLOB_MIGRATION_BATCH},
+                ).fetchall()
+            ]
+            if not ids:
+                return moved
+            for upload_id in ids:
+                data = conn.execute(
+                    text("SELECT conteudo FROM arquivos_importados WHERE id = :id"), {"id": upload_id}
+                ).scalar()
+                sha256, size = put_bytes(bytes(data))
+                conn.execute(
+                    text("UPDATE arquivos_importados SET sha256 = :sha, tamanho = :size, conteudo = x'' WHERE id = :id"),
+                    {"sha": sha256, "size": size, "id": upload_id},
+                )
+                moved += 1
@@ -1,7 +1,10 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 import os
 import shutil
+import sqlite3
+import gzip
 
 """Módulo de conexão restrito a SQLite.
 
@@ -78,13 +81,188 @@ def _build_sqlite_url():
 
 SQLALCHEMY_DATABASE_URL, CONNECT_ARGS, _REAL_DB_PATH = _build_sqlite_url()
 
-engine = create_engine(
+
+"""Perfil de execução do SQLite.
+
+SQLITE_PROFILE=production (padrão) aplica em cada nova conexão:
+  - journal_mode=WAL → leitores não bloqueiam escritores (e vice-versa)
+  - synchronous=NORMAL → seguro com WAL e bem mais rápido que FULL
+  - busy_timeout → espera pelo lock em vez de falhar com "database is locked"
+  - mmap_size / cache_size → leituras servidas da memória
+SQLITE_PROFILE=legacy mantém o comportamento antigo (rollback journal, sem pragmas).
+
+Cada pragma pode ser ajustado por variável de ambiente (ver SQLITE_PRAGMAS abaixo).
+"""
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "production").strip().lower()
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_PRAGMAS = {
+	"journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+	"synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+	"busy_timeout": SQLITE_BUSY_TIMEOUT_MS,
+	"mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+	# Valor negativo = tamanho em KiB (aqui ~8 MB por conexão; ver orçamento de memória abaixo)
+	"cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-8192")),
+	"temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+# Pool dimensionado para o threadpool do FastAPI/Starlette (endpoints síncronos rodam
+# em threads; o padrão do AnyIO é 40). Conexões SQLite são baratas, mas reaproveitá-las
+# evita reabrir o arquivo e reaplicar os pragmas a cada request.
+#
+# Orçamento de memória: o cache de páginas é por conexão, então o pior caso é
+#   (DB_POOL_SIZE + DB_MAX_OVERFLOW + DB_READ_POOL_SIZE + DB_READ_MAX_OVERFLOW) × |cache_size|
+# = (10 + 30 + 10 + 10) × 8 MB ≈ 480 MB com os padrões. Na prática cada cache só cresce até
+# as páginas lidas por aquela conexão (nunca além do tamanho do banco) e o mmap é page
+# cache do SO, compartilhado. Em instâncias pequenas (512 MB) reduza SQLITE_CACHE_SIZE ou
+# os overflows antes de aumentar os pools.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "30"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+SQL_ECHO = os.getenv("SQL_ECHO", "0") == "1"
+
+if SQLITE_PROFILE != "legacy":
+	# timeout do driver sqlite3 (segundos) alinhado ao busy_timeout
+	CONNECT_ARGS["timeout"] = SQLITE_BUSY_TIMEOUT_MS / 1000
+
+
+def _apply_sqlite_pragmas(dbapi_conn, pragmas: dict):
+	cursor = dbapi_conn.cursor()
+	try:
+		for name, value in pragmas.items():
+			try:
+				cursor.execute(f"PRAGMA {name}={value}")
+			except Exception as e:
+				# Ex.: WAL indisponível em alguns filesystems de rede; segue com o padrão
+				print(f"[SQLITE][PRAGMA][WARN] {name}={value}: {e}")
+	finally:
+		cursor.close()
+
+
+def _build_engine(url: str, connect_args: dict, pragmas: dict | None, pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW):
+	eng = create_engine(
+		url,
+		connect_args=connect_args,
+		echo=SQL_ECHO,
+		future=True,
+		poolclass=QueuePool,
+		pool_size=pool_size,
+		max_overflow=max_overflow,
+		pool_timeout=DB_POOL_TIMEOUT,
+		pool_recycle=DB_POOL_RECYCLE,
+		pool_pre_ping=True,
+	)
+	if pragmas:
+		@event.listens_for(eng, "connect")
+		def _on_connect(dbapi_conn, _record):
+			_apply_sqlite_pragmas(dbapi_conn, pragmas)
+	return eng
+
+
+engine = _build_engine(
 	SQLALCHEMY_DATABASE_URL,
-	connect_args=CONNECT_ARGS,
-	echo=True,
-	future=True,
+	CONNECT_ARGS,
+	SQLITE_PRAGMAS if SQLITE_PROFILE != "legacy" else None,
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Engine somente leitura para endpoints GET (listagens/detalhes).
+# Com WAL, leitores não disputam o lock de escrita; um pool separado evita que listagens
+# longas ocupem conexões de que os escritores precisam. query_only=ON garante que
+# nenhuma escrita acidental passe por aqui. journal_mode não é reaplicado (é persistente
+# no arquivo e exigiria escrita).
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", str(DB_POOL_SIZE)))
+# Overflow menor que o da escrita: leituras longas não devem multiplicar caches por conexão
+DB_READ_MAX_OVERFLOW = int(os.getenv("DB_READ_MAX_OVERFLOW", "10"))
+SQLITE_READ_PRAGMAS = {k: v for k, v in SQLITE_PRAGMAS.items() if k != "journal_mode"}
+SQLITE_READ_PRAGMAS["query_only"] = "ON"
+
+read_engine = _build_engine(
+	SQLALCHEMY_DATABASE_URL,
+	dict(CONNECT_ARGS),
+	SQLITE_READ_PRAGMAS if SQLITE_PROFILE != "legacy" else {"query_only": "ON"},
+	pool_size=DB_READ_POOL_SIZE,
+	max_overflow=DB_READ_MAX_OVERFLOW,
+)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
 # Expor o caminho real do arquivo SQLite
 DB_PATH = _REAL_DB_PATH
+
+
+def dispose_engines():
+	"""Fecha todas as conexões (escrita e leitura), p.ex. após restore do arquivo."""
+	engine.dispose()
+	read_engine.dispose()
+
+
+# Snapshot online (API de backup do SQLite): copia N páginas por passo e libera o lock
+# entre passos, então escritores não ficam bloqueados durante a cópia inteira.
+SQLITE_BACKUP_PAGES = int(os.getenv("SQLITE_BACKUP_PAGES", "1024"))
+SQLITE_BACKUP_SLEEP = float(os.getenv("SQLITE_BACKUP_SLEEP", "0.005"))
+SNAPSHOT_CHUNK_BYTES = 1024 * 1024
+
+
+def snapshot_sqlite(dest_path: str, src_path: str | None = None, compress: str | None = None) -> str:
+	"""Gera uma cópia consistente do banco em dest_path (sem parar a aplicação).
+
+	Usa sqlite3.Connection.backup em passos de SQLITE_BACKUP_PAGES páginas. O arquivo
+	gerado é autocontido (journal_mode=DELETE, sem -wal/-shm) e só aparece com o nome
+	final quando completo. compress="gzip" comprime em streaming para dest_path (.gz).
+	Retorna dest_path.
+	"""
+	src_path = src_path or DB_PATH
+	dest_dir = os.path.dirname(os.path.abspath(dest_path))
+	os.makedirs(dest_dir, exist_ok=True)
+	tmp_db = dest_path + ".snapshot-tmp"
+	src = sqlite3.connect(src_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+	try:
+		dst = sqlite3.connect(tmp_db)
+		try:
+			src.backup(dst, pages=SQLITE_BACKUP_PAGES, sleep=SQLITE_BACKUP_SLEEP)
+			dst.execute("PRAGMA journal_mode=DELETE")
+		finally:
+			dst.close()
+	except Exception:
+		_remove_quietly(tmp_db)
+		raise
+	finally:
+		src.close()
+	try:
+		if compress == "gzip":
+			tmp_gz = dest_path + ".gz-tmp"
+			with open(tmp_db, "rb") as fin, gzip.open(tmp_gz, "wb", compresslevel=6) as fout:
+				shutil.copyfileobj(fin, fout, SNAPSHOT_CHUNK_BYTES)
+			os.replace(tmp_gz, dest_path)
+		else:
+			os.replace(tmp_db, dest_path)
+	finally:
+		_remove_quietly(tmp_db)
+		_remove_quietly(dest_path + ".gz-tmp")
+	return dest_path
+
+
+def _remove_quietly(path: str):
+	try:
+		if os.path.exists(path):
+			os.remove(path)
+	except OSError:
+		pass
+
+
+def remove_sqlite_sidecars(db_path: str | None = None):
+	"""Remove arquivos -wal/-shm órfãos do SQLite.
+
+	Deve ser chamado com o pool já descartado (engine.dispose()) antes de substituir
+	o arquivo principal (restore/reset); caso contrário o WAL antigo seria reaplicado
+	sobre o banco novo.
+	"""
+	path = db_path or DB_PATH
+	if not path:
+		return
+	for suffix in ("-wal", "-shm"):
+		try:
+			if os.path.exists(path + suffix):
+				os.remove(path + suffix)
+		except OSError:
+			pass
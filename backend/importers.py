@@ -0,0 +1,442 @@
+"""Importação de planilhas (CSV/XLSX) para as entidades do sistema.
+
+Funções puras (recebem Session + bytes do arquivo) para poderem ser chamadas tanto pelo
+endpoint POST /uploads/{entidade} quanto por workers em background. Não importam main.py.
+
+Estratégia: colunas normalizadas uma única vez, tipos convertidos coluna a coluna com
+pandas e gravação em lote (executemany) em uma única transação.
+"""
+import datetime
+import io
+import json
+import os
+import re
+import unicodedata
+from typing import Callable, Optional
+
+import pandas as pd
+from sqlalchemy import bindparam
+from sqlalchemy.orm import Session
+
+from models import Cliente, Contrato, ValorMaterial
+
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "5000"))
+# Quantidade máxima de mensagens de erro devolvidas ao cliente
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "50"))
+
+# Callback opcional de progresso: (linhas gravadas, total a gravar)
+ProgressFn = Optional[Callable[[int, int], None]]
+
+
+class ImportValidationError(ValueError):
+    """Planilha rejeitada por inteiro (colunas erradas ou linhas inválidas em import estrito)."""
+
+
+def read_dataframe(content: bytes, filename: str) -> pd.DataFrame:
+    buf = io.BytesIO(content)
+    if filename.lower().endswith(".csv"):
+        return pd.read_csv(buf)
+    return pd.read_excel(buf)
+
+
+def _norm_key(name) -> str:
+    """'Descrição Produto' / 'descricao-produto' / 'DESCRICAO_PRODUTO' → 'descricao_produto'."""
+    text = unicodedata.normalize("NFKD", str(name).strip().lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"[\s\-]+", "_", text)
+
+
+def resolve_columns(df: pd.DataFrame, aliases: dict[str, list[str]]) -> dict[str, str]:
+    """Mapeia campo destino → coluna do DataFrame, aceitando as variações de nome usuais.
+
+    Para cada campo testa os aliases em ordem; cada alias casa com a coluna escrita com
+    espaço, hífen, underscore ou sem separador.
+    """
+    by_key: dict[str, str] = {}
+    for c in df.columns:
+        k = _norm_key(c)
+        by_key.setdefault(k, c)
+        by_key.setdefault(k.replace("_", ""), c)
+    resolved: dict[str, str] = {}
+    for field, names in aliases.items():
+        for name in names:
+            col = by_key.get(name) or by_key.get(name.replace("_", ""))
+            if col is not None:
+                resolved[field] = col
+                break
+    return resolved
+
+
+def text_column(df: pd.DataFrame, col: str | None) -> pd.Series:
+    if col is None:
+        return pd.Series([""] * len(df), index=df.index, dtype=object)
+    s = df[col]
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s.dt.strftime("%Y-%m-%d").fillna("")
+    if pd.api.types.is_float_dtype(s) and (s.dropna() % 1 == 0).all():
+        # Códigos/CNPJ numéricos lidos como float: 123.0 → '123'
+        s = s.astype("Int64").astype(object)
+    return s.where(s.notna(), "").astype(str).str.strip()
+
+
+def numeric_column(df: pd.DataFrame, col: str | None, errors: list[tuple[int, str]], label: str) -> pd.Series:
+    """Converte para número; vazio → 0, texto não numérico → erro por linha."""
+    if col is None:
+        return pd.Series([0.0] * len(df), index=df.index)
+    raw = df[col]
+    num = pd.to_numeric(raw, errors="coerce")
+    bad = num.isna() & raw.notna() & (raw.astype(str).str.strip() != "")
+    for idx in df.index[bad]:
+        errors.append((idx, f"'{label}' inválido"))
+    return num.fillna(0.0)
+
+
+def format_errors(errors: list[tuple[int, str]]) -> list[str]:
+    """(índice do DataFrame, mensagem) → 'Linha N: mensagem' (N = linha da planilha)."""
+    return [f"Linha {idx + 2}: {msg}." for idx, msg in sorted(errors, key=lambda e: e[0])[:IMPORT_MAX_ERRORS]]
+
+
+def _chunks(rows: list, size: int):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def _write_batches(db: Session, table, inserts: list[dict], update_stmt=None, updates: list[dict] | None = None, progress: ProgressFn = None) -> None:
+    """INSERT/UPDATE em lotes de IMPORT_CHUNK_ROWS numa única transação, reportando progresso."""
+    updates = updates or []
+    total = len(inserts) + len(updates)
+    done = 0
+    if progress:
+        progress(0, total)
+    try:
+        for chunk in _chunks(inserts, IMPORT_CHUNK_ROWS):
+            db.execute(table.insert(), chunk)
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+        for chunk in _chunks(updates, IMPORT_CHUNK_ROWS):
+            db.execute(update_stmt, chunk)
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+# ---------------- Valor Materiais ----------------
+VALOR_MATERIAIS_ALIASES = {
+    "descricao_produto": ["descricao_produto", "descricao"],
+    "marca": ["marca"],
+    "unidade_medida": ["unidade_medida", "unidade"],
+    "valor_unitario": ["valor_unitario", "valor"],
+    "estoque_atual": ["estoque_atual"],
+    "estoque_minimo": ["estoque_minimo"],
+    "data_ultima_entrada": ["data_ultima_entrada"],
+    "responsavel": ["responsavel"],
+    "fornecedor": ["fornecedor"],
+    "valor": ["valor"],
+    "localizacao": ["localizacao"],
+    "observacoes": ["observacoes"],
+}
+
+
+def import_valor_materiais(db: Session, content: bytes, filename: str, progress: ProgressFn = None) -> dict:
+    """Importa materiais em lote. Linhas com valores numéricos inválidos são ignoradas e
+    reportadas; as demais são gravadas numa única transação."""
+    df = read_dataframe(content, filename)
+    df = df.dropna(how="all")
+    cols = resolve_columns(df, VALOR_MATERIAIS_ALIASES)
+    errors: list[tuple[int, str]] = []
+
+    out = pd.DataFrame(index=df.index)
+    for field in ("descricao_produto", "marca", "unidade_medida", "data_ultima_entrada",
+                  "responsavel", "fornecedor", "localizacao", "observacoes"):
+        out[field] = text_column(df, cols.get(field))
+    out["valor_unitario"] = numeric_column(df, cols.get("valor_unitario"), errors, "valor_unitario")
+    out["valor"] = numeric_column(df, cols.get("valor"), errors, "valor")
+    for field in ("estoque_atual", "estoque_minimo"):
+        out[field] = numeric_column(df, cols.get(field), errors, field).astype("int64")
+    out["cliente_id"] = None
+
+    bad_idx = {idx for idx, _ in errors}
+    if bad_idx:
+        out = out.drop(index=list(bad_idx))
+    records = out.astype(object).to_dict("records")
+
+    _write_batches(db, ValorMaterial.__table__, records, progress=progress)
+    return {"imported": len(records), "errors": format_errors(errors)}
+
+
+# ---------------- Clientes ----------------
+CLIENTES_ALIASES = {
+    "id": ["id"],
+    "nome": ["nome"],
+    "cnpj": ["cnpj"],
+    "email": ["email"],
+    "contato": ["contato"],
+    "endereco": ["endereco"],
+}
+_CLIENTE_FIELDS = ("cnpj", "email", "contato", "endereco")
+
+
+def import_clientes(db: Session, content: bytes, filename: str, progress: ProgressFn = None) -> dict:
+    """Upsert de clientes resolvido em memória.
+
+    Carrega id/cnpj/nome dos clientes existentes em mapas uma única vez; cada linha é
+    casada por id, depois cnpj, depois nome (mesma prioridade de antes). Linhas repetidas na
+    própria planilha caem no mesmo registro. No fim, um INSERT e um UPDATE em lote.
+    Campos vazios na planilha não apagam valores existentes.
+    """
+    df = read_dataframe(content, filename)
+    cols = resolve_columns(df, CLIENTES_ALIASES)
+    nomes = text_column(df, cols.get("nome"))
+    values = {f: text_column(df, cols.get(f)) for f in _CLIENTE_FIELDS}
+    ids = pd.to_numeric(df[cols["id"]], errors="coerce") if "id" in cols else pd.Series([None] * len(df), index=df.index)
+
+    existing: dict[int, dict] = {}
+    by_cnpj: dict[str, int] = {}
+    by_nome: dict[str, int] = {}
+    for row in db.query(Cliente.id, Cliente.nome, Cliente.cnpj, Cliente.email, Cliente.contato, Cliente.endereco).all():
+        existing[row.id] = {"nome": row.nome, "cnpj": row.cnpj, "email": row.email, "contato": row.contato, "endereco": row.endereco}
+        if row.cnpj:
+            by_cnpj.setdefault(row.cnpj, row.id)
+        by_nome.setdefault(row.nome, row.id)
+
+    updates: dict[int, dict] = {}
+    # Novos registros; new_by_* apontam para a posição em inserts (linhas repetidas na planilha)
+    inserts: list[dict] = []
+    new_by_cnpj: dict[str, int] = {}
+    new_by_nome: dict[str, int] = {}
+
+    for idx in df.index:
+        nome = nomes[idx]
+        if not nome:
+            continue  # Pular linhas sem nome
+        data = {f: values[f][idx] for f in _CLIENTE_FIELDS}
+        cnpj = data["cnpj"]
+
+        target_id = None
+        _id = ids[idx]
+        if pd.notna(_id) and int(_id) in existing:
+            target_id = int(_id)
+        if target_id is None and cnpj:
+            target_id = by_cnpj.get(cnpj)
+        if target_id is None:
+            target_id = by_nome.get(nome)
+
+        if target_id is not None:
+            current = updates.get(target_id) or existing[target_id]
+            changed = {f: v for f, v in data.items() if v and current.get(f) != v}
+            if changed:
+                merged = {**current, **changed}
+                updates[target_id] = merged
+                if changed.get("cnpj"):
+                    by_cnpj[changed["cnpj"]] = target_id
+            continue
+
+        pos = new_by_cnpj.get(cnpj) if cnpj else None
+        if pos is None:
+            pos = new_by_nome.get(nome)
+        if pos is not None:
+            rec = inserts[pos]
+            for f, v in data.items():
+                if v:
+                    rec[f] = v
+        else:
+            pos = len(inserts)
+            inserts.append({"nome": nome, **{f: (v or None) for f, v in data.items()}})
+            new_by_nome[nome] = pos
+        if cnpj:
+            new_by_cnpj[cnpj] = pos
+
+    table = Cliente.__table__
+    stmt = (
+        table.update()
+        .where(table.c.id == bindparam("_id"))
+        .values({f: bindparam(f) for f in _CLIENTE_FIELDS})
+    )
+    params = [{"_id": cid, **{f: rec.get(f) for f in _CLIENTE_FIELDS}} for cid, rec in updates.items()]
+    _write_batches(db, table, inserts, stmt, params, progress)
+    return {"imported": len(inserts) + len(updates), "errors": []}
+
+
+# ---------------- Contratos ----------------
+CONTRATOS_COLUMNS = [
+    "numero",
+    "cliente_id",
+    "valor",
+    "dataInicio",
+    "dataFim",
+    "tipo",
+    "situacao",
+    "prazoPagamento",
+    "quantidadeParcelas",
+]
+_CONTRATO_FIELDS = ("cliente_id", "valor", "dataInicio", "dataFim", "tipo", "situacao", "prazoPagamento", "quantidadeParcelas")
+
+
+def _date_column(df: pd.DataFrame, col: str, errors: list[tuple[int, str]]) -> pd.Series:
+    """Datas em lote; vazio → None, texto não reconhecido → erro por linha."""
+    raw = df[col]
+    parsed = pd.to_datetime(raw, errors="coerce", format="mixed")
+    blank = raw.isna() | (raw.astype(str).str.strip() == "")
+    for idx in df.index[parsed.isna() & ~blank]:
+        errors.append((idx, f"'{col}' inválida"))
+    return parsed.dt.date.astype(object).where(parsed.notna(), None)
+
+
+def import_contratos(db: Session, content: bytes, filename: str, progress: ProgressFn = None) -> dict:
+    """Importação estrita (tudo ou nada) de contratos, com upsert por número.
+
+    Valida a planilha inteira antes de gravar: tipos convertidos por coluna, clientes
+    conferidos com um único SELECT ... IN e contratos existentes carregados de uma vez.
+    Qualquer erro levanta ImportValidationError e nada é gravado.
+    """
+    df = read_dataframe(content, filename)
+    norm = [str(c).strip() for c in df.columns]
+    if set(norm) != set(CONTRATOS_COLUMNS) or len(norm) != len(CONTRATOS_COLUMNS):
+        raise ImportValidationError(f"Colunas inválidas. Use exatamente estas colunas: {', '.join(CONTRATOS_COLUMNS)}")
+    df.columns = norm
+
+    errors: list[tuple[int, str]] = []
+    numeros = text_column(df, "numero")
+    for idx in df.index[numeros == ""]:
+        errors.append((idx, "campo 'numero' é obrigatório"))
+    cliente_ids = pd.to_numeric(df["cliente_id"], errors="coerce")
+    for idx in df.index[cliente_ids.isna()]:
+        errors.append((idx, "'cliente_id' inválido"))
+    valores = pd.to_numeric(df["valor"], errors="coerce")
+    for idx in df.index[valores.isna()]:
+        errors.append((idx, "'valor' inválido"))
+    data_inicio = _date_column(df, "dataInicio", errors)
+    data_fim = _date_column(df, "dataFim", errors)
+
+    # FK cliente: um único SELECT para todos os ids referenciados
+    referenced = {int(v) for v in cliente_ids.dropna().unique()}
+    known = {cid for (cid,) in db.query(Cliente.id).filter(Cliente.id.in_(referenced)).all()} if referenced else set()
+    for idx in df.index[cliente_ids.notna()]:
+        cid = int(cliente_ids[idx])
+        if cid not in known:
+            errors.append((idx, f"cliente_id {cid} não existe"))
+
+    if errors:
+        # Rejeitar a planilha inteira (aceitar somente se 100% válida)
+        messages = format_errors(errors)
+        preview = "; ".join(messages[:10])
+        if len(errors) > 10:
+            preview += f" (+{len(errors)-10} erros)"
+        raise ImportValidationError(f"Erros de validação: {preview}")
+
+    texts = {f: text_column(df, f) for f in ("tipo", "situacao", "prazoPagamento", "quantidadeParcelas")}
+    # Upsert por numero; linhas repetidas na planilha atualizam o mesmo registro (vale a última)
+    by_numero: dict[str, dict] = {}
+    for idx in df.index:
+        rec = {
+            "numero": numeros[idx],
+            "cliente_id": int(cliente_ids[idx]),
+            "valor": float(valores[idx]),
+            "dataInicio": data_inicio[idx],
+            "dataFim": data_fim[idx],
+        }
+        rec.update({f: (texts[f][idx] or None) for f in texts})
+        by_numero[rec["numero"]] = rec
+
+    existing: dict[str, int] = {}
+    if by_numero:
+        rows = (
+            db.query(Contrato.id, Contrato.numero)
+            .filter(Contrato.numero.in_(list(by_numero)))
+            .order_by(Contrato.id)
+            .all()
+        )
+        for cid, numero in rows:
+            existing.setdefault(numero, cid)
+
+    inserts = [rec for numero, rec in by_numero.items() if numero not in existing]
+    updates = [{"_id": existing[numero], **{f: rec[f] for f in _CONTRATO_FIELDS}} for numero, rec in by_numero.items() if numero in existing]
+
+    table = Contrato.__table__
+    stmt = (
+        table.update()
+        .where(table.c.id == bindparam("_id"))
+        .values({f: bindparam(f) for f in _CONTRATO_FIELDS})
+    )
+    _write_batches(db, table, inserts, stmt, updates, progress)
+    return {"imported": len(df.index), "errors": []}
+
+
+# ---------------- Jobs de importação em background ----------------
+# Entidades que aceitam importação assíncrona (POST /uploads/{entidade}?async=1)
+IMPORTERS = {
+    "valor_materiais": import_valor_materiais,
+    "clientes": import_clientes,
+    "contratos": import_contratos,
+}
+
+
+def load_job(path: str) -> dict | None:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_job(path: str, data: dict) -> None:
+    # Escrita atômica: o arquivo é lido pelo endpoint de status enquanto o worker grava
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, default=str)
+    os.replace(tmp, path)
+
+
+def update_job(path: str, **fields) -> dict:
+    data = load_job(path) or {}
+    data.update(fields)
+    save_job(path, data)
+    return data
+
+
+def _now_iso() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def run_import_job(job_path: str, upload_id: int, entidade: str, filename: str) -> dict:
+    """Executa a importação de um ArquivoImportado já gravado (roda no pool de processos).
+
+    Abre sessão própria, lê o conteúdo do banco e grava o andamento em job_path.
+    """
+    import blobstore
+    from database import SessionLocal, engine
+    from models import ArquivoImportado
+
+    update_job(job_path, status="running", started_at=_now_iso())
+    db = SessionLocal()
+    try:
+        up = db.get(ArquivoImportado, upload_id)
+        if up is None:
+            raise ImportValidationError(f"Upload {upload_id} não encontrado")
+        if up.sha256 and not blobstore.exists(up.sha256):
+            raise ImportValidationError("Conteúdo do upload não encontrado")
+
+        def progress(done: int, total: int) -> None:
+            update_job(job_path, processed=done, total=total)
+
+        result = IMPORTERS[entidade](db, blobstore.upload_content(up), filename, progress=progress)
+        return update_job(
+            job_path,
+            status="done",
+            records_imported=result["imported"],
+            errors=result["errors"],
+            finished_at=_now_iso(),
+        )
+    except ImportValidationError as e:
+        return update_job(job_path, status="error", records_imported=0, errors=[str(e)], finished_at=_now_iso())
+    except Exception as e:
+        return update_job(job_path, status="error", records_imported=0, errors=[f"Falha ao importar: {e}"], finished_at=_now_iso())
+    finally:
+        db.close()
+        # Não manter conexões abertas no worker (o banco pode ser trocado por restore)
+        engine.dispose()
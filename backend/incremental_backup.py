@@ -0,0 +1,268 @@
+"""Backup incremental com deduplicação por conteúdo.
+
+Layout em <BACKUP_DIR>/incremental/:
+  manifests/manifest_<stamp>.json  → estado completo da árvore naquele instante
+  archives/inc_<stamp>.zip         → só o conteúdo novo daquele backup
+
+Cada manifesto lista todos os arquivos (path → size, mtime, sha256, archive). Arquivos com
+mesmo tamanho/mtime do manifesto anterior não são relidos; conteúdo já presente em algum
+arquivo anterior (mesmo sha256, inclusive em outro caminho) só é referenciado. Dentro dos
+zips a entrada é o próprio sha256, então qualquer manifesto pode ser remontado (restore de
+qualquer ponto no tempo) juntando as entradas dos archives referenciados.
+
+Sem dependência de main.py: funções recebem diretórios e callbacks.
+"""
+import datetime
+import hashlib
+import json
+import os
+import zipfile
+from typing import Callable, Iterable, Optional
+
+from backup_zip import compress_type_for
+
+HASH_CHUNK_BYTES = 1024 * 1024
+MANIFEST_VERSION = 1
+
+
+def _dirs(backup_dir: str) -> tuple[str, str]:
+    base = os.path.join(backup_dir, "incremental")
+    manifests = os.path.join(base, "manifests")
+    archives = os.path.join(base, "archives")
+    os.makedirs(manifests, exist_ok=True)
+    os.makedirs(archives, exist_ok=True)
+    return manifests, archives
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_BYTES)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def list_manifests(backup_dir: str) -> list[str]:
+    """Nomes dos manifestos, do mais recente para o mais antigo."""
+    manifests_dir, _ = _dirs(backup_dir)
+    names = [n for n in os.listdir(manifests_dir) if n.startswith("manifest_") and n.endswith(".json")]
+    return sorted(names, reverse=True)
+
+
+def load_manifest(backup_dir: str, name: str) -> dict:
+    manifests_dir, _ = _dirs(backup_dir)
+    with open(os.path.join(manifests_dir, os.path.basename(name)), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(manifests_dir: str, name: str, data: dict) -> None:
+    tmp = os.path.join(manifests_dir, f".{name}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(manifests_dir, name))
+
+
+def run_incremental_backup(
+    root_dir: str,
+    rel_paths: Iterable[str],
+    backup_dir: str,
+    progress: Optional[Callable[[int, int, Optional[str]], None]] = None,
+    is_canceled: Optional[Callable[[], bool]] = None,
+    compresslevel: int = 6,
+    extra_files: Optional[dict[str, str]] = None,
+) -> Optional[dict]:
+    """Gera um novo manifesto + archive só com o conteúdo novo.
+
+    extra_files: caminho no backup → arquivo em disco fora de root_dir (ex.: snapshot do banco).
+
+    Retorna um resumo ({manifest, archive, file_count, new_files, new_bytes, ...}) ou None se
+    cancelado (nada é gravado nesse caso).
+    """
+    manifests_dir, archives_dir = _dirs(backup_dir)
+    extra_files = extra_files or {}
+    rel_paths = [r for r in rel_paths if r not in extra_files] + list(extra_files)
+    total = len(rel_paths)
+
+    previous = list_manifests(backup_dir)
+    prev_files: dict = {}
+    if previous:
+        prev_files = load_manifest(backup_dir, previous[0]).get("files", {})
+    # sha256 → archive onde o conteúdo já está guardado
+    known: dict[str, str] = {e["sha256"]: e["archive"] for e in prev_files.values()}
+
+    now = datetime.datetime.now()
+    stamp = now.strftime("%Y-%m-%d_%H-%M-%S")
+    n = 1
+    while os.path.exists(os.path.join(manifests_dir, f"manifest_{stamp}.json")):
+        # Dois backups no mesmo segundo
+        n += 1
+        stamp = now.strftime("%Y-%m-%d_%H-%M-%S") + f"_{n}"
+    archive_name = f"inc_{stamp}.zip"
+    manifest_name = f"manifest_{stamp}.json"
+    archive_path = os.path.join(archives_dir, archive_name)
+    tmp_archive = archive_path + ".inprogress"
+
+    files: dict[str, dict] = {}
+    new_files = 0
+    new_bytes = 0
+    reused = 0
+    processed = 0
+    try:
+        with zipfile.ZipFile(tmp_archive, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+            for rel in rel_paths:
+                if is_canceled and is_canceled():
+                    raise _Canceled()
+                abs_fp = extra_files.get(rel) or os.path.join(root_dir, rel)
+                try:
+                    st = os.stat(abs_fp)
+                except OSError:
+                    continue  # removido durante o backup
+                prev = prev_files.get(rel)
+                if prev and prev["size"] == st.st_size and prev["mtime"] == st.st_mtime_ns:
+                    files[rel] = prev
+                    reused += 1
+                else:
+                    try:
+                        sha = _sha256_file(abs_fp)
+                        if sha not in known:
+                            zf.write(abs_fp, arcname=sha, compress_type=compress_type_for(rel))
+                            known[sha] = archive_name
+                            new_files += 1
+                            new_bytes += st.st_size
+                    except OSError:
+                        continue  # ignora arquivo com erro (mesmo comportamento do backup completo)
+                    files[rel] = {"size": st.st_size, "mtime": st.st_mtime_ns, "sha256": sha, "archive": known[sha]}
+                processed += 1
+                if progress and (processed % 20 == 0 or processed == total):
+                    progress(processed, total, rel)
+    except _Canceled:
+        try:
+            os.remove(tmp_archive)
+        except OSError:
+            pass
+        return None
+    except Exception:
+        try:
+            os.remove(tmp_archive)
+        except OSError:
+            pass
+        raise
+
+    if new_files:
+        os.replace(tmp_archive, archive_path)
+    else:
+        # Nada novo: manifesto só referencia archives anteriores
+        os.remove(tmp_archive)
+        archive_name = None
+
+    summary = {
+        "manifest": manifest_name,
+        "archive": archive_name,
+        "file_count": len(files),
+        "new_files": new_files,
+        "new_bytes": new_bytes,
+        "reused_files": reused,
+        "base": previous[0] if previous else None,
+    }
+    _save_manifest(
+        manifests_dir,
+        manifest_name,
+        {"version": MANIFEST_VERSION, "created_at": now.isoformat(timespec="seconds"), **summary, "files": files},
+    )
+    return summary
+
+
+class _Canceled(Exception):
+    pass
+
+
+def restore_to_dir(backup_dir: str, manifest_name: str, dest_dir: str) -> int:
+    """Remonta em dest_dir a árvore de um manifesto. Retorna a quantidade de arquivos."""
+    _, archives_dir = _dirs(backup_dir)
+    manifest = load_manifest(backup_dir, manifest_name)
+    dest_root = os.path.abspath(dest_dir)
+    count = 0
+    for archive, entries in _group_by_archive(manifest).items():
+        with zipfile.ZipFile(os.path.join(archives_dir, archive)) as zf:
+            for rel, entry in entries:
+                target = os.path.abspath(os.path.join(dest_root, rel))
+                if not target.startswith(dest_root + os.sep):
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with zf.open(entry["sha256"]) as src, open(target, "wb") as out:
+                    while True:
+                        chunk = src.read(HASH_CHUNK_BYTES)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                mtime_ns = entry["mtime"]
+                os.utime(target, ns=(mtime_ns, mtime_ns))
+                count += 1
+    return count
+
+
+def restore_to_zip(backup_dir: str, manifest_name: str, zip_path: str) -> int:
+    """Gera um zip completo (mesmo formato do backup completo) de um manifesto."""
+    _, archives_dir = _dirs(backup_dir)
+    manifest = load_manifest(backup_dir, manifest_name)
+    count = 0
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as out:
+        for archive, entries in _group_by_archive(manifest).items():
+            with zipfile.ZipFile(os.path.join(archives_dir, archive)) as zf:
+                for rel, entry in entries:
+                    with zf.open(entry["sha256"]) as src, out.open(rel, "w") as dst:
+                        while True:
+                            chunk = src.read(HASH_CHUNK_BYTES)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                    count += 1
+    return count
+
+
+def _group_by_archive(manifest: dict) -> dict[str, list[tuple[str, dict]]]:
+    # Abrir cada archive uma única vez
+    grouped: dict[str, list[tuple[str, dict]]] = {}
+    for rel, entry in manifest.get("files", {}).items():
+        grouped.setdefault(entry["archive"], []).append((rel, entry))
+    return grouped
+
+
+def prune(backup_dir: str, keep: int = 7) -> dict:
+    """Mantém os `keep` manifestos mais recentes e apaga archives que nenhum deles referencia.
+
+    Se algum manifesto mantido não puder ser lido, nenhum archive é apagado (não dá para
+    saber quais ele referencia); o nome vai em "unreadable".
+    """
+    manifests_dir, archives_dir = _dirs(backup_dir)
+    names = list_manifests(backup_dir)
+    removed_manifests = []
+    for name in names[keep:]:
+        try:
+            os.remove(os.path.join(manifests_dir, name))
+            removed_manifests.append(name)
+        except OSError:
+            continue
+    live: set[str] = set()
+    unreadable = []
+    for name in names[:keep]:
+        try:
+            live.update(e["archive"] for e in load_manifest(backup_dir, name).get("files", {}).values())
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            unreadable.append(name)
+    if unreadable:
+        return {"manifests": removed_manifests, "archives": [], "unreadable": unreadable}
+    removed_archives = []
+    for fn in os.listdir(archives_dir):
+        if fn.endswith(".zip") and fn not in live:
+            try:
+                os.remove(os.path.join(archives_dir, fn))
+                removed_archives.append(fn)
+            except OSError:
+                continue
+    return {"manifests": removed_manifests, "archives": removed_archives, "unreadable": []}
@@ -1,4 +1,4 @@
-from fastapi import File, UploadFile, FastAPI, Depends, HTTPException, status, Form, BackgroundTasks
+from fastapi import File, UploadFile, FastAPI, Depends, HTTPException, status, Form, BackgroundTasks, Query, Request
 import io
 from typing import Optional, List
 import datetime
@@ -7,17 +7,27 @@ import logging
 from jose import JWTError, jwt
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import Headers
 from starlette.middleware.gzip import GZipMiddleware
 from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import text, or_, and_, func, select, DateTime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import os
 import shutil
 import uuid
 import sys
 sys.path.append(os.path.dirname(__file__))
-from database import SessionLocal, engine
+import importers
+import blobstore
+import media
+import incremental_backup
+import backup_zip
+import autocomplete
+import search_index
+from database import SessionLocal, ReadSessionLocal, engine, read_engine, dispose_engines, remove_sqlite_sidecars, snapshot_sqlite
 try:
     # Caminho do arquivo SQLite quando em uso
     from database import DB_PATH  # type: ignore
@@ -44,22 +54,37 @@ from models import (
     LojaGrupo,
     ClienteGrupo,
     RelatorioObras,
+    RelatorioObrasMaoDeObra,
+    RelatorioObrasEquipamento,
+    RelatorioObrasAtividade,
     MaoDeObraHistorico,
     EquipamentoHistorico,
     AtividadeHistorico,
     CondicaoClimaticaHistorico,
 )
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, computed_field
+from dataclasses import dataclass
 import asyncio
+import functools
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import os
-import pandas as pd
 import io
 import uvicorn
 import json
+import csv
+import decimal
+import base64
 import hashlib
-import zipfile
+import tempfile
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse, FileResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask as StarletteBackgroundTask
 
 
 logger = logging.getLogger(__name__)
@@ -73,6 +98,14 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db():
+    """Sessão somente leitura (pool separado, PRAGMA query_only) para endpoints GET."""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 Base.metadata.create_all(bind=engine)
 
 # Garante índices importantes para desempenho
@@ -80,6 +113,28 @@ def ensure_indexes():
     try:
         with engine.connect() as conn:
             conn.execute(text("CREATE INDEX IF NOT EXISTS idx_usuarios_username ON usuarios(username)"))
+            # Filtros/paginação das listagens (cliente, data, status)
+            for ddl in (
+                "CREATE INDEX IF NOT EXISTS idx_despesas_cliente_id ON despesas(cliente_id)",
+                "CREATE INDEX IF NOT EXISTS idx_despesas_id_cliente ON despesas(id_cliente)",
+                "CREATE INDEX IF NOT EXISTS idx_despesas_data ON despesas(data, id)",
+                "CREATE INDEX IF NOT EXISTS idx_contratos_cliente_id ON contratos(cliente_id)",
+                "CREATE INDEX IF NOT EXISTS idx_contratos_data_inicio ON contratos(dataInicio, id)",
+                "CREATE INDEX IF NOT EXISTS idx_valor_materiais_cliente_id ON valor_materiais(cliente_id)",
+                "CREATE INDEX IF NOT EXISTS idx_orcamento_obra_cliente_id ON orcamento_obra(cliente_id)",
+                "CREATE INDEX IF NOT EXISTS idx_orcamento_obra_data ON orcamento_obra(data, id)",
+                "CREATE INDEX IF NOT EXISTS idx_resumo_mensal_cliente_id ON resumo_mensal(cliente_id)",
+                "CREATE INDEX IF NOT EXISTS idx_testes_loja_cliente_data ON testes_loja(cliente_id, data_teste)",
+                "CREATE INDEX IF NOT EXISTS idx_testes_loja_data ON testes_loja(data_teste, id)",
+                "CREATE INDEX IF NOT EXISTS idx_testes_ar_cliente_data ON testes_ar_condicionado(cliente_id, data_teste)",
+                "CREATE INDEX IF NOT EXISTS idx_testes_ar_data ON testes_ar_condicionado(data_teste, id)",
+                "CREATE INDEX IF NOT EXISTS idx_relatorios_obras_cliente_data ON relatorios_obras(cliente_id, data_relatorio)",
+                "CREATE INDEX IF NOT EXISTS idx_relatorios_obras_data ON relatorios_obras(data_relatorio, id)",
+            ):
+                try:
+                    conn.execute(text(ddl))
+                except Exception:
+                    pass
             # Adiciona coluna grupo_id se não existir (SQLite permite ADD COLUMN)
             try:
                 res = conn.execute(text("PRAGMA table_info(usuarios)"))
@@ -94,6 +149,137 @@ def ensure_indexes():
 
 ensure_indexes()
 
+# Blob store dos uploads: coluna sha256 + migração (uma vez) dos blobs legados para fora do SQLite
+def ensure_upload_blob_store():
+    try:
+        with engine.begin() as conn:
+            cols = [row[1] for row in conn.execute(text("PRAGMA table_info(arquivos_importados)")).fetchall()]
+            if cols and "sha256" not in cols:
+                conn.execute(text("ALTER TABLE arquivos_importados ADD COLUMN sha256 VARCHAR(64)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_arquivos_importados_sha256 ON arquivos_importados(sha256)"))
+        moved = blobstore.migrate_db_blobs(engine)
+        if moved:
+            logger.info(f"[BLOBS] {moved} uploads movidos do SQLite para {blobstore.BLOB_STORE_DIR}")
+    except Exception as e:
+        logger.warning(f"[BLOBS] Falha ao preparar blob store: {e}")
+
+ensure_upload_blob_store()
+
+# Itens dos relatórios de obras: tabelas filhas + migração (uma vez) das colunas JSON legadas
+RELATORIO_ITENS_TABELAS = (
+    ("mao_de_obra", RelatorioObrasMaoDeObra, "nome"),
+    ("equipamentos", RelatorioObrasEquipamento, "nome"),
+    ("atividades", RelatorioObrasAtividade, "descricao"),
+)
+RELATORIO_ITENS_MIGRATION_BATCH = int(os.getenv("RELATORIO_ITENS_MIGRATION_BATCH", "500"))
+
+def _parse_lista_json(raw) -> list[str]:
+    try:
+        data = json.loads(raw) if raw else []
+    except ValueError:
+        return []
+    if not isinstance(data, list):
+        return []
+    return [str(x) for x in data if x is not None]
+
+def migrate_relatorio_itens() -> int:
+    """Copia mao_de_obra/equipamentos/atividades (JSON) para as tabelas filhas.
+
+    Idempotente: processa só relatórios com alguma coluna legada preenchida; itens e a
+    limpeza das colunas (NULL) entram na mesma transação. Retorna relatórios migrados.
+    """
+    migrated = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT id, mao_de_obra, equipamentos, atividades FROM relatorios_obras "
+                    "WHERE mao_de_obra IS NOT NULL OR equipamentos IS NOT NULL OR atividades IS NOT NULL "
+                    "ORDER BY id LIMIT :n"
+                ),
+                {"n": RELATORIO_ITENS_MIGRATION_BATCH},
+            ).fetchall()
+            if not rows:
+                return migrated
+            for idx, (coluna, model, campo) in enumerate(RELATORIO_ITENS_TABELAS, start=1):
+                itens = [
+                    {"relatorio_id": row[0], "posicao": pos, campo: valor}
+                    for row in rows
+                    for pos, valor in enumerate(_parse_lista_json(row[idx]))
+                ]
+                if itens:
+                    conn.execute(model.__table__.insert(), itens)
+            conn.execute(
+                text(
+                    "UPDATE relatorios_obras SET mao_de_obra = NULL, equipamentos = NULL, atividades = NULL "
+                    "WHERE id IN (" + ",".join(str(int(row[0])) for row in rows) + ")"
+                )
+            )
+            migrated += len(rows)
+
+def ensure_relatorio_itens():
+    try:
+        # Banco restaurado pode ser anterior às tabelas filhas
+        Base.metadata.create_all(bind=engine, tables=[m.__table__ for _, m, _ in RELATORIO_ITENS_TABELAS])
+        migrated = migrate_relatorio_itens()
+        if migrated:
+            logger.info(f"[RELATORIOS] Itens de {migrated} relatórios de obras migrados para tabelas próprias")
+    except Exception as e:
+        logger.warning(f"[RELATORIOS] Falha ao migrar itens dos relatórios de obras: {e}")
+
+ensure_relatorio_itens()
+
+# Históricos do autocompletar: chave normalizada (minúsculas, sem acento) com índice único,
+# que torna o dedupe uma única instrução (INSERT ... ON CONFLICT DO NOTHING)
+HISTORICO_CHAVE_CAMPOS = {
+    MaoDeObraHistorico: ("nome", "cargo"),
+    EquipamentoHistorico: ("nome",),
+    AtividadeHistorico: ("descricao",),
+}
+
+def historico_chave(model, valores) -> str:
+    return "\x1f".join(autocomplete.normalize(valores.get(c)) for c in HISTORICO_CHAVE_CAMPOS[model])
+
+def ensure_historico_chaves():
+    """Preenche chave nas linhas antigas, remove duplicatas (fica o menor id) e cria o índice único."""
+    try:
+        with engine.begin() as conn:
+            for model, campos in HISTORICO_CHAVE_CAMPOS.items():
+                table = model.__tablename__
+                cols = [row[1] for row in conn.execute(text(f"PRAGMA table_info({table})")).fetchall()]
+                if "chave" not in cols:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN chave VARCHAR"))
+                rows = conn.execute(
+                    text(f"SELECT id, {', '.join(campos)} FROM {table} WHERE chave IS NULL")
+                ).mappings().fetchall()
+                if rows:
+                    # Sem o índice durante a atualização: a chave nova pode repetir uma existente
+                    conn.execute(text(f"DROP INDEX IF EXISTS ix_{table}_chave"))
+                    conn.execute(
+                        text(f"UPDATE {table} SET chave = :chave WHERE id = :id"),
+                        [{"id": r["id"], "chave": historico_chave(model, r)} for r in rows],
+                    )
+                    removed = conn.execute(
+                        text(f"DELETE FROM {table} WHERE id NOT IN (SELECT min(id) FROM {table} GROUP BY chave)")
+                    ).rowcount
+                    logger.info(f"[HISTORICO] {table}: {len(rows)} chaves preenchidas, {removed} duplicatas removidas")
+                conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ix_{table}_chave ON {table}(chave)"))
+    except Exception as e:
+        logger.warning(f"[HISTORICO] Falha ao preparar chaves dos históricos: {e}")
+
+ensure_historico_chaves()
+
+# Busca textual (FTS5, ver search_index.py): tabela + triggers; populada quando criada
+def ensure_search_index(force_rebuild: bool = False):
+    try:
+        indexed = search_index.ensure_search_index(engine, force_rebuild)
+        if indexed is not None:
+            logger.info(f"[BUSCA] Índice FTS5 construído com {indexed} registros")
+    except Exception as e:
+        logger.warning(f"[BUSCA] Falha ao preparar índice de busca: {e}")
+
+ensure_search_index()
+
 # Garante permissões padrão do sistema (IDs fixos usados no frontend)
 def ensure_system_permissions():
     DEFAULT_PERMISSIONS = [
@@ -475,7 +661,7 @@ class StatsResponse(BaseModel):
     error: str | None = None
 
 @app.get("/debug/stats", response_model=StatsResponse)
-def debug_stats(db: Session = Depends(get_db)):
+def debug_stats(db: Session = Depends(get_read_db)):
     error_message: str | None = None
     try:
         usuarios = db.query(Usuario).count()
@@ -524,7 +710,7 @@ def debug_db_reconnect():
     """
     try:
         # Descarta todas as conexões existentes
-        engine.dispose()
+        dispose_engines()
         
         # Tenta reconectar e validar
         with engine.connect() as conn:
@@ -611,6 +797,75 @@ allow_origin_regex = os.getenv(
     "ALLOW_ORIGIN_REGEX",
     r"https?://((localhost:(3000|3001|3005))|([a-z0-9-]+\.netlify\.app)|([a-z0-9-]+\.vercel\.app)|gestao-frontend[\w-]*\.onrender\.com)$",
 )
+# Limite de tamanho das mídias antes do corpo ser lido: o UploadFile só chega ao endpoint
+# depois que o Starlette recebeu e gravou o multipart inteiro em arquivo temporário, então
+# o corte por tamanho precisa ser feito aqui (Content-Length, ou contando os bytes quando o
+# corpo vem em chunks). Registrado antes do CORS para o 413 sair com os cabeçalhos de CORS.
+MEDIA_MULTIPART_OVERHEAD_BYTES = 64 * 1024  # boundaries, cabeçalhos das partes e campos do form
+_MEDIA_VIDEO_UPLOAD_PATH = re.compile(r"^/upload/testes-(loja|ar-condicionado)/video/[^/]+$")
+_MEDIA_FORM_PATH = re.compile(r"^/testes-(loja|ar-condicionado)/(\d+)?$")
+
+class _BodyTooLarge(Exception):
+    pass
+
+def _media_request_limit(method: str, path: str) -> int | None:
+    if method == "POST" and _MEDIA_VIDEO_UPLOAD_PATH.match(path):
+        return MEDIA_MAX_VIDEO_BYTES + MEDIA_MULTIPART_OVERHEAD_BYTES
+    if method in ("POST", "PUT") and MEDIA_MAX_REQUEST_BYTES and _MEDIA_FORM_PATH.match(path):
+        return MEDIA_MAX_REQUEST_BYTES
+    return None
+
+class MediaUploadLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = _media_request_limit(scope.get("method", ""), scope.get("path", "")) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        detail = f"O arquivo não pode exceder {limit // (1024 * 1024)}MB"
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+            return
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Para de ler; o erro de parse do endpoint é trocado pelo 413 abaixo
+                    exceeded = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def limited_send(message):
+            nonlocal started
+            if exceeded:
+                if message["type"] == "http.response.start" and not started:
+                    started = True
+                    await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except _BodyTooLarge:
+            if started:
+                raise
+            await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+
+app.add_middleware(MediaUploadLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allow_origins,
@@ -618,10 +873,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Cabeçalhos de paginação precisam ser expostos para o browser conseguir lê-los
+    expose_headers=["X-Total-Count", "X-Next-Cursor"],
 )
 
-# GZip para respostas mais leves
-app.add_middleware(GZipMiddleware, minimum_size=500)
+# GZip para respostas mais leves, exceto mídias/arquivos já comprimidos (JPEG/MP4/zip...):
+# recomprimir só gasta CPU e impede Range nos vídeos.
+NO_GZIP_PATH_PREFIXES = ("/uploads/testes-loja/", "/uploads/testes-ar-condicionado/")
+NO_GZIP_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp4", ".mov", ".m4v", ".webm", ".3gp",
+    ".zip", ".gz", ".xlsx", ".xls", ".pdf",
+}
+
+class SelectiveGZipMiddleware:
+    def __init__(self, app, minimum_size: int = 500):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            path = scope.get("path", "")
+            if path.startswith(NO_GZIP_PATH_PREFIXES) or os.path.splitext(path)[1].lower() in NO_GZIP_EXTENSIONS:
+                await self.app(scope, receive, send)
+                return
+        await self.gzip(scope, receive, send)
+
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=500)
 
 """Diretórios de dados graváveis
 
@@ -679,14 +956,108 @@ if SERVE_FRONTEND and FRONTEND_DIST_DIR and os.path.isdir(FRONTEND_DIST_DIR):
         # Se falhar por algum motivo (ex.: permissões), apenas segue com API
         pass
 
+# Mídias são gravadas com nome uuid4 e nunca reescritas (troca = arquivo novo), então a URL
+# é imutável: cache longo no navegador/CDN e ETag forte derivado do nome.
+MEDIA_CACHE_MAX_AGE = int(os.getenv("MEDIA_CACHE_MAX_AGE", str(365 * 24 * 3600)))
+_UUID_MEDIA_NAME = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(\.poster)?\.[A-Za-z0-9]+$")
+
+class MediaStaticFiles(StaticFiles):
+    """StaticFiles com Cache-Control imutável para arquivos uuid (Range/304 vêm do StaticFiles)."""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        name = os.path.basename(full_path)
+        if _UUID_MEDIA_NAME.match(name):
+            response.headers["Cache-Control"] = f"public, max-age={MEDIA_CACHE_MAX_AGE}, immutable"
+            response.headers["ETag"] = f'"{name}-{stat_result.st_size}"'
+            # O 304 do StaticFiles foi avaliado com o ETag padrão; reavaliar com o nosso
+            if response.status_code == 200 and self.is_not_modified(response.headers, Headers(scope=scope)):
+                return NotModifiedResponse(response.headers)
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
 # Configurar arquivos estáticos APENAS para subrotas de mídia (evita conflito com /uploads/{entidade})
-app.mount("/uploads/testes-loja", StaticFiles(directory=TESTES_LOJA_DIR), name="uploads_testes_loja")
+app.mount("/uploads/testes-loja", MediaStaticFiles(directory=TESTES_LOJA_DIR), name="uploads_testes_loja")
 app.mount(
     "/uploads/testes-ar-condicionado",
-    StaticFiles(directory=TESTES_AR_CONDICIONADO_DIR),
+    MediaStaticFiles(directory=TESTES_AR_CONDICIONADO_DIR),
     name="uploads_testes_ar",
 )
 
+# Jobs de importação assíncrona (um JSON de andamento por job, no mesmo esquema do progress.json do backup)
+IMPORT_JOBS_DIR = os.path.join(DATA_DIR, "import_jobs")
+os.makedirs(IMPORT_JOBS_DIR, exist_ok=True)
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "1"))  # SQLite aceita um escritor por vez
+IMPORT_JOB_TTL_SECONDS = int(os.getenv("IMPORT_JOB_TTL_SECONDS", str(24 * 3600)))
+_import_pool: ProcessPoolExecutor | None = None
+_import_pool_lock = threading.Lock()
+
+def _get_import_pool() -> ProcessPoolExecutor:
+    global _import_pool
+    with _import_pool_lock:
+        if _import_pool is None:
+            # spawn: não herdar conexões SQLite/threads do processo do servidor
+            _import_pool = ProcessPoolExecutor(max_workers=IMPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _import_pool
+
+def _shutdown_import_pool():
+    global _import_pool
+    with _import_pool_lock:
+        if _import_pool is not None:
+            _import_pool.shutdown(wait=False, cancel_futures=True)
+            _import_pool = None
+
+def _import_job_path(job_id: str) -> str:
+    return os.path.join(IMPORT_JOBS_DIR, f"{job_id}.json")
+
+def _prune_import_jobs():
+    # Remove arquivos de jobs antigos (já finalizados) para o diretório não crescer indefinidamente
+    cutoff = time.time() - IMPORT_JOB_TTL_SECONDS
+    try:
+        for fn in os.listdir(IMPORT_JOBS_DIR):
+            fp = os.path.join(IMPORT_JOBS_DIR, fn)
+            try:
+                if os.path.getmtime(fp) < cutoff:
+                    os.remove(fp)
+            except OSError:
+                continue
+    except OSError:
+        pass
+
+def _submit_import_job(upload_id: int, entidade: str, filename: str, username: str) -> dict:
+    _prune_import_jobs()
+    job_id = uuid.uuid4().hex
+    path = _import_job_path(job_id)
+    job = {
+        "id": job_id,
+        "status": "queued",
+        "entidade": entidade,
+        "upload_id": upload_id,
+        "filename": filename,
+        "username": username,
+        "processed": 0,
+        "total": None,
+        "records_imported": 0,
+        "errors": [],
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "started_at": None,
+        "finished_at": None,
+    }
+    importers.save_job(path, job)
+    future = _get_import_pool().submit(importers.run_import_job, path, upload_id, entidade, filename)
+
+    def _on_done(f):
+        # Falha do próprio pool (processo morto, pool encerrado): registrar no job
+        exc = f.exception() if not f.cancelled() else None
+        if f.cancelled() or exc is not None:
+            msg = "Job cancelado" if f.cancelled() else f"Falha no worker de importação: {exc}"
+            logger.error("[IMPORT JOB %s] %s", job_id, msg)
+            importers.update_job(path, status="error", errors=[msg], finished_at=datetime.datetime.now().isoformat(timespec="seconds"))
+
+    future.add_done_callback(_on_done)
+    return job
+
 # Diretório de backups
 BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.abspath(os.path.join(BACKEND_DIR, ".."))
@@ -710,6 +1081,9 @@ EXCLUDE_DIRS = {
     "backups",  # evita incluir os próprios backups
 }
 EXCLUDE_FILES_SUFFIX = {".pyc", ".pyo", ".log"}
+# "full" (zip completo a cada execução) ou "incremental" (manifesto + só arquivos alterados)
+BACKUP_MODE = os.getenv("BACKUP_MODE", "full").strip().lower()
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
 
 def load_backup_state():
     try:
@@ -748,7 +1122,47 @@ def list_backup_files():
     files.sort(key=lambda x: x["created"], reverse=True)
     return files
 
+# O banco vivo nunca é copiado como arquivo (pode estar no meio de uma escrita): os backups
+# recebem um snapshot online (snapshot_sqlite) sob este nome.
+def _db_rel_path() -> str | None:
+    if not DB_PATH:
+        return None
+    rel = os.path.relpath(os.path.abspath(DB_PATH), ROOT_DIR)
+    return None if rel.startswith("..") else rel
+
+def backup_db_arcname() -> str:
+    return _db_rel_path() or os.path.join("_data", os.path.basename(DB_PATH))
+
+# Conteúdo dos uploads de planilhas (blobstore) também fica fora do SQLite, em geral fora de
+# ROOT_DIR: entra nos backups como extra_files, com o mesmo critério de nome do banco.
+def _blob_store_rel_path() -> str | None:
+    rel = os.path.relpath(os.path.abspath(blobstore.BLOB_STORE_DIR), ROOT_DIR)
+    return None if rel.startswith("..") else rel
+
+def backup_blob_files() -> dict[str, str]:
+    """Nome no backup → arquivo, para cada blob do store (ex.: _data/blobs/<aa>/<bb>/<sha256>)."""
+    prefix = _blob_store_rel_path() or os.path.join("_data", "blobs")
+    files: dict[str, str] = {}
+    for root, _dirs, names in os.walk(blobstore.BLOB_STORE_DIR):
+        for fn in names:
+            if fn.startswith(".incoming-"):
+                continue  # upload em andamento
+            abs_fp = os.path.join(root, fn)
+            files[os.path.join(prefix, os.path.relpath(abs_fp, blobstore.BLOB_STORE_DIR))] = abs_fp
+    return files
+
+def make_db_snapshot_tmp() -> str:
+    fd, tmp = tempfile.mkstemp(prefix=".db-snapshot-", suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    return snapshot_sqlite(tmp)
+
 def should_exclude(rel_path: str) -> bool:
+    db_rel = _db_rel_path()
+    if db_rel and (rel_path == db_rel or rel_path.startswith(db_rel + "-")):
+        return True
+    blob_rel = _blob_store_rel_path()
+    if blob_rel and (rel_path == blob_rel or rel_path.startswith(blob_rel + os.sep)):
+        return True  # vai pelo backup_blob_files
     parts = Path(rel_path).parts
     for part in parts:
         if part in EXCLUDE_DIRS:
@@ -758,43 +1172,25 @@ def should_exclude(rel_path: str) -> bool:
             return True
     return False
 
-def make_backup_zip() -> str:
-    now = datetime.datetime.now()
-    stamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-    zip_name = f"backup_{stamp}.zip"
-    zip_path = os.path.join(BACKUP_DIR, zip_name)
-    inprogress = zip_path + ".inprogress"
-    # Evitar concorrência
-    if os.path.exists(inprogress):
-        raise HTTPException(status_code=409, detail="Backup já em andamento")
-    open(inprogress, "w").close()
-    try:
-        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
-            for root, dirs, files in os.walk(ROOT_DIR):
-                rel_root = os.path.relpath(root, ROOT_DIR)
-                if rel_root == ".":
-                    rel_root = ""
-                # Filtrar dirs in-place para acelerar
-                dirs[:] = [d for d in dirs if not should_exclude(os.path.join(rel_root, d))]
-                for fn in files:
-                    rel_fp = os.path.join(rel_root, fn)
-                    if should_exclude(rel_fp):
-                        continue
-                    abs_fp = os.path.join(ROOT_DIR, rel_fp)
-                    # Segurança: garantir que está dentro do ROOT_DIR
-                    if not os.path.abspath(abs_fp).startswith(ROOT_DIR):
-                        continue
-                    zf.write(abs_fp, arcname=rel_fp)
-        # Atualiza estado
-        state = load_backup_state()
-        state["last_backup_at"] = now
-        save_backup_state(state)
-        return zip_name
-    finally:
-        try:
-            os.remove(inprogress)
-        except OSError:
-            pass
+# O zip do backup completo é montado em um processo próprio (backup_zip.build_backup_zip),
+# com compressão por arquivo em várias threads; o event loop só aguarda o resultado.
+BACKUP_COMPRESS_WORKERS = int(os.getenv("BACKUP_COMPRESS_WORKERS", "0")) or (os.cpu_count() or 1)
+_backup_pool: ProcessPoolExecutor | None = None
+_backup_pool_lock = threading.Lock()
+
+def _get_backup_pool() -> ProcessPoolExecutor:
+    global _backup_pool
+    with _backup_pool_lock:
+        if _backup_pool is None:
+            _backup_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        return _backup_pool
+
+def _shutdown_backup_pool():
+    global _backup_pool
+    with _backup_pool_lock:
+        if _backup_pool is not None:
+            _backup_pool.shutdown(wait=False, cancel_futures=True)
+            _backup_pool = None
 
 def collect_backup_candidates() -> list[str]:
     candidates: list[str] = []
@@ -857,29 +1253,24 @@ async def backup_worker_async():
         raise HTTPException(status_code=409, detail="Backup já em andamento")
     open(inprogress, "w").close()
     canceled = False
+    snap = None
     try:
-        files = collect_backup_candidates()
-        total = len(files)
-        processed = 0
+        files = await asyncio.to_thread(collect_backup_candidates)
+        extra = await asyncio.to_thread(backup_blob_files)
+        total = len(files) + len(extra) + 1
         save_progress({"running": True, "percent": 0, "processed": 0, "total": total, "current": None, "file": zip_name, "canceled": False})
-        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
-            for rel_fp in files:
-                if is_canceled():
-                    canceled = True
-                    break
-                abs_fp = os.path.join(ROOT_DIR, rel_fp)
-                if not os.path.abspath(abs_fp).startswith(ROOT_DIR):
-                    continue
-                try:
-                    zf.write(abs_fp, arcname=rel_fp)
-                except Exception:
-                    # ignora arquivo com erro
-                    pass
-                processed += 1
-                if processed % 20 == 0 or processed == total:
-                    percent = 0 if total == 0 else round(processed * 100 / total, 2)
-                    save_progress({"running": True, "percent": percent, "processed": processed, "total": total, "current": rel_fp, "file": zip_name, "canceled": False})
-                    await asyncio.sleep(0)
+        if DB_PATH and os.path.exists(DB_PATH):
+            snap = await asyncio.to_thread(make_db_snapshot_tmp)
+            extra[backup_db_arcname()] = snap
+        summary = await asyncio.get_running_loop().run_in_executor(
+            _get_backup_pool(),
+            functools.partial(
+                backup_zip.build_backup_zip, ROOT_DIR, files, zip_path,
+                extra_files=extra,
+                progress_file=PROGRESS_FILE, cancel_file=CANCEL_FILE, workers=BACKUP_COMPRESS_WORKERS,
+            ),
+        )
+        canceled = summary is None
         if canceled:
             # remover zip parcial
             try:
@@ -892,8 +1283,13 @@ async def backup_worker_async():
             state = load_backup_state()
             state["last_backup_at"] = now
             save_backup_state(state)
-            rotate_backups(keep=7)
+            await asyncio.to_thread(rotate_backups, BACKUP_KEEP)
     finally:
+        if snap:
+            try:
+                os.remove(snap)
+            except OSError:
+                pass
         # Marca estado final (sucesso 100% ou cancelado com percent atual)
         try:
             p = load_progress() or {}
@@ -926,6 +1322,54 @@ async def backup_worker_async():
             pass
         clear_cancel()
 
+async def incremental_backup_worker_async():
+    """Backup incremental (ver incremental_backup.py) com o mesmo progress.json/cancel.flag de backup_worker_async."""
+    now = datetime.datetime.now()
+    canceled = False
+    summary = None
+    try:
+        files = await asyncio.to_thread(collect_backup_candidates)
+        extra = await asyncio.to_thread(backup_blob_files)
+        total = len(files) + len(extra) + 1
+        save_progress({"running": True, "percent": 0, "processed": 0, "total": total, "current": None, "file": None, "canceled": False})
+
+        def _progress(processed: int, total: int, current: str | None):
+            percent = 0 if total == 0 else round(processed * 100 / total, 2)
+            save_progress({"running": True, "percent": percent, "processed": processed, "total": total, "current": current, "file": None, "canceled": False})
+
+        snap = await asyncio.to_thread(make_db_snapshot_tmp) if DB_PATH and os.path.exists(DB_PATH) else None
+        if snap:
+            extra[backup_db_arcname()] = snap
+        try:
+            summary = await asyncio.to_thread(
+                incremental_backup.run_incremental_backup, ROOT_DIR, files, BACKUP_DIR, _progress, is_canceled, extra_files=extra
+            )
+        finally:
+            if snap:
+                os.remove(snap)
+        canceled = summary is None
+        if not canceled:
+            state = load_backup_state()
+            state["last_backup_at"] = now
+            save_backup_state(state)
+            pruned = await asyncio.to_thread(incremental_backup.prune, BACKUP_DIR, BACKUP_KEEP)
+            if pruned["unreadable"]:
+                logger.warning(f"[BACKUP] Manifestos ilegíveis {pruned['unreadable']}; nenhum archive removido")
+    finally:
+        p = load_progress() or {}
+        total = int(p.get("total") or 0)
+        save_progress({
+            "running": False,
+            "percent": float(p.get("percent") or 0) if canceled else 100.0,
+            "processed": int(p.get("processed") or 0) if canceled else total,
+            "total": total,
+            "current": None,
+            "file": summary["manifest"] if summary else None,
+            "canceled": canceled,
+        })
+        clear_cancel()
+    return summary
+
 def rotate_backups(keep: int = 7):
     files = list_backup_files()
     if len(files) <= keep:
@@ -946,18 +1390,129 @@ async def schedule_backup_task():
         wait_seconds = (target - now).total_seconds()
         try:
             await asyncio.sleep(wait_seconds)
-            make_backup_zip()
-            rotate_backups(keep=7)
+            if BACKUP_MODE == "incremental":
+                await incremental_backup_worker_async()
+            else:
+                await backup_worker_async()
         except Exception:
             # Não interromper o laço por erro
             await asyncio.sleep(5)
 
+# ================= GC de mídias =================
+# Mark: nomes referenciados em testes_loja/testes_ar_condicionado (foto/video); sweep: arquivos
+# dos diretórios de upload sem referência. Órfãos só são apagados após o período de carência.
+MEDIA_GC_GRACE_HOURS = float(os.getenv("MEDIA_GC_GRACE_HOURS", "72"))
+MEDIA_GC_INTERVAL_HOURS = float(os.getenv("MEDIA_GC_INTERVAL_HOURS", "24"))  # 0 desativa o job periódico
+# Trava de segurança: banco vazio/antigo (reset, restore de backup velho) faz tudo parecer
+# órfão. A remoção é recusada se o diretório tem arquivos e nenhum é referenciado, ou se
+# os órfãos passam desta fração dos arquivos (force=True no POST ignora a trava).
+MEDIA_GC_MAX_DELETE_RATIO = float(os.getenv("MEDIA_GC_MAX_DELETE_RATIO", "0.5"))
+# Após restore/reset/recreate a próxima execução periódica é pulada
+_media_gc_skip_next = False
+
+def skip_next_media_gc(motivo: str) -> None:
+    global _media_gc_skip_next
+    _media_gc_skip_next = True
+    logger.info(f"[MEDIA GC] Próxima execução periódica será pulada ({motivo})")
+
+def _media_gc_refusal(sweep: dict, referenced: set[str], media_dir: str) -> str | None:
+    try:
+        files = [e.name for e in os.scandir(media_dir) if e.is_file() and not e.name.startswith(".")]
+    except OSError:
+        return None
+    if not files:
+        return None
+    if not referenced:
+        return f"nenhuma referência no banco para {len(files)} arquivos"
+    orphans = [o for o in sweep["orphans"] if "/" not in o and not o.startswith(".")]
+    ratio = len(orphans) / len(files)
+    if ratio > MEDIA_GC_MAX_DELETE_RATIO:
+        return f"{len(orphans)} de {len(files)} arquivos órfãos ({ratio:.0%} > MEDIA_GC_MAX_DELETE_RATIO {MEDIA_GC_MAX_DELETE_RATIO:.0%})"
+    return None
+
+def collect_media_garbage(db: Session, dry_run: bool = True, grace_hours: float | None = None, force: bool = False) -> dict:
+    grace_seconds = int((MEDIA_GC_GRACE_HOURS if grace_hours is None else grace_hours) * 3600)
+    report = {"dry_run": dry_run, "grace_hours": grace_seconds / 3600, "dirs": {}, "missing": []}
+    for model, media_dir, tabela in (
+        (TesteLoja, TESTES_LOJA_DIR, "testes_loja"),
+        (TesteArCondicionado, TESTES_AR_CONDICIONADO_DIR, "testes_ar_condicionado"),
+    ):
+        referenced: set[str] = set()
+        refs: list[tuple[int, str, str]] = []
+        rows = db.query(model.id, model.foto, model.video).filter(or_(model.foto.isnot(None), model.video.isnot(None))).all()
+        for row_id, foto, video in rows:
+            for campo, nome in (("foto", foto), ("video", video)):
+                if nome:
+                    referenced.add(nome)
+                    refs.append((row_id, campo, nome))
+        # Sempre avalia primeiro sem apagar; só remove se a trava de segurança permitir
+        sweep = media.sweep_orphans(media_dir, referenced, grace_seconds, dry_run=True)
+        refused = _media_gc_refusal(sweep, referenced, media_dir)
+        if not dry_run:
+            if refused and not force:
+                logger.warning(f"[MEDIA GC] {tabela}: remoção recusada: {refused}")
+            else:
+                sweep = media.sweep_orphans(media_dir, referenced, grace_seconds, dry_run=False)
+        sweep["refused"] = refused
+        # Referências cujo arquivo não existe mais (inverso de restore_missing_uploads.py)
+        try:
+            present = set(os.listdir(media_dir))
+        except OSError:
+            present = set()
+        for row_id, campo, nome in refs:
+            if nome not in present:
+                report["missing"].append({"tabela": tabela, "id": row_id, "campo": campo, "arquivo": nome})
+        sweep["referenced"] = len(referenced)
+        report["dirs"][tabela] = sweep
+    report["bytes_freed"] = sum(d["bytes_freed"] for d in report["dirs"].values())
+    return report
+
+def _run_media_gc_once() -> dict | None:
+    global _media_gc_skip_next
+    if _media_gc_skip_next:
+        _media_gc_skip_next = False
+        logger.warning("[MEDIA GC] Execução pulada: banco restaurado/resetado desde a última execução")
+        return None
+    db = SessionLocal()
+    try:
+        report = collect_media_garbage(db, dry_run=False)
+    finally:
+        db.close()
+    deleted = sum(len(d["deleted"]) for d in report["dirs"].values())
+    if deleted or report["missing"]:
+        logger.info(f"[MEDIA GC] {deleted} órfãos removidos ({report['bytes_freed']} bytes); {len(report['missing'])} referências sem arquivo")
+    return report
+
+async def schedule_media_gc_task():
+    while True:
+        await asyncio.sleep(MEDIA_GC_INTERVAL_HOURS * 3600)
+        try:
+            await asyncio.to_thread(_run_media_gc_once)
+        except Exception as e:
+            # Não interromper o laço por erro
+            logger.warning(f"[MEDIA GC] Falha: {e}")
+
+@app.on_event("shutdown")
+async def _shutdown_import_jobs():
+    _shutdown_import_pool()
+    _shutdown_backup_pool()
+    _media_executor.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("startup")
+async def _startup_media_backfill():
+    # Gera em background os derivados de mídias enviadas antes do pipeline existir
+    for media_dir in (TESTES_LOJA_DIR, TESTES_AR_CONDICIONADO_DIR):
+        for fn in media.missing_derivatives(media_dir):
+            _schedule_media_derivatives(media_dir, fn)
+
 @app.on_event("startup")
 async def _startup_schedule():
     # Evitar múltiplas tarefas em reload: usar um flag global
     if not getattr(app.state, "_backup_task_started", False):
         app.state._backup_task_started = True
         asyncio.create_task(schedule_backup_task())
+        if MEDIA_GC_INTERVAL_HOURS > 0:
+            asyncio.create_task(schedule_media_gc_task())
 
 # Configurações de Segurança
 SECRET_KEY = os.getenv("SECRET_KEY", "secret-key-thors-gestor-2025")
@@ -1007,6 +1562,66 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# --- Cache de usuário autenticado ---
+# Evita 2–3 consultas ao SQLite por request (usuário + permissões do grupo + clientes do grupo).
+# O cache é por processo e indexado pelo "sub" do token; entradas expiram após
+# AUTH_CACHE_TTL_SECONDS e são invalidadas quando usuários/grupos são alterados.
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+
+@dataclass(frozen=True)
+class CachedUser:
+    """Snapshot imutável do usuário autenticado (não é ligado a nenhuma Session)."""
+    id: int
+    username: str
+    nome: str
+    email: Optional[str]
+    nivel_acesso: str
+    ativo: bool
+    grupo_id: Optional[int]
+
+_auth_cache: dict[str, tuple[float, CachedUser]] = {}
+_auth_cache_lock = threading.Lock()
+
+def _auth_cache_get(username: str) -> Optional[CachedUser]:
+    with _auth_cache_lock:
+        hit = _auth_cache.get(username)
+        if hit is None:
+            return None
+        expires_at, cached = hit
+        if expires_at < time.monotonic():
+            _auth_cache.pop(username, None)
+            return None
+        return cached
+
+def _auth_cache_put(cached: CachedUser):
+    if AUTH_CACHE_TTL_SECONDS <= 0:
+        return
+    with _auth_cache_lock:
+        _auth_cache[cached.username] = (time.monotonic() + AUTH_CACHE_TTL_SECONDS, cached)
+
+def invalidate_auth_cache(username: Optional[str] = None):
+    """Invalida o cache de autenticação (um usuário ou, sem argumento, todos).
+
+    Permissões e clientes do grupo não ficam aqui: vêm da matriz de permissões por grupo
+    (_permission_matrix), atualizada pelos endpoints de grupos.
+    """
+    with _auth_cache_lock:
+        if username is None:
+            _auth_cache.clear()
+        else:
+            _auth_cache.pop(username, None)
+
+def _build_cached_user(user: Usuario) -> CachedUser:
+    return CachedUser(
+        id=user.id,
+        username=user.username,
+        nome=user.nome,
+        email=user.email,
+        nivel_acesso=user.nivel_acesso,
+        ativo=bool(user.ativo),
+        grupo_id=user.grupo_id,
+    )
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1021,10 +1636,15 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception
     
+    cached = _auth_cache_get(username)
+    if cached is not None:
+        return cached
     user = db.query(Usuario).filter(Usuario.username == username).first()
     if user is None:
         raise credentials_exception
-    return user
+    cached = _build_cached_user(user)
+    _auth_cache_put(cached)
+    return cached
 
 def require_admin(current_user: Usuario = Depends(get_current_user)):
     if current_user.nivel_acesso != "Admin":
@@ -1075,6 +1695,92 @@ def _format_cpf_cnpj_display(raw: str | None) -> str | None:
         return f"{digits[0:2]}.{digits[2:5]}.{digits[5:8]}/{digits[8:12]}-{digits[12:14]}"
     return raw
 
+# --- Matriz de permissões por grupo ---
+# Cada grupo vira um bitmap (int) sobre os IDs de PermissaoSistema (1001..19xx) e um
+# frozenset de cliente_ids. A checagem de permissão passa a ser um teste de bit em memória.
+# A matriz é carregada de uma vez (2 consultas) no primeiro uso, atualizada por grupo em
+# create/update/delete_grupo e recarregada por completo após PERMISSION_MATRIX_TTL_SECONDS
+# (cobre alterações feitas por outro processo/worker).
+PERMISSION_MATRIX_TTL_SECONDS = float(os.getenv("PERMISSION_MATRIX_TTL_SECONDS", "300"))
+
+class PermissionMatrix:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_at: float | None = None
+        self._bit_index: dict[int, int] = {}
+        self._masks: dict[int, int] = {}
+        self._clients: dict[int, frozenset] = {}
+
+    def _bit(self, perm_id: int) -> int:
+        bit = self._bit_index.get(perm_id)
+        if bit is None:
+            # Permissão criada depois da carga: ganha a próxima posição livre
+            bit = len(self._bit_index)
+            self._bit_index[perm_id] = bit
+        return bit
+
+    def _mask_for(self, perm_ids) -> int:
+        mask = 0
+        for pid in perm_ids:
+            mask |= 1 << self._bit(pid)
+        return mask
+
+    def _ensure_loaded(self, db: Session):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < PERMISSION_MATRIX_TTL_SECONDS:
+            return
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < PERMISSION_MATRIX_TTL_SECONDS:
+                return
+            self._bit_index = {pid: i for i, (pid,) in enumerate(db.query(PermissaoSistema.id).order_by(PermissaoSistema.id).all())}
+            perms: dict[int, list[int]] = {}
+            for grupo_id, permissao_id in db.query(PermissaoGrupo.grupo_id, PermissaoGrupo.permissao_id).all():
+                perms.setdefault(grupo_id, []).append(permissao_id)
+            clients: dict[int, list[int]] = {}
+            for grupo_id, cliente_id in db.query(ClienteGrupo.grupo_id, ClienteGrupo.cliente_id).all():
+                clients.setdefault(grupo_id, []).append(cliente_id)
+            self._masks = {gid: self._mask_for(ids) for gid, ids in perms.items()}
+            self._clients = {gid: frozenset(ids) for gid, ids in clients.items()}
+            self._loaded_at = time.monotonic()
+
+    def refresh_group(self, db: Session, grupo_id: int):
+        """Recalcula apenas o grupo informado (após create/update_grupo)."""
+        if self._loaded_at is None:
+            return  # ainda não carregada; a primeira consulta fará a carga completa
+        perm_ids = [pid for (pid,) in db.query(PermissaoGrupo.permissao_id).filter(PermissaoGrupo.grupo_id == grupo_id).all()]
+        client_ids = [cid for (cid,) in db.query(ClienteGrupo.cliente_id).filter(ClienteGrupo.grupo_id == grupo_id).all()]
+        with self._lock:
+            self._masks[grupo_id] = self._mask_for(perm_ids)
+            self._clients[grupo_id] = frozenset(client_ids)
+
+    def drop_group(self, grupo_id: int):
+        with self._lock:
+            self._masks.pop(grupo_id, None)
+            self._clients.pop(grupo_id, None)
+
+    def reset(self):
+        with self._lock:
+            self._loaded_at = None
+            self._masks = {}
+            self._clients = {}
+
+    def has(self, db: Session, grupo_id: int, perm_id: int) -> bool:
+        self._ensure_loaded(db)
+        bit = self._bit_index.get(perm_id)
+        if bit is None:
+            return False
+        return bool((self._masks.get(grupo_id, 0) >> bit) & 1)
+
+    def permission_ids(self, db: Session, grupo_id: int) -> set[int]:
+        self._ensure_loaded(db)
+        mask = self._masks.get(grupo_id, 0)
+        return {pid for pid, bit in self._bit_index.items() if (mask >> bit) & 1}
+
+    def client_ids(self, db: Session, grupo_id: int) -> frozenset:
+        self._ensure_loaded(db)
+        return self._clients.get(grupo_id, frozenset())
+
+_permission_matrix = PermissionMatrix()
+
 def _collect_permission_ids_for_user(db: Session, user: Usuario) -> set[int]:
     # Admin e Willians têm acesso total
     if str(user.nivel_acesso or '').lower() in {"admin", "willians"}:
@@ -1082,25 +1788,20 @@ def _collect_permission_ids_for_user(db: Session, user: Usuario) -> set[int]:
         return set()
     if not user.grupo_id:
         return set()
-    # Buscar permissões do grupo
-    links = db.query(PermissaoGrupo).filter(PermissaoGrupo.grupo_id == user.grupo_id).all()
-    return {lk.permissao_id for lk in links}
+    return _permission_matrix.permission_ids(db, user.grupo_id)
 
 def _permission_required(base_id: int, action: str):
     def dependency(current_user: Usuario = Depends(get_current_user), db: Session = Depends(get_db)):
         # Admin e Willians sempre passam
         if str(current_user.nivel_acesso or '').lower() in {"admin", "willians"}:
             return current_user
-        ids = _collect_permission_ids_for_user(db, current_user)
-        # Sempre aceitar se tiver a base (leitura) para qualquer ação de leitura; para outras, exigir o id específico
-        offset = ACTION_OFFSETS.get(action, 0)
-        required = base_id + offset
-        # A permissão base (xx01) concede leitura
-        if action == "read":
-            if (base_id in ids) or (required in ids):
+        if current_user.grupo_id:
+            offset = ACTION_OFFSETS.get(action, 0)
+            required = base_id + offset
+            # Para outras ações exige o id específico; a permissão base (xx01) concede leitura
+            if _permission_matrix.has(db, current_user.grupo_id, required):
                 return current_user
-        else:
-            if (required in ids):
+            if action == "read" and _permission_matrix.has(db, current_user.grupo_id, base_id):
                 return current_user
         raise HTTPException(status_code=403, detail="Permissão negada: ação não autorizada")
     return dependency
@@ -1220,6 +1921,8 @@ class UploadResult(BaseModel):
     filename: str
     entidade: str
     records_imported: int = 0
+    # Erros por linha ("Linha N: ...") de linhas ignoradas na importação
+    errors: List[str] = []
 
 class TesteLojaSchema(BaseModel):
     id: int | None = None
@@ -1233,6 +1936,17 @@ class TesteLojaSchema(BaseModel):
     criado_em: Optional[datetime.datetime] = None
     model_config = ConfigDict(from_attributes=True)
 
+    # Derivados leves para listagens (null enquanto não gerados; usar o original)
+    @computed_field
+    @property
+    def foto_thumb_url(self) -> str | None:
+        return media.derivative_url(TESTES_LOJA_DIR, "/uploads/testes-loja", self.foto, "thumb")
+
+    @computed_field
+    @property
+    def video_poster_url(self) -> str | None:
+        return media.derivative_url(TESTES_LOJA_DIR, "/uploads/testes-loja", self.video, "poster")
+
 class TesteLojaCreateSchema(BaseModel):
     data_teste: datetime.date
     cliente_id: int
@@ -1252,6 +1966,17 @@ class TesteArCondicionadoSchema(BaseModel):
     criado_em: Optional[datetime.datetime] = None
     model_config = ConfigDict(from_attributes=True)
 
+    # Derivados leves para listagens (null enquanto não gerados; usar o original)
+    @computed_field
+    @property
+    def foto_thumb_url(self) -> str | None:
+        return media.derivative_url(TESTES_AR_CONDICIONADO_DIR, "/uploads/testes-ar-condicionado", self.foto, "thumb")
+
+    @computed_field
+    @property
+    def video_poster_url(self) -> str | None:
+        return media.derivative_url(TESTES_AR_CONDICIONADO_DIR, "/uploads/testes-ar-condicionado", self.video, "poster")
+
 class TesteArCondicionadoCreateSchema(BaseModel):
     data_teste: datetime.date
     cliente_id: int
@@ -1298,6 +2023,31 @@ class RelatorioObrasSchema(BaseModel):
     
     model_config = ConfigDict(from_attributes=True)
 
+class RelatorioObrasResumoSchema(BaseModel):
+    id: int
+    cliente_id: int
+    cliente_nome: Optional[str] = None
+    data_relatorio: datetime.datetime
+    tempo: Optional[str] = None
+    condicao: Optional[str] = None
+    indice_pluviometrico: Optional[float] = None
+    qtd_mao_de_obra: int = 0
+    qtd_equipamentos: int = 0
+    qtd_atividades: int = 0
+    criado_em: Optional[datetime.datetime] = None
+    criado_por: Optional[int] = None
+    # Só preenchidos com ?expand= (o detalhe completo fica em GET /relatorios-obras/{id})
+    mao_de_obra: Optional[List[str]] = None
+    equipamentos: Optional[List[str]] = None
+    atividades: Optional[List[str]] = None
+
+class RelatorioObrasUsoMensalSchema(BaseModel):
+    cliente_id: int
+    mes: str
+    item: str
+    relatorios: int
+    ocorrencias: int
+
 # Schemas para históricos (autocompletar)
 
 class MaoDeObraHistoricoCreate(BaseModel):
@@ -1345,6 +2095,16 @@ class AtividadeHistoricoSchema(BaseModel):
     
     model_config = ConfigDict(from_attributes=True)
 
+class HistoricoLoteCreate(BaseModel):
+    mao_de_obra: List[MaoDeObraHistoricoCreate] = []
+    equipamentos: List[EquipamentoHistoricoCreate] = []
+    atividades: List[AtividadeHistoricoCreate] = []
+
+class HistoricoLoteSchema(BaseModel):
+    mao_de_obra: List[MaoDeObraHistoricoSchema]
+    equipamentos: List[EquipamentoHistoricoSchema]
+    atividades: List[AtividadeHistoricoSchema]
+
 class CondicaoClimaticaHistoricoCreate(BaseModel):
     data_registro: Optional[datetime.datetime] = None
     horario_dia: Optional[str] = None  # 'manha', 'tarde', 'noite'
@@ -1407,16 +2167,56 @@ def backup_status(current_user: Usuario = Depends(require_admin)):
     )
 
 @app.post("/backup/run")
-def run_backup(background_tasks: BackgroundTasks, current_user: Usuario = Depends(require_admin)):
+def run_backup(
+    background_tasks: BackgroundTasks,
+    mode: str | None = Query(None, pattern="^(full|incremental)$", description="Padrão: BACKUP_MODE"),
+    current_user: Usuario = Depends(require_admin),
+):
     # dispara tarefa em background com progresso
     # se já houver progresso em andamento, retornar 409
     progress = load_progress()
     if progress and progress.get("running"):
         raise HTTPException(status_code=409, detail="Backup em andamento")
     # iniciar tarefa
-    background_tasks.add_task(backup_worker_async)
+    if (mode or BACKUP_MODE) == "incremental":
+        background_tasks.add_task(incremental_backup_worker_async)
+    else:
+        background_tasks.add_task(backup_worker_async)
     return {"message": "Backup iniciado"}
 
+@app.get("/backup/incremental")
+def list_incremental_backups(current_user: Usuario = Depends(require_admin)):
+    """Pontos de restauração incrementais (mais recente primeiro)."""
+    items = []
+    for name in incremental_backup.list_manifests(BACKUP_DIR):
+        try:
+            m = incremental_backup.load_manifest(BACKUP_DIR, name)
+        except (OSError, ValueError):
+            continue
+        items.append({k: m.get(k) for k in ("manifest", "created_at", "archive", "file_count", "new_files", "new_bytes", "reused_files", "base")})
+    return items
+
+@app.get("/backup/incremental/{manifest}/download")
+def download_incremental_backup(manifest: str, current_user: Usuario = Depends(require_admin)):
+    """Remonta o ponto no tempo de um manifesto num zip completo (mesmo formato do backup completo)."""
+    safe_name = os.path.basename(manifest)
+    if safe_name not in incremental_backup.list_manifests(BACKUP_DIR):
+        raise HTTPException(status_code=404, detail="Manifesto não encontrado")
+    fd, tmp_zip = tempfile.mkstemp(prefix=".restore-", suffix=".zip", dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        incremental_backup.restore_to_zip(BACKUP_DIR, safe_name, tmp_zip)
+    except Exception as e:
+        os.remove(tmp_zip)
+        raise HTTPException(status_code=500, detail=f"Falha ao remontar backup: {e}")
+    zip_name = safe_name.replace("manifest_", "backup_").replace(".json", ".zip")
+    return FileResponse(
+        tmp_zip,
+        media_type="application/zip",
+        filename=zip_name,
+        background=StarletteBackgroundTask(os.remove, tmp_zip),
+    )
+
 @app.get("/backup/list")
 def list_backups(current_user: Usuario = Depends(require_admin)):
     return list_backup_files()
@@ -1504,6 +2304,7 @@ def _format_cpf_cnpj_display(raw: str | None) -> str | None:
 # ================= Backup SQLite =================
 @app.get("/admin/backup/sqlite", summary="Download do arquivo SQLite atual")
 def admin_backup_sqlite(current_user: Usuario = Depends(get_current_user)):
+    """Snapshot só do banco: o conteúdo dos uploads de planilhas fica no blob store (ver /admin/download/sqlite)."""
     if str(current_user.nivel_acesso or '').lower() not in {"admin", "willians"}:
         raise HTTPException(status_code=403, detail="Apenas admin pode gerar backup")
     try:
@@ -1512,12 +2313,11 @@ def admin_backup_sqlite(current_user: Usuario = Depends(get_current_user)):
         DB_PATH = None
     if not DB_PATH or not os.path.exists(DB_PATH):
         raise HTTPException(status_code=500, detail="DB_PATH indisponível")
-    with open(DB_PATH, 'rb') as f:
-        data = f.read()
+    snap = make_db_snapshot_tmp()
     filename = os.path.basename(DB_PATH)
-    return StreamingResponse(io.BytesIO(data), media_type='application/octet-stream', headers={
+    return FileResponse(snap, media_type='application/octet-stream', headers={
         'Content-Disposition': f'attachment; filename="' + filename + '"'
-    })
+    }, background=StarletteBackgroundTask(os.remove, snap))
 
 @app.post("/admin/backup/sqlite/restore", summary="Restaura DB a partir de arquivo upload (admin only)")
 def admin_restore_sqlite(
@@ -1568,13 +2368,20 @@ def admin_restore_sqlite(
             os.makedirs(backup_dir, exist_ok=True)
             backup_filename = f"gestao_obras_pre_restore_{timestamp}.db"
             backup_path = os.path.join(backup_dir, backup_filename)
-            shutil.copy2(DB_PATH, backup_path)
+            snapshot_sqlite(backup_path)
         except Exception as e:
             # Se falhar backup, aborta restore
             raise HTTPException(status_code=500, detail=f"Falha ao gerar backup: {e}")
     
-    # Substitui DB
+    # Substitui DB (fecha conexões e descarta WAL antigo antes, senão ele seria
+    # reaplicado sobre o arquivo novo)
     try:
+        dispose_engines()
+        remove_sqlite_sidecars(DB_PATH)
+        invalidate_auth_cache()
+        _permission_matrix.reset()
+        _reset_autocomplete()
+        skip_next_media_gc("restore do banco")
         with open(DB_PATH, 'wb') as f:
             f.write(content)
     except Exception as e:
@@ -1588,7 +2395,7 @@ def admin_restore_sqlite(
     for attempt in range(max_attempts):
         try:
             # Descarta pool de conexões
-            engine.dispose()
+            dispose_engines()
             
             # Aguarda um pouco entre tentativas (exceto na primeira)
             if attempt > 0:
@@ -1599,6 +2406,12 @@ def admin_restore_sqlite(
             with engine.connect() as conn:
                 conn.execute(text("SELECT 1"))
                 
+            # Banco restaurado pode ser anterior ao blob store / itens dos relatórios
+            ensure_upload_blob_store()
+            ensure_relatorio_itens()
+            ensure_historico_chaves()
+            ensure_search_index()
+
             # Tenta query real para validar estrutura
             db_test = SessionLocal()
             try:
@@ -1630,8 +2443,9 @@ def admin_restore_sqlite(
     logger.exception("Falha em todas as tentativas de validar restore")
     if backup_path and os.path.exists(backup_path):
         try:
+            dispose_engines()
+            remove_sqlite_sidecars(DB_PATH)
             shutil.copy2(backup_path, DB_PATH)
-            engine.dispose()
             logger.info("Backup anterior restaurado devido a falha de validação")
         except Exception as rollback_exc:
             logger.exception("Falha ao restaurar backup após erro no restore: %s", rollback_exc)
@@ -1702,7 +2516,7 @@ def admin_db_reset(current_user: Usuario = Depends(get_current_user)):
             os.makedirs(backup_dir, exist_ok=True)
             backup_filename = f"gestao_obras_pre_reset_{timestamp}.db"
             backup_path = os.path.join(backup_dir, backup_filename)
-            shutil.copy2(DB_PATH, backup_path)
+            snapshot_sqlite(backup_path)
             logger.info(f"Backup criado: {backup_path}")
         except Exception as e:
             logger.exception("Falha ao criar backup antes do reset")
@@ -1710,7 +2524,11 @@ def admin_db_reset(current_user: Usuario = Depends(get_current_user)):
     
     # 2. Fechar todas as conexões existentes
     try:
-        engine.dispose()
+        dispose_engines()
+        invalidate_auth_cache()
+        _permission_matrix.reset()
+        _reset_autocomplete()
+        skip_next_media_gc("reset do banco")
         logger.info("Conexões descartadas")
     except Exception as e:
         logger.warning(f"Erro ao descartar conexões: {e}")
@@ -1720,6 +2538,7 @@ def admin_db_reset(current_user: Usuario = Depends(get_current_user)):
         if os.path.exists(DB_PATH):
             os.remove(DB_PATH)
             logger.info(f"Banco deletado: {DB_PATH}")
+        remove_sqlite_sidecars(DB_PATH)
     except Exception as e:
         logger.exception("Falha ao deletar banco antigo")
         raise HTTPException(status_code=500, detail=f"Falha ao deletar banco: {e}")
@@ -1749,12 +2568,17 @@ def admin_db_reset(current_user: Usuario = Depends(get_current_user)):
     max_attempts = 5
     for attempt in range(max_attempts):
         try:
-            engine.dispose()
+            dispose_engines()
             
             if attempt > 0:
                 import time
                 time.sleep(0.3)
             
+            # Seed pode ser anterior às tabelas de itens dos relatórios / busca
+            ensure_relatorio_itens()
+            ensure_historico_chaves()
+            ensure_search_index()
+
             # Validar com queries reais
             db_test = SessionLocal()
             try:
@@ -1863,7 +2687,7 @@ def admin_recreate_tables(current_user: Usuario = Depends(get_current_user)):
                 backup_dir = os.path.join(os.path.dirname(DB_PATH), "..", "backups")
                 os.makedirs(backup_dir, exist_ok=True)
                 backup_path = os.path.join(backup_dir, f"gestao_obras_pre_recreate_{timestamp}.db")
-                shutil.copy2(DB_PATH, backup_path)
+                snapshot_sqlite(backup_path)
                 logger.info(f"Backup criado: {backup_path}")
         except Exception as e:
             logger.warning(f"Falha ao criar backup: {e}")
@@ -1875,9 +2699,15 @@ def admin_recreate_tables(current_user: Usuario = Depends(get_current_user)):
         # Recria com schema atual
         Base.metadata.create_all(bind=engine)
         logger.info("Todas as tabelas foram recriadas com schema atual")
+        # Triggers da busca caem junto com as tabelas; o FTS fica com linhas antigas
+        ensure_search_index(force_rebuild=True)
         
         # Força reconexão
-        engine.dispose()
+        dispose_engines()
+        invalidate_auth_cache()
+        _permission_matrix.reset()
+        _reset_autocomplete()
+        skip_next_media_gc("recriação das tabelas")
         
         # Recria usuários padrão
         ensure_admin_user()
@@ -1924,7 +2754,7 @@ def admin_migrate_add_cliente_id(current_user: Usuario = Depends(get_current_use
             conn.commit()
             
             # Força reconexão
-            engine.dispose()
+            dispose_engines()
             
             return {
                 "status": "ok",
@@ -2036,16 +2866,196 @@ def _get_allowed_client_ids(db: Session, user: Usuario) -> Optional[List[int]]:
         return None  # acesso total
     if not user.grupo_id:
         return None  # sem grupo específico => não filtra
-    links = db.query(ClienteGrupo).filter(ClienteGrupo.grupo_id == user.grupo_id).all()
-    ids = [lk.cliente_id for lk in links]
-    return ids
+    return list(_permission_matrix.client_ids(db, user.grupo_id))
+
+# --- Paginação / filtros compartilhados das listagens ---
+# Compatível com o frontend atual: sem `limit`/`cursor` a listagem continua retornando tudo.
+# Com `limit`, a paginação é por keyset (id ou coluna de data + id) e o próximo cursor vem
+# no cabeçalho X-Next-Cursor. X-Total-Count só é calculado com include_total=true.
+PAGINATION_DEFAULT_LIMIT = int(os.getenv("PAGINATION_DEFAULT_LIMIT", "100"))
+PAGINATION_MAX_LIMIT = int(os.getenv("PAGINATION_MAX_LIMIT", "500"))
+
+@dataclass
+class ListParams:
+    limit: Optional[int]
+    cursor: Optional[str]
+    order: str
+    sort: str
+    cliente_id: Optional[int]
+    data_inicio: Optional[datetime.date]
+    data_fim: Optional[datetime.date]
+    status: Optional[str]
+    include_total: bool
+    format: str = "json"
+
+def list_params(
+    limit: Optional[int] = Query(None, ge=1, description=f"Tamanho da página (máx. {PAGINATION_MAX_LIMIT})"),
+    cursor: Optional[str] = Query(None, description="Valor de X-Next-Cursor da página anterior"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    sort: str = Query("id", pattern="^(id|data)$"),
+    cliente_id: Optional[int] = None,
+    data_inicio: Optional[datetime.date] = None,
+    data_fim: Optional[datetime.date] = None,
+    status: Optional[str] = None,
+    include_total: bool = False,
+    format: str = Query("json", pattern="^(json|ndjson|csv)$", description="ndjson/csv = exportação em streaming"),
+) -> ListParams:
+    # Exportação em streaming (ndjson/csv) não tem teto de página: limite só se pedido
+    if format == "json":
+        if limit is not None:
+            limit = min(limit, PAGINATION_MAX_LIMIT)
+        elif cursor:
+            limit = PAGINATION_DEFAULT_LIMIT
+    return ListParams(limit, cursor, order, sort, cliente_id, data_inicio, data_fim, status, include_total, format)
+
+def _encode_cursor(sort_value, row_id: int) -> str:
+    if isinstance(sort_value, (datetime.date, datetime.datetime)):
+        sort_value = sort_value.isoformat()
+    raw = json.dumps([sort_value, row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return sort_value, int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def _apply_list_filters(q, p: ListParams, cliente_cols=(), date_col=None, status_col=None):
+    """Aplica filtros cliente_id / data_inicio..data_fim / status direto no SQL."""
+    if p.cliente_id is not None:
+        if not cliente_cols:
+            raise HTTPException(status_code=400, detail="Filtro cliente_id não suportado nesta listagem")
+        q = q.filter(or_(*[c == p.cliente_id for c in cliente_cols]))
+    if p.data_inicio is not None or p.data_fim is not None:
+        if date_col is None:
+            raise HTTPException(status_code=400, detail="Filtro por data não suportado nesta listagem")
+        if p.data_inicio is not None:
+            q = q.filter(date_col >= p.data_inicio)
+        if p.data_fim is not None:
+            if isinstance(date_col.type, DateTime):
+                # Coluna com hora: inclui o dia inteiro de data_fim
+                q = q.filter(date_col < p.data_fim + datetime.timedelta(days=1))
+            else:
+                q = q.filter(date_col <= p.data_fim)
+    if p.status is not None:
+        if status_col is None:
+            raise HTTPException(status_code=400, detail="Filtro status não suportado nesta listagem")
+        q = q.filter(status_col == p.status)
+    return q
+
+def _keyset_order(q, p: ListParams, id_col, date_col=None):
+    """Aplica cursor (keyset) e ordenação; retorna (query, coluna de ordenação ou None)."""
+    desc = p.order == "desc"
+    if p.sort == "data":
+        if date_col is None:
+            raise HTTPException(status_code=400, detail="Ordenação por data não suportada nesta listagem")
+        # NULL não é comparável no keyset; trata como a menor data possível
+        is_datetime = isinstance(date_col.type, DateTime)
+        sort_col = func.coalesce(date_col, datetime.datetime.min if is_datetime else datetime.date.min)
+    else:
+        sort_col = None
+    if p.cursor:
+        last_value, last_id = _decode_cursor(p.cursor)
+        if sort_col is None:
+            q = q.filter(id_col < last_id if desc else id_col > last_id)
+        else:
+            try:
+                if is_datetime:
+                    last_date = datetime.datetime.fromisoformat(last_value) if last_value else datetime.datetime.min
+                else:
+                    last_date = datetime.date.fromisoformat(last_value) if last_value else datetime.date.min
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Cursor inválido")
+            if desc:
+                q = q.filter(or_(sort_col < last_date, and_(sort_col == last_date, id_col < last_id)))
+            else:
+                q = q.filter(or_(sort_col > last_date, and_(sort_col == last_date, id_col > last_id)))
+    order_cols = ([sort_col] if sort_col is not None else []) + [id_col]
+    return q.order_by(*[c.desc() if desc else c.asc() for c in order_cols]), sort_col
+
+def _paginate(q, p: ListParams, response: Response, id_col, date_col=None):
+    """Ordena e pagina por keyset; preenche X-Total-Count/X-Next-Cursor em `response`.
+
+    Com format=ndjson|csv devolve um StreamingResponse (ver _stream_export).
+    """
+    if p.include_total:
+        response.headers["X-Total-Count"] = str(q.order_by(None).count())
+    q, sort_col = _keyset_order(q, p, id_col, date_col)
+    if p.format != "json":
+        if p.limit is not None:
+            q = q.limit(p.limit)
+        return _stream_export(q, p.format, id_col.table.name, dict(response.headers))
+    if p.limit is None:
+        return q.all()
+    rows = q.limit(p.limit + 1).all()
+    if len(rows) > p.limit:
+        rows = rows[:p.limit]
+        last = rows[-1]
+        last_value = None
+        if sort_col is not None:
+            last_value = getattr(last, date_col.key) or datetime.date.min
+        response.headers["X-Next-Cursor"] = _encode_cursor(last_value, last.id)
+    return rows
+
+# --- Exportação em streaming (NDJSON / CSV) ---
+# Lê as linhas direto do cursor do SQLite (sem montar objetos ORM nem validar cada linha
+# via Pydantic) e envia em blocos de EXPORT_CHUNK_ROWS, mantendo a memória constante.
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+
+def _export_value(v):
+    if isinstance(v, decimal.Decimal):
+        return float(v)
+    if isinstance(v, (datetime.date, datetime.time, datetime.datetime)):
+        return v.isoformat()
+    return v
+
+def _stream_export(q, fmt: str, name: str, headers: dict | None = None):
+    # Consulta de entidade (db.query(Model)): só as colunas da tabela; consulta por colunas
+    # (ex.: resumo com contagens/joins) sai com a projeção que já tem. A conexão é aberta
+    # dentro do gerador para que o cursor viva enquanto a resposta é enviada
+    # (independente do ciclo das dependências).
+    descs = q.column_descriptions
+    if len(descs) == 1 and descs[0]["entity"] is not None and descs[0]["expr"] is descs[0]["entity"]:
+        q = q.with_entities(*descs[0]["entity"].__table__.columns)
+    stmt = q.statement
+
+    def gen():
+        with read_engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_ROWS).execute(stmt)
+            cols = list(result.keys())
+            if fmt == "csv":
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                buf.write("\ufeff")  # BOM: Excel reconhece UTF-8 (acentos)
+                writer.writerow(cols)
+                yield buf.getvalue()
+            for chunk in result.partitions():
+                buf = io.StringIO()
+                if fmt == "csv":
+                    writer = csv.writer(buf)
+                    writer.writerows([[_export_value(v) for v in row] for row in chunk])
+                else:
+                    for row in chunk:
+                        buf.write(json.dumps({k: _export_value(v) for k, v in zip(cols, row)}, ensure_ascii=False))
+                        buf.write("\n")
+                yield buf.getvalue()
+
+    out_headers = {k: v for k, v in (headers or {}).items() if k.lower().startswith("x-")}
+    stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    if fmt == "csv":
+        out_headers["Content-Disposition"] = f"attachment; filename={name}_{stamp}.csv"
+        return StreamingResponse(gen(), media_type="text/csv; charset=utf-8", headers=out_headers)
+    out_headers["Content-Disposition"] = f"attachment; filename={name}_{stamp}.ndjson"
+    return StreamingResponse(gen(), media_type="application/x-ndjson", headers=out_headers)
 
 class MyClientesResponse(BaseModel):
     grupo_id: int | None
     clientes: List[int]
 
 @app.get("/me/clientes", response_model=MyClientesResponse)
-def get_my_clientes(current_user: Usuario = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_my_clientes(current_user: Usuario = Depends(get_current_user), db: Session = Depends(get_read_db)):
     ids = _get_allowed_client_ids(db, current_user)
     # None significa acesso total; por compatibilidade retornamos todos IDs
     if ids is None:
@@ -2055,7 +3065,7 @@ def get_my_clientes(current_user: Usuario = Depends(get_current_user), db: Sessi
 
 # --- DEBUG / DIAGNOSTICS AUXILIARES ---
 @app.get("/debug/clientes/count")
-def debug_clientes_count(db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
+def debug_clientes_count(db: Session = Depends(get_read_db), current_user: Usuario = Depends(get_current_user)):
     total = db.query(Cliente).count()
     sample = db.query(Cliente).order_by(Cliente.id).limit(5).all()
     return {
@@ -2069,33 +3079,33 @@ def debug_clientes_count(db: Session = Depends(get_db), current_user: Usuario =
     }
 
 @app.get("/debug/permissoes/ids")
-def debug_permissoes_ids(db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
+def debug_permissoes_ids(db: Session = Depends(get_read_db), current_user: Usuario = Depends(get_current_user)):
     ids = _collect_permission_ids_for_user(db, current_user)
     return {"user": current_user.username, "nivel": current_user.nivel_acesso, "perm_ids": sorted(list(ids))}
 
 # --- Admin: Download de dados (SQLite e uploads) ---
 @app.get("/admin/download/sqlite")
 def admin_download_sqlite(current_user: Usuario = Depends(require_admin)):
-    """Baixa o arquivo SQLite atual (somente quando o backend usa SQLite)."""
+    """Baixa o arquivo SQLite atual (somente quando o backend usa SQLite).
+
+    O banco sozinho não traz o conteúdo das planilhas enviadas (arquivos_importados guarda
+    só o sha256; os arquivos ficam no blob store). Para um backup completo use /backup/run,
+    que inclui os blobs em _data/blobs/.
+    """
     if not DB_PATH:
         raise HTTPException(status_code=400, detail="Backend não está usando SQLite")
     if not os.path.exists(DB_PATH):
         raise HTTPException(status_code=404, detail="Arquivo SQLite não encontrado")
 
     safe_name = os.path.basename(DB_PATH)
+    # Snapshot consistente (API de backup do SQLite) em vez do arquivo vivo
+    snap = make_db_snapshot_tmp()
 
-    def iterfile():
-        with open(DB_PATH, "rb") as f:  # type: ignore[arg-type]
-            while True:
-                chunk = f.read(1024 * 1024)
-                if not chunk:
-                    break
-                yield chunk
-
-    return StreamingResponse(
-        iterfile(),
+    return FileResponse(
+        snap,
         media_type="application/octet-stream",
         headers={"Content-Disposition": f"attachment; filename={safe_name}"},
+        background=StarletteBackgroundTask(os.remove, snap),
     )
 
 @app.get("/admin/download/uploads.zip")
@@ -2104,33 +3114,19 @@ def admin_download_uploads(current_user: Usuario = Depends(require_admin)):
     if not os.path.isdir(UPLOAD_DIR):
         raise HTTPException(status_code=404, detail="Diretório de uploads não encontrado")
 
-    # Gera ZIP em memória (pode ser pesado para uploads muito grandes)
-    # Para cenários grandes, migrar para arquivo temporário em BACKUP_DIR
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
-        for root, _, files in os.walk(UPLOAD_DIR):
-            for fn in files:
-                abs_fp = os.path.join(root, fn)
-                # Segurança: garantir que está dentro do UPLOAD_DIR
-                if not os.path.abspath(abs_fp).startswith(os.path.abspath(UPLOAD_DIR)):
-                    continue
-                arcname = os.path.relpath(abs_fp, UPLOAD_DIR)
-                try:
-                    zf.write(abs_fp, arcname=arcname)
-                except Exception:
-                    # ignora arquivo problemático
-                    continue
-    buf.seek(0)
+    # ZIP gerado em streaming: cada arquivo é lido só quando sua entrada é enviada
+    # (mídias sem recompressão), então a memória fica constante em qualquer volume
+    entries = backup_zip.stream_entries(UPLOAD_DIR)
     stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
     filename = f"uploads_{stamp}.zip"
-    return Response(
-        content=buf.read(),
-        media_type="application/zip",
-        headers={"Content-Disposition": f"attachment; filename={filename}"},
-    )
+    headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    size = backup_zip.stream_zip_size(entries)
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    return StreamingResponse(backup_zip.iter_stream_zip(entries), media_type="application/zip", headers=headers)
 
 @app.get("/usuarios/", response_model=List[UsuarioSchema])
-def listar_usuarios(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1101, "read"))):
+def listar_usuarios(db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1101, "read"))):
     return db.query(Usuario).all()
 
 @app.post("/usuarios/", response_model=UsuarioSchema)
@@ -2156,6 +3152,7 @@ def editar_usuario(usuario_id: int, usuario: UsuarioUpdateSchema, db: Session =
     db_usuario = db.query(Usuario).filter(Usuario.id == usuario_id).first()
     if not db_usuario:
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
+    old_username = db_usuario.username
     db_usuario.username = usuario.username
     db_usuario.nome = usuario.nome
     db_usuario.email = usuario.email
@@ -2167,6 +3164,8 @@ def editar_usuario(usuario_id: int, usuario: UsuarioUpdateSchema, db: Session =
     db_usuario.grupo_id = usuario.grupo_id
     db.commit()
     db.refresh(db_usuario)
+    invalidate_auth_cache(username=old_username)
+    invalidate_auth_cache(username=db_usuario.username)
     return db_usuario
 
 @app.delete("/usuarios/{usuario_id}")
@@ -2176,11 +3175,12 @@ def deletar_usuario(usuario_id: int, db: Session = Depends(get_db), current_user
         raise HTTPException(status_code=404, detail="Usuário não encontrado")
     db.delete(db_usuario)
     db.commit()
+    invalidate_auth_cache(username=db_usuario.username)
     return {"ok": True}
 
 # Auxiliares de usuários por grupo
 @app.get("/grupos/{grupo_id}/usuarios", response_model=List[UsuarioSchema])
-def listar_usuarios_por_grupo(grupo_id: int, db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1101, "read"))):
+def listar_usuarios_por_grupo(grupo_id: int, db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1101, "read"))):
     return db.query(Usuario).filter(Usuario.grupo_id == grupo_id).all()
 
 class SetGrupoSchema(BaseModel):
@@ -2194,6 +3194,7 @@ def set_grupo_usuario(usuario_id: int, payload: SetGrupoSchema, db: Session = De
     user.grupo_id = payload.grupo_id
     db.commit()
     db.refresh(user)
+    invalidate_auth_cache(username=user.username)
     return user
 
 # Login
@@ -2249,279 +3250,104 @@ def get_current_user_info(current_user: Usuario = Depends(get_current_user)):
 # para evitar conflito com StaticFiles montado em "/uploads" (usado para servir mídias).
 @app.post("/uploads/{entidade}", response_model=UploadResult)
 @app.post("/api/uploads/{entidade}", response_model=UploadResult)
-async def upload_entidade(entidade: str, file: UploadFile = File(...), db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
-    # Persistir arquivo no banco (ArquivosImportados)
-    content = await file.read()
+async def upload_entidade(
+    entidade: str,
+    file: UploadFile = File(...),
+    run_async: bool = Query(False, alias="async", description="Importar em background; retorna job_id (202)"),
+    db: Session = Depends(get_db),
+    current_user: Usuario = Depends(get_current_user),
+):
+    importable = file.filename.lower().endswith((".csv", ".xlsx", ".xls"))
+    if run_async:
+        if entidade not in importers.IMPORTERS or not importable:
+            raise HTTPException(status_code=400, detail=f"Importação assíncrona não suportada para '{entidade}' com este arquivo.")
+        if entidade == "contratos" and not file.filename.lower().endswith((".xlsx", ".xls")):
+            raise HTTPException(status_code=400, detail="Apenas arquivos Excel (.xlsx/.xls) são aceitos para contratos.")
+    # Persistir arquivo no blob store (endereçado por SHA-256) e só os metadados em ArquivosImportados
+    sha256, size = await run_in_threadpool(blobstore.put_stream, file.file)
     up = ArquivoImportado(
         nome=file.filename,
         entidade=entidade,
-        conteudo=content,
-        tamanho=len(content),
+        conteudo=b"",
+        sha256=sha256,
+        tamanho=size,
     )
     db.add(up)
     db.commit()
     db.refresh(up)
 
+    if run_async:
+        # Parse em processo separado; o cliente acompanha por GET /uploads/jobs/{id}
+        job = _submit_import_job(up.id, entidade, file.filename, current_user.username)
+        return JSONResponse(
+            status_code=202,
+            content={
+                "job_id": job["id"],
+                "upload_id": up.id,
+                "filename": up.nome,
+                "entidade": entidade,
+                "status": job["status"],
+                "status_url": f"/uploads/jobs/{job['id']}",
+            },
+        )
+
+    content = blobstore.read_bytes(sha256) if entidade in importers.IMPORTERS else b""
+
     # Opcional: se for valor_materiais ou clientes, tentar parse simples (CSV/XLSX)
     imported = 0
-    if entidade == "valor_materiais" and file.filename.lower().endswith((".csv", ".xlsx", ".xls")):
+    import_errors: list[str] = []
+    if entidade == "valor_materiais" and importable:
         try:
-            import pandas as pd  # type: ignore
-            buf = io.BytesIO(content)
-            if file.filename.lower().endswith('.csv'):
-                df = pd.read_csv(buf)
-            else:
-                df = pd.read_excel(buf)
-            # Normalização de colunas esperadas
-            cols = {c.lower().strip(): c for c in df.columns}
-            def pick(row, key, default=None):
-                # aceita chave exata ou variações comuns
-                candidates = [key, key.replace('_', ' '), key.replace('_', ''), key.replace('_', '-')]
-                for k in candidates:
-                    if k in cols:
-                        return row[cols[k]]
-                return default
-            for _, row in df.iterrows():
-                vm = ValorMaterial(
-                    cliente_id=None,
-                    descricao_produto=str(pick(row, 'descricao_produto', pick(row, 'descricao', '')) or ''),
-                    marca=str(pick(row, 'marca', '') or ''),
-                    unidade_medida=str(pick(row, 'unidade_medida', pick(row, 'unidade', '')) or ''),
-                    valor_unitario=float(pick(row, 'valor_unitario', pick(row, 'valor', 0)) or 0),
-                    estoque_atual=int(pick(row, 'estoque_atual', 0) or 0),
-                    estoque_minimo=int(pick(row, 'estoque_minimo', 0) or 0),
-                    data_ultima_entrada=str(pick(row, 'data_ultima_entrada', '') or ''),
-                    responsavel=str(pick(row, 'responsavel', '') or ''),
-                    fornecedor=str(pick(row, 'fornecedor', '') or ''),
-                    valor=float(pick(row, 'valor', 0) or 0),
-                    localizacao=str(pick(row, 'localizacao', '') or ''),
-                    observacoes=str(pick(row, 'observacoes', '') or ''),
-                )
-                db.add(vm)
-                imported += 1
-            db.commit()
-        except Exception:
+            result = importers.import_valor_materiais(db, content, file.filename)
+            imported = result["imported"]
+            import_errors = result["errors"]
+        except Exception as e:
             # Se falhar o parse, não impede o upload; apenas segue com 0 importados
-            db.rollback()
+            logger.exception("Falha ao importar valor_materiais")
             imported = 0
-    elif entidade == "clientes" and file.filename.lower().endswith((".csv", ".xlsx", ".xls")):
+            import_errors = [f"Falha ao importar: {e}"]
+    elif entidade == "clientes" and importable:
         try:
-            import pandas as pd  # type: ignore
-            buf = io.BytesIO(content)
-            if file.filename.lower().endswith('.csv'):
-                df = pd.read_csv(buf)
-            else:
-                df = pd.read_excel(buf)
-
-            # Normalização de colunas esperadas
-            cols = {str(c).strip().lower(): c for c in df.columns}
-
-            def col(row, key, default=None):
-                variants = [
-                    key,
-                    key.replace('_', ' '),
-                    key.replace('_', ''),
-                    key.replace('_', '-'),
-                ]
-                for k in variants:
-                    if k in cols:
-                        return row[cols[k]]
-                return default
-
-            for _, row in df.iterrows():
-                _id = col(row, 'id')
-                nome = str(col(row, 'nome', '') or '').strip()
-                cnpj = str(col(row, 'cnpj', '') or '').strip()
-                email = str(col(row, 'email', '') or '').strip()
-                contato = str(col(row, 'contato', '') or '').strip()
-                endereco = str(col(row, 'endereco', col(row, 'endereço', '')) or '').strip()
-
-                # Pular linhas sem nome
-                if not nome:
-                    continue
-
-                # Estratégia de upsert: tenta localizar por ID, depois por CNPJ, depois por nome
-                existing = None
-                if _id not in (None, "", float('nan')):
-                    try:
-                        _id_int = int(_id)
-                        existing = db.query(Cliente).filter(Cliente.id == _id_int).first()
-                    except Exception:
-                        existing = None
-                if not existing and cnpj:
-                    existing = db.query(Cliente).filter(Cliente.cnpj == cnpj).first()
-                if not existing and nome:
-                    existing = db.query(Cliente).filter(Cliente.nome == nome).first()
-
-                if existing:
-                    # Atualiza campos conhecidos
-                    changed = False
-                    if cnpj and existing.cnpj != cnpj:
-                        existing.cnpj = cnpj; changed = True
-                    if email and existing.email != email:
-                        existing.email = email; changed = True
-                    if contato and existing.contato != contato:
-                        existing.contato = contato; changed = True
-                    if endereco and existing.endereco != endereco:
-                        existing.endereco = endereco; changed = True
-                    if changed:
-                        db.add(existing)
-                        existing.endereco = endereco; changed = True
-                    if changed:
-                        db.add(existing)
-                        imported += 1
-                else:
-                    novo = Cliente(
-                        nome=nome,
-                        cnpj=cnpj or None,
-                        email=email or None,
-                        contato=contato or None,
-                        endereco=endereco or None,
-                    )
-                    db.add(novo)
-                    imported += 1
-            db.commit()
+            result = importers.import_clientes(db, content, file.filename)
+            imported = result["imported"]
+            import_errors = result["errors"]
         except Exception as e:
             # Em caso de erro, faz rollback e segue
             print(f"[UPLOAD clientes] Erro ao importar: {e}")
-            db.rollback()
             imported = 0
+            import_errors = [f"Falha ao importar: {e}"]
 
     elif entidade == "contratos":
         # Importação ESTRITA via modelo: aceita somente .xlsx/.xls com colunas exatamente iguais ao template
+        if not file.filename.lower().endswith((".xlsx", ".xls")):
+            raise HTTPException(status_code=400, detail="Apenas arquivos Excel (.xlsx/.xls) são aceitos para contratos.")
         try:
-            if not file.filename.lower().endswith((".xlsx", ".xls")):
-                raise HTTPException(status_code=400, detail="Apenas arquivos Excel (.xlsx/.xls) são aceitos para contratos.")
-            import pandas as pd  # type: ignore
-            buf = io.BytesIO(content)
-            df = pd.read_excel(buf)
-
-            expected = [
-                "numero",
-                "cliente_id",
-                "valor",
-                "dataInicio",
-                "dataFim",
-                "tipo",
-                "situacao",
-                "prazoPagamento",
-                "quantidadeParcelas",
-            ]
-            # Normalizar nomes (case-insensitive), mas exigir conjunto exato de colunas
-            norm = [str(c).strip() for c in df.columns]
-            if set(norm) != set(expected) or len(norm) != len(expected):
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Colunas inválidas. Use exatamente estas colunas: {', '.join(expected)}",
-                )
-
-            # Helper de datas
-            from datetime import date, datetime as dt
-
-            def to_date(v):
-                if pd.isna(v) or v is None or v == "":
-                    return None
-                if isinstance(v, (dt, date)):
-                    return v.date() if isinstance(v, dt) else v
-                # tentar parse a partir de string
-                try:
-                    return pd.to_datetime(v).date()
-                except Exception:
-                    return None
-
-            errors: list[str] = []
-            new_count = 0
-
-            # Validar todas as linhas antes (transação all-or-nothing)
-            rows_data = []
-            for idx, row in df.iterrows():
-                numero = str(row.get("numero", "")).strip()
-                cliente_id = row.get("cliente_id", None)
-                valor = row.get("valor", None)
-                dataInicio = to_date(row.get("dataInicio", None))
-                dataFim = to_date(row.get("dataFim", None))
-                tipo = str(row.get("tipo", "")).strip() or None
-                situacao = str(row.get("situacao", "")).strip() or None
-                prazoPagamento = str(row.get("prazoPagamento", "")).strip() or None
-                quantidadeParcelas = str(row.get("quantidadeParcelas", "")).strip() or None
-
-                if not numero:
-                    errors.append(f"Linha {idx+2}: campo 'numero' é obrigatório.")
-                try:
-                    cliente_id_int = int(cliente_id)
-                except Exception:
-                    errors.append(f"Linha {idx+2}: 'cliente_id' inválido.")
-                    cliente_id_int = None  # type: ignore
-                try:
-                    valor_num = float(valor)
-                except Exception:
-                    errors.append(f"Linha {idx+2}: 'valor' inválido.")
-                    valor_num = None  # type: ignore
-                # Datas: se informadas e parse falhar, erro
-                if row.get("dataInicio", None) not in (None, "") and dataInicio is None:
-                    errors.append(f"Linha {idx+2}: 'dataInicio' inválida.")
-                if row.get("dataFim", None) not in (None, "") and dataFim is None:
-                    errors.append(f"Linha {idx+2}: 'dataFim' inválida.")
-
-                # FK cliente
-                if isinstance(cliente_id_int, int):
-                    cli = db.query(Cliente).filter(Cliente.id == cliente_id_int).first()
-                    if not cli:
-                        errors.append(f"Linha {idx+2}: cliente_id {cliente_id_int} não existe.")
-
-                rows_data.append(
-                    {
-                        "numero": numero,
-                        "cliente_id": cliente_id_int,
-                        "valor": valor_num,
-                        "dataInicio": dataInicio,
-                        "dataFim": dataFim,
-                        "tipo": tipo,
-                        "situacao": situacao,
-                        "prazoPagamento": prazoPagamento,
-                        "quantidadeParcelas": quantidadeParcelas,
-                    }
-                )
-
-            if errors:
-                # Rollback total e retornar erros (aceitar somente se 100% válido)
-                db.rollback()
-                # Limitar quantidade de erros na resposta
-                preview = "; ".join(errors[:10])
-                if len(errors) > 10:
-                    preview += f" (+{len(errors)-10} erros)"
-                raise HTTPException(status_code=400, detail=f"Erros de validação: {preview}")
-
-            # Inserir (upsert por numero)
-            for data in rows_data:
-                existing = db.query(Contrato).filter(Contrato.numero == data["numero"]).first()
-                if existing:
-                    existing.cliente_id = data["cliente_id"]
-                    existing.valor = data["valor"]
-                    existing.dataInicio = data["dataInicio"]
-                    existing.dataFim = data["dataFim"]
-                    existing.tipo = data["tipo"]
-                    existing.situacao = data["situacao"]
-                    existing.prazoPagamento = data["prazoPagamento"]
-                    existing.quantidadeParcelas = data["quantidadeParcelas"]
-                    db.add(existing)
-                else:
-                    novo = Contrato(**data)
-                    db.add(novo)
-                new_count += 1
-            db.commit()
-            imported = new_count
-        except HTTPException:
-            raise
+            result = importers.import_contratos(db, content, file.filename)
+            imported = result["imported"]
+        except importers.ImportValidationError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         except Exception as e:
             db.rollback()
             raise HTTPException(status_code=400, detail=f"Falha ao importar contratos: {e}")
 
-    return UploadResult(upload_id=up.id, filename=up.nome, entidade=up.entidade, records_imported=imported)
+    return UploadResult(upload_id=up.id, filename=up.nome, entidade=up.entidade, records_imported=imported, errors=import_errors)
+
+@app.get("/uploads/jobs/{job_id}")
+@app.get("/api/uploads/jobs/{job_id}")
+def get_import_job(job_id: str, current_user: Usuario = Depends(get_current_user)):
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    job = importers.load_job(_import_job_path(job_id))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    is_admin = (current_user.nivel_acesso or "").lower() in ["admin", "willians"]
+    if not is_admin and job.get("username") != current_user.username:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return {k: v for k, v in job.items() if k != "username"}
 
 @app.get("/uploads")
 @app.get("/api/uploads")
-def list_uploads(entidade: Optional[str] = None, db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
+def list_uploads(entidade: Optional[str] = None, db: Session = Depends(get_read_db), current_user: Usuario = Depends(get_current_user)):
     q = db.query(ArquivoImportado)
     if entidade:
         q = q.filter(ArquivoImportado.entidade == entidade)
@@ -2537,14 +3363,67 @@ def list_uploads(entidade: Optional[str] = None, db: Session = Depends(get_db),
         for it in items
     ]
 
+def _not_modified(request: Request, etag: str, last_modified: datetime.datetime | None) -> bool:
+    """Avalia If-None-Match (prioritário) e If-Modified-Since contra o ETag/data do recurso."""
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        tags = [t.strip().removeprefix("W/") for t in inm.split(",")]
+        return "*" in tags or etag in tags
+    ims = request.headers.get("if-modified-since")
+    if ims and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(ims)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+def _conditional_file_response(
+    request: Request,
+    path: str,
+    etag: str,
+    last_modified: datetime.datetime | None = None,
+    filename: str | None = None,
+    media_type: str | None = None,
+    cache_control: str = "private, no-cache",
+):
+    """Serve um arquivo do disco em blocos com ETag/Last-Modified próprios.
+
+    Responde 304 para requisições condicionais; Range/If-Range ficam com o FileResponse
+    (206 com o trecho pedido), então downloads repetidos ou retomados não reenviam o arquivo.
+    last_modified deve estar em UTC (aware).
+    """
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified.timestamp(), usegmt=True)
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers, media_type=media_type, filename=filename)
+
 @app.get("/uploads/{upload_id}/download")
 @app.get("/api/uploads/{upload_id}/download")
-def download_upload(upload_id: int, db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
+def download_upload(upload_id: int, request: Request, db: Session = Depends(get_read_db), current_user: Usuario = Depends(get_current_user)):
     up = db.query(ArquivoImportado).filter(ArquivoImportado.id == upload_id).first()
     if not up:
         raise HTTPException(status_code=404, detail="Upload não encontrado")
+    if up.sha256:
+        if not blobstore.exists(up.sha256):
+            raise HTTPException(status_code=404, detail="Conteúdo do upload não encontrado")
+        # Conteúdo endereçado por hash: o próprio sha256 é um ETag forte
+        criado = up.criado_em.replace(tzinfo=datetime.timezone.utc) if up.criado_em else None
+        return _conditional_file_response(
+            request,
+            blobstore.blob_path(up.sha256),
+            etag=f'"{up.sha256}"',
+            last_modified=criado,
+            filename=up.nome,
+            media_type=mimetypes.guess_type(up.nome)[0] or "application/octet-stream",
+        )
+    # Registro ainda não migrado para o blob store
     headers = {"Content-Disposition": f"attachment; filename={up.nome}"}
-    return StreamingResponse(io.BytesIO(up.conteudo), headers=headers)
+    return StreamingResponse(io.BytesIO(up.conteudo or b""), headers=headers)
 
 # ------------------------
 # Modelos Excel (Templates)
@@ -2700,7 +3579,7 @@ async def upload_valor_materiais(file: UploadFile = File(...), db: Session = Dep
 async def import_contratos(file: UploadFile = File(...), db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
     return await upload_entidade("contratos", file, db, current_user)
 @app.get("/me/permissoes")
-def get_my_permissions(current_user: Usuario = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_my_permissions(current_user: Usuario = Depends(get_current_user), db: Session = Depends(get_read_db)):
     """Retorna permissões efetivas do usuário (via grupo)."""
     if not current_user.grupo_id:
         return {"grupo_id": None, "permissoes": []}
@@ -2720,7 +3599,7 @@ def get_my_permissions(current_user: Usuario = Depends(get_current_user), db: Se
 
 # Grupos de Usuários
 @app.get("/grupos/", response_model=List[GrupoUsuarioSchema])
-def list_grupos(db: Session = Depends(get_db), current_user: Usuario = Depends(require_admin)):
+def list_grupos(db: Session = Depends(get_read_db), current_user: Usuario = Depends(require_admin)):
     return db.query(GrupoUsuario).all()
 
 @app.post("/grupos/", response_model=GrupoUsuarioSchema)
@@ -2774,10 +3653,11 @@ def create_grupo(grupo: GrupoUsuarioCreateSchema, db: Session = Depends(get_db),
             
     db.commit()
     db.refresh(db_grupo)
+    _permission_matrix.refresh_group(db, db_grupo.id)
     return db_grupo
 
 @app.get("/grupos/{grupo_id}", response_model=GrupoUsuarioSchema)
-def get_grupo(grupo_id: int, db: Session = Depends(get_db), current_user: Usuario = Depends(require_admin)):
+def get_grupo(grupo_id: int, db: Session = Depends(get_read_db), current_user: Usuario = Depends(require_admin)):
     grupo = db.query(GrupoUsuario).filter(GrupoUsuario.id == grupo_id).first()
     if not grupo:
         raise HTTPException(status_code=404, detail="Grupo não encontrado")
@@ -2822,6 +3702,7 @@ def update_grupo(grupo_id: int, grupo: GrupoUsuarioCreateSchema, db: Session = D
 
     db.commit()
     db.refresh(db_grupo)
+    _permission_matrix.refresh_group(db, grupo_id)
     return db_grupo
 
 @app.delete("/grupos/{grupo_id}")
@@ -2831,16 +3712,17 @@ def delete_grupo(grupo_id: int, db: Session = Depends(get_db), current_user: Usu
         raise HTTPException(status_code=404, detail="Grupo não encontrado")
     db.delete(db_grupo)
     db.commit()
+    _permission_matrix.drop_group(grupo_id)
     return {"ok": True}
 
 # Permissões
 @app.get("/permissoes/", response_model=List[PermissaoSistemaSchema])
-def list_permissoes(db: Session = Depends(get_db), current_user: Usuario = Depends(require_admin)):
+def list_permissoes(db: Session = Depends(get_read_db), current_user: Usuario = Depends(require_admin)):
     return db.query(PermissaoSistema).all()
 
 # Permissões de Grupo
 @app.get("/grupos/{grupo_id}/permissoes/")
-def get_grupo_permissoes(grupo_id: int, db: Session = Depends(get_db), current_user: Usuario = Depends(require_admin)):
+def get_grupo_permissoes(grupo_id: int, db: Session = Depends(get_read_db), current_user: Usuario = Depends(require_admin)):
     # Verificar se o grupo existe
     db_grupo = db.query(GrupoUsuario).filter(GrupoUsuario.id == grupo_id).first()
     if not db_grupo:
@@ -2867,7 +3749,7 @@ def get_grupo_permissoes(grupo_id: int, db: Session = Depends(get_db), current_u
 
 # Lojas
 @app.get("/lojas/", response_model=List[LojaSchema])
-def list_lojas(db: Session = Depends(get_db)):
+def list_lojas(db: Session = Depends(get_read_db)):
     return db.query(Loja).all()
 
 @app.post("/lojas/", response_model=LojaSchema)
@@ -2880,7 +3762,7 @@ def create_loja(loja: LojaCreateSchema, db: Session = Depends(get_db)):
 
 # Finalizando o arquivo main.py com endpoints de clientes e outras entidades
 @app.get("/clientes/", response_model=List[ClienteSchema])
-def listar_clientes(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1201, "read"))):
+def listar_clientes(db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1201, "read"))):
     allowed = _get_allowed_client_ids(db, current_user)
     q = db.query(Cliente)
     if allowed is not None and len(allowed) > 0:
@@ -2938,12 +3820,13 @@ def deletar_cliente(cliente_id: int, db: Session = Depends(get_db), current_user
 
 # Despesas
 @app.get("/despesas/", response_model=List[DespesaSchema])
-def listar_despesas(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1601, "read"))):
-    return db.query(Despesa).all()
+def listar_despesas(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1601, "read"))):
+    q = _apply_list_filters(db.query(Despesa), params, cliente_cols=(Despesa.id_cliente, Despesa.cliente_id), date_col=Despesa.data, status_col=Despesa.status)
+    return _paginate(q, params, response, Despesa.id, date_col=Despesa.data)
 
 @app.get("/despesas", response_model=List[DespesaSchema])
-def listar_despesas_alt(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1601, "read"))):
-    return db.query(Despesa).all()
+def listar_despesas_alt(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1601, "read"))):
+    return listar_despesas(response, params, db, current_user)
 
 @app.post("/despesas/", response_model=DespesaSchema)
 def criar_despesa(despesa: DespesaSchema, db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1601, "create"))):
@@ -2978,8 +3861,9 @@ def deletar_despesa(despesa_id: int, db: Session = Depends(get_db), current_user
 
 # Resumo Mensal
 @app.get("/resumo_mensal/", response_model=List[ResumoMensalSchema])
-def listar_resumo_mensal(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1801, "read"))):
-    return db.query(ResumoMensal).all()
+def listar_resumo_mensal(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1801, "read"))):
+    q = _apply_list_filters(db.query(ResumoMensal), params, cliente_cols=(ResumoMensal.cliente_id,))
+    return _paginate(q, params, response, ResumoMensal.id)
 
 @app.post("/resumo_mensal/", response_model=ResumoMensalSchema)
 def criar_resumo_mensal(resumo: ResumoMensalSchema, db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1801, "create"))):
@@ -3014,8 +3898,9 @@ def deletar_resumo_mensal(resumo_id: int, db: Session = Depends(get_db), current
 
 # Fornecedores
 @app.get("/fornecedores/", response_model=List[FornecedorSchema])
-def listar_fornecedores(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1301, "read"))):
-    return db.query(Fornecedor).all()
+def listar_fornecedores(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1301, "read"))):
+    q = _apply_list_filters(db.query(Fornecedor), params)
+    return _paginate(q, params, response, Fornecedor.id)
 
 @app.post("/fornecedores/", response_model=FornecedorSchema)
 def criar_fornecedor(fornecedor: FornecedorSchema, db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1301, "create"))):
@@ -3027,8 +3912,9 @@ def criar_fornecedor(fornecedor: FornecedorSchema, db: Session = Depends(get_db)
 
 # Orçamento de Obra
 @app.get("/orcamento_obra/", response_model=List[OrcamentoObraSchema])
-def listar_orcamento_obra(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1501, "read"))):
-    return db.query(OrcamentoObra).all()
+def listar_orcamento_obra(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1501, "read"))):
+    q = _apply_list_filters(db.query(OrcamentoObra), params, cliente_cols=(OrcamentoObra.cliente_id,), date_col=OrcamentoObra.data)
+    return _paginate(q, params, response, OrcamentoObra.id, date_col=OrcamentoObra.data)
 
 @app.post("/orcamento_obra/", response_model=OrcamentoObraSchema)
 def criar_orcamento_obra(orcamento: OrcamentoObraSchema, db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1501, "create"))):
@@ -3040,8 +3926,9 @@ def criar_orcamento_obra(orcamento: OrcamentoObraSchema, db: Session = Depends(g
 
 # Contratos
 @app.get("/contratos/", response_model=List[ContratoSchema])
-def listar_contratos(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1401, "read"))):
-    return db.query(Contrato).all()
+def listar_contratos(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1401, "read"))):
+    q = _apply_list_filters(db.query(Contrato), params, cliente_cols=(Contrato.cliente_id,), date_col=Contrato.dataInicio, status_col=Contrato.situacao)
+    return _paginate(q, params, response, Contrato.id, date_col=Contrato.dataInicio)
 
 @app.post("/contratos/", response_model=ContratoSchema)
 def criar_contrato(contrato: ContratoSchema, db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1401, "create"))):
@@ -3052,73 +3939,187 @@ def criar_contrato(contrato: ContratoSchema, db: Session = Depends(get_db), curr
     return novo
 
 # Relatório de Obras
-@app.get("/relatorios-obras/", response_model=List[RelatorioObrasSchema])
-def listar_relatorios_obras(db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
-    import json
-    
-    relatorios = db.query(RelatorioObras).order_by(RelatorioObras.data_relatorio.desc()).all()
-    
-    # Converter JSON strings para listas
-    for r in relatorios:
-        if r.mao_de_obra:
-            r.mao_de_obra = json.loads(r.mao_de_obra) if isinstance(r.mao_de_obra, str) else r.mao_de_obra
-        if r.equipamentos:
-            r.equipamentos = json.loads(r.equipamentos) if isinstance(r.equipamentos, str) else r.equipamentos
-        if r.atividades:
-            r.atividades = json.loads(r.atividades) if isinstance(r.atividades, str) else r.atividades
-    
-    return relatorios
+def _relatorio_query(db: Session):
+    # Itens carregados em 3 consultas (IN) para a página inteira, sem N+1
+    return db.query(RelatorioObras).options(
+        selectinload(RelatorioObras.mao_de_obra_itens),
+        selectinload(RelatorioObras.equipamentos_itens),
+        selectinload(RelatorioObras.atividades_itens),
+    )
+
+def _filtrar_relatorios(q, cliente_id: Optional[int], data_inicio: Optional[datetime.date], data_fim: Optional[datetime.date]):
+    if cliente_id is not None:
+        q = q.filter(RelatorioObras.cliente_id == cliente_id)
+    if data_inicio is not None:
+        q = q.filter(RelatorioObras.data_relatorio >= data_inicio)
+    if data_fim is not None:
+        # data_relatorio é DateTime: inclui o dia inteiro de data_fim
+        q = q.filter(RelatorioObras.data_relatorio < data_fim + datetime.timedelta(days=1))
+    return q
+
+def _set_relatorio_itens(db_relatorio: RelatorioObras, relatorio: RelatorioObrasCreateSchema):
+    # Substituir a coleção apaga os itens anteriores (delete-orphan)
+    db_relatorio.mao_de_obra_itens = [RelatorioObrasMaoDeObra(posicao=i, nome=v) for i, v in enumerate(relatorio.mao_de_obra or [])]
+    db_relatorio.equipamentos_itens = [RelatorioObrasEquipamento(posicao=i, nome=v) for i, v in enumerate(relatorio.equipamentos or [])]
+    db_relatorio.atividades_itens = [RelatorioObrasAtividade(posicao=i, descricao=v) for i, v in enumerate(relatorio.atividades or [])]
+
+def _relatorio_cliente_permitido(db: Session, user: Usuario, cliente_id: int):
+    allowed = _get_allowed_client_ids(db, user)
+    if allowed is not None and cliente_id not in allowed:
+        raise HTTPException(status_code=403, detail="Sem acesso a este cliente")
+
+def _escopo_relatorios(q, db: Session, user: Usuario):
+    allowed = _get_allowed_client_ids(db, user)
+    if allowed is not None:
+        # Lista vazia => IN () sempre falso (nenhum relatório visível)
+        q = q.filter(RelatorioObras.cliente_id.in_(allowed))
+    return q
+
+def _parse_expand(expand: Optional[str]) -> list[str]:
+    if not expand:
+        return []
+    campos = {p.strip() for p in expand.split(",") if p.strip()}
+    if "itens" in campos:
+        campos |= {coluna for coluna, _, _ in RELATORIO_ITENS_TABELAS}
+        campos.discard("itens")
+    validos = {coluna for coluna, _, _ in RELATORIO_ITENS_TABELAS}
+    invalidos = campos - validos
+    if invalidos:
+        raise HTTPException(status_code=400, detail=f"expand inválido: {', '.join(sorted(invalidos))}")
+    return [coluna for coluna, _, _ in RELATORIO_ITENS_TABELAS if coluna in campos]
+
+@app.get("/relatorios-obras/", response_model=List[RelatorioObrasResumoSchema])
+def listar_relatorios_obras(
+    response: Response,
+    params: ListParams = Depends(list_params),
+    expand: Optional[str] = Query(None, description="mao_de_obra,equipamentos,atividades ou itens (todos)"),
+    db: Session = Depends(get_read_db),
+    current_user: Usuario = Depends(get_current_user),
+):
+    """Resumo dos relatórios (clima + quantidade de itens), só dos clientes do usuário.
+
+    Paginação/filtros como nas demais listagens (limit/cursor, cliente_id, data_inicio..data_fim,
+    sort=id|data). As listas de itens só vêm com ?expand= ou no detalhe.
+    """
+    campos_expand = _parse_expand(expand)
+    contagens = [
+        select(func.count()).where(model.relatorio_id == RelatorioObras.id).correlate(RelatorioObras).scalar_subquery().label(f"qtd_{coluna}")
+        for coluna, model, _ in RELATORIO_ITENS_TABELAS
+    ]
+    q = db.query(
+        RelatorioObras.id,
+        RelatorioObras.cliente_id,
+        Cliente.nome.label("cliente_nome"),
+        RelatorioObras.data_relatorio,
+        RelatorioObras.tempo,
+        RelatorioObras.condicao,
+        RelatorioObras.indice_pluviometrico,
+        *contagens,
+        RelatorioObras.criado_em,
+        RelatorioObras.criado_por,
+    ).outerjoin(Cliente, Cliente.id == RelatorioObras.cliente_id)
+    q = _escopo_relatorios(q, db, current_user)
+    q = _apply_list_filters(q, params, cliente_cols=(RelatorioObras.cliente_id,), date_col=RelatorioObras.data_relatorio)
+    rows = _paginate(q, params, response, RelatorioObras.id, date_col=RelatorioObras.data_relatorio)
+    if not isinstance(rows, list):
+        return rows  # exportação ndjson/csv
+    out = [dict(r._mapping) for r in rows]
+    if campos_expand and out:
+        por_id = {item["id"]: item for item in out}
+        for coluna, model, campo in RELATORIO_ITENS_TABELAS:
+            if coluna not in campos_expand:
+                continue
+            valor = getattr(model, campo)
+            # Uma consulta por tipo de item para a página inteira
+            for relatorio_id, v in (
+                db.query(model.relatorio_id, valor)
+                .filter(model.relatorio_id.in_(list(por_id)))
+                .order_by(model.relatorio_id, model.posicao)
+            ):
+                por_id[relatorio_id].setdefault(coluna, []).append(v)
+    return out
+
+@app.get("/relatorios-obras/busca", response_model=List[RelatorioObrasSchema])
+def buscar_relatorios_obras(
+    mao_de_obra: Optional[str] = None,
+    equipamento: Optional[str] = None,
+    atividade: Optional[str] = None,
+    cliente_id: Optional[int] = None,
+    data_inicio: Optional[datetime.date] = None,
+    data_fim: Optional[datetime.date] = None,
+    db: Session = Depends(get_read_db),
+    current_user: Usuario = Depends(get_current_user),
+):
+    """Relatórios em que o item aparece (ex.: todos os dias em que a equipe X trabalhou).
+
+    Comparação exata, sem diferenciar maiúsculas/minúsculas; filtros combinados com E.
+    """
+    q = _filtrar_relatorios(_escopo_relatorios(_relatorio_query(db), db, current_user), cliente_id, data_inicio, data_fim)
+    for valor, model, campo in (
+        (mao_de_obra, RelatorioObrasMaoDeObra, RelatorioObrasMaoDeObra.nome),
+        (equipamento, RelatorioObrasEquipamento, RelatorioObrasEquipamento.nome),
+        (atividade, RelatorioObrasAtividade, RelatorioObrasAtividade.descricao),
+    ):
+        if valor and valor.strip():
+            q = q.filter(RelatorioObras.id.in_(db.query(model.relatorio_id).filter(campo == valor.strip())))
+    return q.order_by(RelatorioObras.data_relatorio.desc()).all()
+
+@app.get("/relatorios-obras/uso-mensal", response_model=List[RelatorioObrasUsoMensalSchema])
+def uso_mensal_relatorios_obras(
+    tipo: str = Query("equipamentos", pattern="^(mao_de_obra|equipamentos|atividades)$"),
+    cliente_id: Optional[int] = None,
+    data_inicio: Optional[datetime.date] = None,
+    data_fim: Optional[datetime.date] = None,
+    db: Session = Depends(get_read_db),
+    current_user: Usuario = Depends(get_current_user),
+):
+    """Uso por obra (cliente) e mês: em quantos relatórios (dias) cada item aparece."""
+    model, campo = {
+        "mao_de_obra": (RelatorioObrasMaoDeObra, RelatorioObrasMaoDeObra.nome),
+        "equipamentos": (RelatorioObrasEquipamento, RelatorioObrasEquipamento.nome),
+        "atividades": (RelatorioObrasAtividade, RelatorioObrasAtividade.descricao),
+    }[tipo]
+    mes = func.strftime("%Y-%m", RelatorioObras.data_relatorio)
+    q = db.query(
+        RelatorioObras.cliente_id,
+        mes.label("mes"),
+        func.min(campo).label("item"),
+        func.count(func.distinct(RelatorioObras.id)).label("relatorios"),
+        func.count().label("ocorrencias"),
+    ).join(model, model.relatorio_id == RelatorioObras.id)
+    q = _filtrar_relatorios(_escopo_relatorios(q, db, current_user), cliente_id, data_inicio, data_fim)
+    # Agrupa pelo valor da coluna (NOCASE): variações de caixa contam como o mesmo item
+    rows = q.group_by(RelatorioObras.cliente_id, mes, campo).order_by(RelatorioObras.cliente_id, mes, campo).all()
+    return [
+        {"cliente_id": r.cliente_id, "mes": r.mes, "item": r.item, "relatorios": r.relatorios, "ocorrencias": r.ocorrencias}
+        for r in rows
+    ]
 
 @app.get("/relatorios-obras/{relatorio_id}", response_model=RelatorioObrasSchema)
-def obter_relatorio_obras(relatorio_id: int, db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
-    import json
-    
-    relatorio = db.query(RelatorioObras).filter(RelatorioObras.id == relatorio_id).first()
+def obter_relatorio_obras(relatorio_id: int, db: Session = Depends(get_read_db), current_user: Usuario = Depends(get_current_user)):
+    relatorio = _relatorio_query(db).filter(RelatorioObras.id == relatorio_id).first()
     if not relatorio:
         raise HTTPException(status_code=404, detail="Relatório não encontrado")
-    
-    # Converter JSON strings para listas
-    if relatorio.mao_de_obra:
-        relatorio.mao_de_obra = json.loads(relatorio.mao_de_obra) if isinstance(relatorio.mao_de_obra, str) else relatorio.mao_de_obra
-    if relatorio.equipamentos:
-        relatorio.equipamentos = json.loads(relatorio.equipamentos) if isinstance(relatorio.equipamentos, str) else relatorio.equipamentos
-    if relatorio.atividades:
-        relatorio.atividades = json.loads(relatorio.atividades) if isinstance(relatorio.atividades, str) else relatorio.atividades
-    
+    _relatorio_cliente_permitido(db, current_user, relatorio.cliente_id)
     return relatorio
 
 @app.post("/relatorios-obras/", response_model=RelatorioObrasSchema)
 def criar_relatorio_obras(relatorio: RelatorioObrasCreateSchema, db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
-    import json
-    
-    # Converter listas para JSON strings
-    mao_de_obra_json = json.dumps(relatorio.mao_de_obra) if relatorio.mao_de_obra else None
-    equipamentos_json = json.dumps(relatorio.equipamentos) if relatorio.equipamentos else None
-    atividades_json = json.dumps(relatorio.atividades) if relatorio.atividades else None
-    
+    _relatorio_cliente_permitido(db, current_user, relatorio.cliente_id)
     novo = RelatorioObras(
         cliente_id=relatorio.cliente_id,
         data_relatorio=relatorio.data_relatorio or datetime.datetime.utcnow(),
         tempo=relatorio.tempo,
         condicao=relatorio.condicao,
         indice_pluviometrico=relatorio.indice_pluviometrico,
-        mao_de_obra=mao_de_obra_json,
-        equipamentos=equipamentos_json,
-        atividades=atividades_json,
         criado_por=current_user.id
     )
+    _set_relatorio_itens(novo, relatorio)
     db.add(novo)
     db.commit()
     db.refresh(novo)
-    
-    # Converter de volta para listas no response
-    if novo.mao_de_obra:
-        novo.mao_de_obra = json.loads(novo.mao_de_obra)
-    if novo.equipamentos:
-        novo.equipamentos = json.loads(novo.equipamentos)
-    if novo.atividades:
-        novo.atividades = json.loads(novo.atividades)
-    
+    for tipo in _autocomplete_indexes:
+        _autocomplete_indexes[tipo].add_usage(getattr(relatorio, tipo) or [])
     return novo
 
 @app.put("/relatorios-obras/{relatorio_id}", response_model=RelatorioObrasSchema)
@@ -3128,11 +4129,11 @@ def atualizar_relatorio_obras(
     db: Session = Depends(get_db),
     current_user: Usuario = Depends(get_current_user)
 ):
-    import json
-    
     db_relatorio = db.query(RelatorioObras).filter(RelatorioObras.id == relatorio_id).first()
     if not db_relatorio:
         raise HTTPException(status_code=404, detail="Relatório não encontrado")
+    _relatorio_cliente_permitido(db, current_user, db_relatorio.cliente_id)
+    _relatorio_cliente_permitido(db, current_user, relatorio.cliente_id)
     
     # Atualizar campos
     db_relatorio.cliente_id = relatorio.cliente_id
@@ -3141,21 +4142,10 @@ def atualizar_relatorio_obras(
     db_relatorio.tempo = relatorio.tempo
     db_relatorio.condicao = relatorio.condicao
     db_relatorio.indice_pluviometrico = relatorio.indice_pluviometrico
-    db_relatorio.mao_de_obra = json.dumps(relatorio.mao_de_obra) if relatorio.mao_de_obra else None
-    db_relatorio.equipamentos = json.dumps(relatorio.equipamentos) if relatorio.equipamentos else None
-    db_relatorio.atividades = json.dumps(relatorio.atividades) if relatorio.atividades else None
+    _set_relatorio_itens(db_relatorio, relatorio)
     
     db.commit()
     db.refresh(db_relatorio)
-    
-    # Converter de volta para listas no response
-    if db_relatorio.mao_de_obra:
-        db_relatorio.mao_de_obra = json.loads(db_relatorio.mao_de_obra)
-    if db_relatorio.equipamentos:
-        db_relatorio.equipamentos = json.loads(db_relatorio.equipamentos)
-    if db_relatorio.atividades:
-        db_relatorio.atividades = json.loads(db_relatorio.atividades)
-    
     return db_relatorio
 
 @app.delete("/relatorios-obras/{relatorio_id}")
@@ -3163,19 +4153,135 @@ def deletar_relatorio_obras(relatorio_id: int, db: Session = Depends(get_db), cu
     db_relatorio = db.query(RelatorioObras).filter(RelatorioObras.id == relatorio_id).first()
     if not db_relatorio:
         raise HTTPException(status_code=404, detail="Relatório não encontrado")
+    _relatorio_cliente_permitido(db, current_user, db_relatorio.cliente_id)
     db.delete(db_relatorio)
     db.commit()
     return {"message": "Relatório deletado com sucesso"}
 
+# ========== Busca textual ==========
+# entidade → permissão de leitura exigida (None: qualquer usuário autenticado, como nas rotas da entidade)
+SEARCH_ENTITY_PERMISSIONS = {
+    "cliente": 1201,
+    "fornecedor": 1301,
+    "material": 1701,
+    "atividade": None,
+    "relatorio": None,
+}
+
+class SearchHitSchema(BaseModel):
+    entidade: str
+    id: int
+    cliente_id: Optional[int] = None
+    titulo: Optional[str] = None
+    trecho: Optional[str] = None
+    score: float
+
+def _can_read(db: Session, user: Usuario, base_id: int | None) -> bool:
+    # Mesma regra de _permission_required(base_id, "read"), sem levantar 403
+    if base_id is None or str(user.nivel_acesso or "").lower() in {"admin", "willians"}:
+        return True
+    if not user.grupo_id:
+        return False
+    return _permission_matrix.has(db, user.grupo_id, base_id + ACTION_OFFSETS.get("read", 0)) or _permission_matrix.has(db, user.grupo_id, base_id)
+
+@app.get("/search", response_model=List[SearchHitSchema])
+def buscar(
+    q: str = Query(..., min_length=1, description="Termos (todos devem aparecer; cada um vale como prefixo, sem acento)"),
+    entidades: Optional[str] = Query(None, description="Lista separada por vírgula: " + ",".join(SEARCH_ENTITY_PERMISSIONS)),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_read_db),
+    current_user: Usuario = Depends(get_current_user),
+):
+    """Busca em clientes, fornecedores, materiais, atividades e relatórios de obras, por relevância."""
+    pedidas = [e.strip() for e in entidades.split(",") if e.strip()] if entidades else list(SEARCH_ENTITY_PERMISSIONS)
+    invalidas = [e for e in pedidas if e not in SEARCH_ENTITY_PERMISSIONS]
+    if invalidas:
+        raise HTTPException(status_code=400, detail=f"Entidade(s) inválida(s): {', '.join(invalidas)}")
+    permitidas = [e for e in pedidas if _can_read(db, current_user, SEARCH_ENTITY_PERMISSIONS[e])]
+    return search_index.search(db.connection(), q, permitidas, _get_allowed_client_ids(db, current_user), limit)
+
+@app.post("/admin/search/rebuild")
+def admin_rebuild_search_index(current_user: Usuario = Depends(require_admin)):
+    """Reconstrói o índice de busca (ex.: após editar o banco fora da API com triggers desativados)."""
+    with engine.begin() as conn:
+        indexed = search_index.rebuild(conn)
+    return {"indexed": indexed}
+
 # ========== Históricos para Autocompletar ==========
+# Com ?q= as listagens respondem do índice de prefixo em memória (autocomplete.PrefixIndex),
+# sem acento/maiúsculas, ordenado pela frequência de uso nos relatórios de obras. O índice é
+# atualizado a cada create/delete deste processo e recarregado a cada AUTOCOMPLETE_TTL_SECONDS
+# (mudanças feitas por outros workers).
+AUTOCOMPLETE_TTL_SECONDS = float(os.getenv("AUTOCOMPLETE_TTL_SECONDS", "300"))
+AUTOCOMPLETE_DEFAULT_LIMIT = int(os.getenv("AUTOCOMPLETE_DEFAULT_LIMIT", "20"))
+_autocomplete_indexes = {
+    "mao_de_obra": autocomplete.PrefixIndex(),
+    "equipamentos": autocomplete.PrefixIndex(),
+    "atividades": autocomplete.PrefixIndex(),
+}
+
+def _autocomplete_config(tipo: str):
+    # (modelo do histórico, campo de texto, schema, tabela de uso nos relatórios, campo de uso)
+    return {
+        "mao_de_obra": (MaoDeObraHistorico, "nome", MaoDeObraHistoricoSchema, RelatorioObrasMaoDeObra, "nome"),
+        "equipamentos": (EquipamentoHistorico, "nome", EquipamentoHistoricoSchema, RelatorioObrasEquipamento, "nome"),
+        "atividades": (AtividadeHistorico, "descricao", AtividadeHistoricoSchema, RelatorioObrasAtividade, "descricao"),
+    }[tipo]
+
+def _autocomplete_payload(tipo: str, item) -> tuple:
+    _, campo, schema, _, _ = _autocomplete_config(tipo)
+    return item.id, getattr(item, campo), item.cliente_id, schema.model_validate(item).model_dump()
+
+def _autocomplete_index(db: Session, tipo: str) -> autocomplete.PrefixIndex:
+    index = _autocomplete_indexes[tipo]
+    if index.is_stale(AUTOCOMPLETE_TTL_SECONDS):
+        model, _, _, uso_model, uso_campo = _autocomplete_config(tipo)
+        coluna_uso = getattr(uso_model, uso_campo)
+        uso = dict(db.query(coluna_uso, func.count()).group_by(coluna_uso).all())
+        index.load((_autocomplete_payload(tipo, r) for r in db.query(model).all()), uso)
+    return index
+
+def _reset_autocomplete():
+    for index in _autocomplete_indexes.values():
+        index.reset()
+
+HISTORICO_LOTE_MAX = int(os.getenv("HISTORICO_LOTE_MAX", "500"))
+
+def _salvar_historico(db: Session, tipo: str, itens: list, user_id: int) -> list:
+    """Grava os itens ainda inexistentes e devolve as linhas (novas ou já existentes) na ordem de itens.
+
+    O dedupe é o índice único de chave (ver ensure_historico_chaves): um único
+    INSERT ... ON CONFLICT DO NOTHING para o lote, sem corrida entre requisições simultâneas.
+    Não faz commit.
+    """
+    if not itens:
+        return []
+    model = _autocomplete_config(tipo)[0]
+    rows = []
+    for item in itens:
+        dados = item.model_dump()
+        rows.append({**dados, "chave": historico_chave(model, dados), "criado_por": user_id})
+    db.execute(sqlite_insert(model).values(rows).on_conflict_do_nothing(index_elements=["chave"]))
+    por_chave = {r.chave: r for r in db.query(model).filter(model.chave.in_(list({r["chave"] for r in rows})))}
+    return [por_chave[r["chave"]] for r in rows]
+
+def _indexar_historico(tipo: str, salvos: list):
+    index = _autocomplete_indexes[tipo]
+    for item in {i.id: i for i in salvos}.values():
+        index.add(*_autocomplete_payload(tipo, item))
+
 
 # Mão de Obra Histórico
 @app.get("/mao-de-obra-historico/", response_model=List[MaoDeObraHistoricoSchema])
 def listar_mao_de_obra_historico(
     cliente_id: Optional[int] = None,
-    db: Session = Depends(get_db),
+    q: Optional[str] = Query(None, description="Autocompletar: prefixo (sem acento), mais usados primeiro"),
+    limit: int = Query(AUTOCOMPLETE_DEFAULT_LIMIT, ge=1, le=PAGINATION_MAX_LIMIT),
+    db: Session = Depends(get_read_db),
     current_user: Usuario = Depends(get_current_user)
 ):
+    if q is not None:
+        return _autocomplete_index(db, "mao_de_obra").search(q, cliente_id or None, limit)
     query = db.query(MaoDeObraHistorico)
     if cliente_id:
         query = query.filter(MaoDeObraHistorico.cliente_id == cliente_id)
@@ -3187,23 +4293,9 @@ def criar_mao_de_obra_historico(
     db: Session = Depends(get_db),
     current_user: Usuario = Depends(get_current_user)
 ):
-    # Verifica se já existe
-    existe = db.query(MaoDeObraHistorico).filter(
-        MaoDeObraHistorico.nome == item.nome,
-        MaoDeObraHistorico.cargo == item.cargo
-    ).first()
-    if existe:
-        return existe  # Retorna o existente
-    
-    novo = MaoDeObraHistorico(
-        nome=item.nome,
-        cargo=item.cargo,
-        cliente_id=item.cliente_id,
-        criado_por=current_user.id
-    )
-    db.add(novo)
+    novo = _salvar_historico(db, "mao_de_obra", [item], current_user.id)[0]
     db.commit()
-    db.refresh(novo)
+    _indexar_historico("mao_de_obra", [novo])
     return novo
 
 @app.delete("/mao-de-obra-historico/{item_id}")
@@ -3217,15 +4309,20 @@ def deletar_mao_de_obra_historico(
         raise HTTPException(status_code=404, detail="Item não encontrado")
     db.delete(item)
     db.commit()
+    _autocomplete_indexes["mao_de_obra"].remove(item_id)
     return {"message": "Item deletado com sucesso"}
 
 # Equipamentos Histórico
 @app.get("/equipamentos-historico/", response_model=List[EquipamentoHistoricoSchema])
 def listar_equipamentos_historico(
     cliente_id: Optional[int] = None,
-    db: Session = Depends(get_db),
+    q: Optional[str] = Query(None, description="Autocompletar: prefixo (sem acento), mais usados primeiro"),
+    limit: int = Query(AUTOCOMPLETE_DEFAULT_LIMIT, ge=1, le=PAGINATION_MAX_LIMIT),
+    db: Session = Depends(get_read_db),
     current_user: Usuario = Depends(get_current_user)
 ):
+    if q is not None:
+        return _autocomplete_index(db, "equipamentos").search(q, cliente_id or None, limit)
     query = db.query(EquipamentoHistorico)
     if cliente_id:
         query = query.filter(EquipamentoHistorico.cliente_id == cliente_id)
@@ -3237,22 +4334,9 @@ def criar_equipamento_historico(
     db: Session = Depends(get_db),
     current_user: Usuario = Depends(get_current_user)
 ):
-    # Verifica se já existe
-    existe = db.query(EquipamentoHistorico).filter(
-        EquipamentoHistorico.nome == item.nome
-    ).first()
-    if existe:
-        return existe
-    
-    novo = EquipamentoHistorico(
-        nome=item.nome,
-        descricao=item.descricao,
-        cliente_id=item.cliente_id,
-        criado_por=current_user.id
-    )
-    db.add(novo)
+    novo = _salvar_historico(db, "equipamentos", [item], current_user.id)[0]
     db.commit()
-    db.refresh(novo)
+    _indexar_historico("equipamentos", [novo])
     return novo
 
 @app.delete("/equipamentos-historico/{item_id}")
@@ -3266,6 +4350,7 @@ def deletar_equipamento_historico(
         raise HTTPException(status_code=404, detail="Item não encontrado")
     db.delete(item)
     db.commit()
+    _autocomplete_indexes["equipamentos"].remove(item_id)
     return {"message": "Item deletado com sucesso"}
 
 # Atividades Histórico
@@ -3273,9 +4358,14 @@ def deletar_equipamento_historico(
 def listar_atividades_historico(
     cliente_id: Optional[int] = None,
     categoria: Optional[str] = None,
-    db: Session = Depends(get_db),
+    q: Optional[str] = Query(None, description="Autocompletar: prefixo (sem acento), mais usados primeiro"),
+    limit: int = Query(AUTOCOMPLETE_DEFAULT_LIMIT, ge=1, le=PAGINATION_MAX_LIMIT),
+    db: Session = Depends(get_read_db),
     current_user: Usuario = Depends(get_current_user)
 ):
+    if q is not None:
+        predicate = (lambda item: item["categoria"] == categoria) if categoria else None
+        return _autocomplete_index(db, "atividades").search(q, cliente_id or None, limit, predicate)
     query = db.query(AtividadeHistorico)
     if cliente_id:
         query = query.filter(AtividadeHistorico.cliente_id == cliente_id)
@@ -3289,22 +4379,9 @@ def criar_atividade_historico(
     db: Session = Depends(get_db),
     current_user: Usuario = Depends(get_current_user)
 ):
-    # Verifica se já existe
-    existe = db.query(AtividadeHistorico).filter(
-        AtividadeHistorico.descricao == item.descricao
-    ).first()
-    if existe:
-        return existe
-    
-    novo = AtividadeHistorico(
-        descricao=item.descricao,
-        categoria=item.categoria,
-        cliente_id=item.cliente_id,
-        criado_por=current_user.id
-    )
-    db.add(novo)
+    novo = _salvar_historico(db, "atividades", [item], current_user.id)[0]
     db.commit()
-    db.refresh(novo)
+    _indexar_historico("atividades", [novo])
     return novo
 
 @app.delete("/atividades-historico/{item_id}")
@@ -3318,15 +4395,37 @@ def deletar_atividade_historico(
         raise HTTPException(status_code=404, detail="Item não encontrado")
     db.delete(item)
     db.commit()
+    _autocomplete_indexes["atividades"].remove(item_id)
     return {"message": "Item deletado com sucesso"}
 
+@app.post("/historicos/lote", response_model=HistoricoLoteSchema)
+def salvar_historicos_lote(
+    lote: HistoricoLoteCreate,
+    db: Session = Depends(get_db),
+    current_user: Usuario = Depends(get_current_user)
+):
+    """Grava de uma vez a mão de obra, os equipamentos e as atividades de um relatório.
+
+    Mesmo dedupe dos POSTs individuais, numa única transação; cada lista da resposta
+    corresponde, na mesma ordem, à lista enviada (itens repetidos devolvem o mesmo registro).
+    """
+    tipos = ("mao_de_obra", "equipamentos", "atividades")
+    total = sum(len(getattr(lote, t)) for t in tipos)
+    if total > HISTORICO_LOTE_MAX:
+        raise HTTPException(status_code=400, detail=f"Lote com {total} itens; máximo {HISTORICO_LOTE_MAX}")
+    salvos = {t: _salvar_historico(db, t, getattr(lote, t), current_user.id) for t in tipos}
+    db.commit()
+    for t in tipos:
+        _indexar_historico(t, salvos[t])
+    return salvos
+
 # Condições Climáticas Histórico
 @app.get("/condicoes-climaticas-historico/", response_model=List[CondicaoClimaticaHistoricoSchema])
 def listar_condicoes_climaticas_historico(
     cliente_id: Optional[int] = None,
     data_inicio: Optional[datetime.date] = None,
     data_fim: Optional[datetime.date] = None,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: Usuario = Depends(get_current_user)
 ):
     query = db.query(CondicaoClimaticaHistorico)
@@ -3374,8 +4473,9 @@ def deletar_condicao_climatica_historico(
 
 # Valor de Materiais
 @app.get("/valor_materiais/", response_model=List[ValorMaterialSchema])
-def listar_valor_materiais(db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1701, "read"))):
-    return db.query(ValorMaterial).all()
+def listar_valor_materiais(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(_permission_required(1701, "read"))):
+    q = _apply_list_filters(db.query(ValorMaterial), params, cliente_cols=(ValorMaterial.cliente_id,))
+    return _paginate(q, params, response, ValorMaterial.id)
 
 @app.post("/valor_materiais/", response_model=ValorMaterialSchema)
 def criar_valor_material(material: ValorMaterialSchema, db: Session = Depends(get_db), current_user: Usuario = Depends(_permission_required(1701, "create"))):
@@ -3385,19 +4485,101 @@ def criar_valor_material(material: ValorMaterialSchema, db: Session = Depends(ge
     db.refresh(novo)
     return novo
 
+# Ingestão de mídias (fotos/vídeos dos testes)
+# Cópia em blocos fora do event loop, limite de tamanho aplicado durante a cópia,
+# fsync e rename atômico para o diretório final (nunca fica arquivo parcial com nome válido).
+MEDIA_CHUNK_BYTES = 1024 * 1024
+MEDIA_MAX_VIDEO_BYTES = int(os.getenv("MEDIA_MAX_VIDEO_BYTES", str(10 * 1024 * 1024)))  # 10MB, igual ao frontend
+# Corpo inteiro de POST/PUT /testes-loja e /testes-ar-condicionado (foto + vídeo + campos),
+# recusado antes de ser lido (MediaUploadLimitMiddleware); 0 = sem limite
+MEDIA_MAX_REQUEST_BYTES = int(os.getenv("MEDIA_MAX_REQUEST_BYTES", "0"))
+
+# Miniaturas/pôsteres (media.py) gerados fora da requisição
+MEDIA_DERIVATIVE_WORKERS = int(os.getenv("MEDIA_DERIVATIVE_WORKERS", "1"))
+_media_executor = ThreadPoolExecutor(max_workers=MEDIA_DERIVATIVE_WORKERS, thread_name_prefix="media-derivs")
+
+def _schedule_media_derivatives(dest_dir: str, filename: str) -> None:
+    try:
+        _media_executor.submit(media.generate_derivatives, dest_dir, filename)
+    except RuntimeError:
+        # Executor encerrado (shutdown); o backfill da próxima inicialização gera
+        pass
+
+class MediaTooLarge(Exception):
+    pass
+
+def _write_media_file(src, dest_dir: str, final_name: str, max_bytes: int | None) -> None:
+    tmp_path = os.path.join(dest_dir, f".{final_name}.part")
+    written = 0
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = src.read(MEDIA_CHUNK_BYTES)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if max_bytes is not None and written > max_bytes:
+                    raise MediaTooLarge()
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, os.path.join(dest_dir, final_name))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    try:
+        # Persistir a entrada do diretório (rename) em caso de queda de energia
+        dir_fd = os.open(dest_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+async def save_media_upload(upload: UploadFile, dest_dir: str, max_bytes: int | None = None, label: str = "arquivo") -> str:
+    """Grava o upload em dest_dir com nome único (uuid + extensão original) e retorna o nome.
+
+    Levanta 413 se max_bytes for excedido (antes de copiar, quando o tamanho já é conhecido,
+    ou no meio da cópia). O UploadFile já foi recebido por inteiro nesse ponto; o corte antes
+    do recebimento é feito por MediaUploadLimitMiddleware.
+    """
+    if max_bytes is not None and upload.size is not None and upload.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"O {label} não pode exceder {max_bytes // (1024 * 1024)}MB")
+    file_extension = os.path.splitext(upload.filename or "")[1]
+    unique_filename = f"{uuid.uuid4()}{file_extension}"
+    try:
+        await upload.seek(0)
+        await run_in_threadpool(_write_media_file, upload.file, dest_dir, unique_filename, max_bytes)
+    except MediaTooLarge:
+        raise HTTPException(status_code=413, detail=f"O {label} não pode exceder {max_bytes // (1024 * 1024)}MB")
+    _schedule_media_derivatives(dest_dir, unique_filename)
+    return unique_filename
+
+def _remove_media_file(dest_dir: str, filename: str | None) -> None:
+    if not filename:
+        return
+    old_file_path = os.path.join(dest_dir, filename)
+    if os.path.exists(old_file_path):
+        os.remove(old_file_path)
+    media.remove_derivatives(dest_dir, filename)
+
 # Testes de Loja
 @app.get("/testes-loja/", response_model=List[TesteLojaSchema])
-def listar_testes_loja(db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
+def listar_testes_loja(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(get_current_user)):
     allowed = _get_allowed_client_ids(db, current_user)
     q = db.query(TesteLoja)
-    if allowed is not None and len(allowed) > 0:
+    if allowed is not None:
+        # Lista vazia => IN () sempre falso (nenhum teste visível)
         q = q.filter(TesteLoja.cliente_id.in_(allowed))
-    elif allowed is not None and len(allowed) == 0:
-        return []
-    return q.all()
+    q = _apply_list_filters(q, params, cliente_cols=(TesteLoja.cliente_id,), date_col=TesteLoja.data_teste, status_col=TesteLoja.status)
+    return _paginate(q, params, response, TesteLoja.id, date_col=TesteLoja.data_teste)
 
 @app.get("/testes-loja/{teste_id}", response_model=TesteLojaSchema)
-def obter_teste_loja(teste_id: int, db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
+def obter_teste_loja(teste_id: int, db: Session = Depends(get_read_db), current_user: Usuario = Depends(get_current_user)):
     teste = db.query(TesteLoja).filter(TesteLoja.id == teste_id).first()
     if not teste:
         raise HTTPException(status_code=404, detail="Teste não encontrado")
@@ -3422,41 +4604,26 @@ async def criar_teste_loja(
     allowed = _get_allowed_client_ids(db, current_user)
     if allowed is not None and cliente_id not in allowed:
         raise HTTPException(status_code=403, detail="Sem acesso a este cliente")
-    # Criar teste primeiro
+    # Salvar arquivos se fornecidos (antes do registro: vídeo acima do limite não cria teste)
+    foto_nome = await save_media_upload(foto, TESTES_LOJA_DIR, label="arquivo de foto") if foto else None
+    try:
+        video_nome = await save_media_upload(video, TESTES_LOJA_DIR, MEDIA_MAX_VIDEO_BYTES, "arquivo de vídeo") if video else None
+    except HTTPException:
+        _remove_media_file(TESTES_LOJA_DIR, foto_nome)
+        raise
+
     novo_teste = TesteLoja(
         data_teste=datetime.datetime.strptime(data_teste, "%Y-%m-%d").date(),
         cliente_id=cliente_id,
         horario=datetime.datetime.strptime(horario, "%H:%M").time(),
         status=status,
-        observacao=observacao
+        observacao=observacao,
+        foto=foto_nome,
+        video=video_nome,
     )
     db.add(novo_teste)
     db.commit()
     db.refresh(novo_teste)
-    
-    # Salvar arquivos se fornecidos
-    if foto:
-        file_extension = os.path.splitext(foto.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(TESTES_LOJA_DIR, unique_filename)
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(foto.file, buffer)
-        
-        novo_teste.foto = unique_filename
-    
-    if video:
-        file_extension = os.path.splitext(video.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(TESTES_LOJA_DIR, unique_filename)
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        
-        novo_teste.video = unique_filename
-    
-    db.commit()
-    db.refresh(novo_teste)
     return novo_teste
 
 @app.put("/testes-loja/{teste_id}", response_model=TesteLojaSchema)
@@ -3489,37 +4656,15 @@ async def atualizar_teste_loja(
     
     # Salvar novos arquivos se fornecidos
     if foto and foto.filename:
-        # Remover arquivo antigo se existir
-        if teste_db.foto:
-            old_file_path = os.path.join(TESTES_LOJA_DIR, teste_db.foto)
-            if os.path.exists(old_file_path):
-                os.remove(old_file_path)
-        
-        # Salvar novo arquivo
-        file_extension = os.path.splitext(foto.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(TESTES_LOJA_DIR, unique_filename)
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(foto.file, buffer)
-        
+        # Salvar novo arquivo e só então remover o antigo
+        unique_filename = await save_media_upload(foto, TESTES_LOJA_DIR, label="arquivo de foto")
+        _remove_media_file(TESTES_LOJA_DIR, teste_db.foto)
         teste_db.foto = unique_filename
     
     if video and video.filename:
-        # Remover arquivo antigo se existir
-        if teste_db.video:
-            old_file_path = os.path.join(TESTES_LOJA_DIR, teste_db.video)
-            if os.path.exists(old_file_path):
-                os.remove(old_file_path)
-        
-        # Salvar novo arquivo
-        file_extension = os.path.splitext(video.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(TESTES_LOJA_DIR, unique_filename)
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        
+        # Salvar novo arquivo e só então remover o antigo
+        unique_filename = await save_media_upload(video, TESTES_LOJA_DIR, MEDIA_MAX_VIDEO_BYTES, "arquivo de vídeo")
+        _remove_media_file(TESTES_LOJA_DIR, teste_db.video)
         teste_db.video = unique_filename
     
     db.commit()
@@ -3542,14 +4687,14 @@ def deletar_teste_loja(teste_id: int, db: Session = Depends(get_db), current_use
 
 # Testes de Ar Condicionado
 @app.get("/testes-ar-condicionado/", response_model=List[TesteArCondicionadoSchema])
-def listar_testes_ar_condicionado(db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
+def listar_testes_ar_condicionado(response: Response, params: ListParams = Depends(list_params), db: Session = Depends(get_read_db), current_user: Usuario = Depends(get_current_user)):
     allowed = _get_allowed_client_ids(db, current_user)
     q = db.query(TesteArCondicionado)
-    if allowed is not None and len(allowed) > 0:
+    if allowed is not None:
+        # Lista vazia => IN () sempre falso (nenhum teste visível)
         q = q.filter(TesteArCondicionado.cliente_id.in_(allowed))
-    elif allowed is not None and len(allowed) == 0:
-        return []
-    return q.all()
+    q = _apply_list_filters(q, params, cliente_cols=(TesteArCondicionado.cliente_id,), date_col=TesteArCondicionado.data_teste, status_col=TesteArCondicionado.status)
+    return _paginate(q, params, response, TesteArCondicionado.id, date_col=TesteArCondicionado.data_teste)
 
 @app.post("/testes-ar-condicionado/", response_model=TesteArCondicionadoSchema)
 async def criar_teste_ar_condicionado(
@@ -3567,41 +4712,26 @@ async def criar_teste_ar_condicionado(
     allowed = _get_allowed_client_ids(db, current_user)
     if allowed is not None and cliente_id not in allowed:
         raise HTTPException(status_code=403, detail="Sem acesso a este cliente")
-    # Criar teste primeiro
+    # Salvar arquivos se fornecidos (antes do registro: vídeo acima do limite não cria teste)
+    foto_nome = await save_media_upload(foto, TESTES_AR_CONDICIONADO_DIR, label="arquivo de foto") if foto else None
+    try:
+        video_nome = await save_media_upload(video, TESTES_AR_CONDICIONADO_DIR, MEDIA_MAX_VIDEO_BYTES, "arquivo de vídeo") if video else None
+    except HTTPException:
+        _remove_media_file(TESTES_AR_CONDICIONADO_DIR, foto_nome)
+        raise
+
     novo_teste = TesteArCondicionado(
         data_teste=datetime.datetime.strptime(data_teste, "%Y-%m-%d").date(),
         cliente_id=cliente_id,
         horario=datetime.datetime.strptime(horario, "%H:%M").time(),
         status=status,
-        observacao=observacao
+        observacao=observacao,
+        foto=foto_nome,
+        video=video_nome,
     )
     db.add(novo_teste)
     db.commit()
     db.refresh(novo_teste)
-    
-    # Salvar arquivos se fornecidos
-    if foto:
-        file_extension = os.path.splitext(foto.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(TESTES_AR_CONDICIONADO_DIR, unique_filename)
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(foto.file, buffer)
-        
-        novo_teste.foto = unique_filename
-    
-    if video:
-        file_extension = os.path.splitext(video.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(TESTES_AR_CONDICIONADO_DIR, unique_filename)
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        
-        novo_teste.video = unique_filename
-    
-    db.commit()
-    db.refresh(novo_teste)
     return novo_teste
 
 @app.put("/testes-ar-condicionado/{teste_id}", response_model=TesteArCondicionadoSchema)
@@ -3634,37 +4764,15 @@ async def atualizar_teste_ar_condicionado(
     
     # Salvar novos arquivos se fornecidos
     if foto and foto.filename:
-        # Remover arquivo antigo se existir
-        if teste_db.foto:
-            old_file_path = os.path.join(TESTES_AR_CONDICIONADO_DIR, teste_db.foto)
-            if os.path.exists(old_file_path):
-                os.remove(old_file_path)
-        
-        # Salvar novo arquivo
-        file_extension = os.path.splitext(foto.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(TESTES_AR_CONDICIONADO_DIR, unique_filename)
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(foto.file, buffer)
-        
+        # Salvar novo arquivo e só então remover o antigo
+        unique_filename = await save_media_upload(foto, TESTES_AR_CONDICIONADO_DIR, label="arquivo de foto")
+        _remove_media_file(TESTES_AR_CONDICIONADO_DIR, teste_db.foto)
         teste_db.foto = unique_filename
     
     if video and video.filename:
-        # Remover arquivo antigo se existir
-        if teste_db.video:
-            old_file_path = os.path.join(TESTES_AR_CONDICIONADO_DIR, teste_db.video)
-            if os.path.exists(old_file_path):
-                os.remove(old_file_path)
-        
-        # Salvar novo arquivo
-        file_extension = os.path.splitext(video.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(TESTES_AR_CONDICIONADO_DIR, unique_filename)
-        
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
-        
+        # Salvar novo arquivo e só então remover o antigo
+        unique_filename = await save_media_upload(video, TESTES_AR_CONDICIONADO_DIR, MEDIA_MAX_VIDEO_BYTES, "arquivo de vídeo")
+        _remove_media_file(TESTES_AR_CONDICIONADO_DIR, teste_db.video)
         teste_db.video = unique_filename
     
     db.commit()
@@ -3685,6 +4793,22 @@ def deletar_teste_ar_condicionado(teste_id: int, db: Session = Depends(get_db),
     db.commit()
     return {"message": "Teste deletado com sucesso"}
 
+# GC de mídias (ver collect_media_garbage)
+@app.get("/admin/media/gc")
+def media_gc_report(grace_hours: float | None = Query(None, ge=0), db: Session = Depends(get_read_db), current_user: Usuario = Depends(require_admin)):
+    """Relatório (dry run) de mídias órfãs e referências sem arquivo."""
+    return collect_media_garbage(db, dry_run=True, grace_hours=grace_hours)
+
+@app.post("/admin/media/gc")
+def media_gc_run(
+    grace_hours: float | None = Query(None, ge=0),
+    force: bool = Query(False, description="Ignora a trava de segurança (banco sem referências / muitos órfãos)"),
+    db: Session = Depends(get_read_db),
+    current_user: Usuario = Depends(require_admin),
+):
+    """Remove as mídias órfãs mais antigas que a carência (diretórios recusados ficam com "refused")."""
+    return collect_media_garbage(db, dry_run=False, grace_hours=grace_hours, force=force)
+
 # Rotas de Upload para Testes
 @app.post("/upload/testes-loja/foto/{teste_id}")
 async def upload_foto_teste_loja(teste_id: int, file: UploadFile = File(...), db: Session = Depends(get_db), current_user: Usuario = Depends(get_current_user)):
@@ -3698,14 +4822,8 @@ async def upload_foto_teste_loja(teste_id: int, file: UploadFile = File(...), db
     if allowed is not None and teste.cliente_id not in allowed:
         raise HTTPException(status_code=403, detail="Sem acesso a este cliente")
 
-    # Gerar nome único para o arquivo
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(TESTES_LOJA_DIR, unique_filename)
-    
-    # Salvar arquivo
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Salvar arquivo (nome único, gravação atômica)
+    unique_filename = await save_media_upload(file, TESTES_LOJA_DIR, label="arquivo de foto")
     
     # Atualizar teste no banco
     teste.foto = unique_filename
@@ -3725,14 +4843,8 @@ async def upload_video_teste_loja(teste_id: int, file: UploadFile = File(...), d
     if allowed is not None and teste.cliente_id not in allowed:
         raise HTTPException(status_code=403, detail="Sem acesso a este cliente")
 
-    # Gerar nome único para o arquivo
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(TESTES_LOJA_DIR, unique_filename)
-    
-    # Salvar arquivo
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Salvar arquivo (nome único, gravação atômica)
+    unique_filename = await save_media_upload(file, TESTES_LOJA_DIR, MEDIA_MAX_VIDEO_BYTES, "arquivo de vídeo")
     
     # Atualizar teste no banco
     teste.video = unique_filename
@@ -3752,14 +4864,8 @@ async def upload_foto_teste_ar_condicionado(teste_id: int, file: UploadFile = Fi
     if allowed is not None and teste.cliente_id not in allowed:
         raise HTTPException(status_code=403, detail="Sem acesso a este cliente")
 
-    # Gerar nome único para o arquivo
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(TESTES_AR_CONDICIONADO_DIR, unique_filename)
-    
-    # Salvar arquivo
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Salvar arquivo (nome único, gravação atômica)
+    unique_filename = await save_media_upload(file, TESTES_AR_CONDICIONADO_DIR, label="arquivo de foto")
     
     # Atualizar teste no banco
     teste.foto = unique_filename
@@ -3779,14 +4885,8 @@ async def upload_video_teste_ar_condicionado(teste_id: int, file: UploadFile = F
     if allowed is not None and teste.cliente_id not in allowed:
         raise HTTPException(status_code=403, detail="Sem acesso a este cliente")
 
-    # Gerar nome único para o arquivo
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(TESTES_AR_CONDICIONADO_DIR, unique_filename)
-    
-    # Salvar arquivo
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # Salvar arquivo (nome único, gravação atômica)
+    unique_filename = await save_media_upload(file, TESTES_AR_CONDICIONADO_DIR, MEDIA_MAX_VIDEO_BYTES, "arquivo de vídeo")
     
     # Atualizar teste no banco
     teste.video = unique_filename
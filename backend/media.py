@@ -0,0 +1,195 @@
+"""Derivados das mídias dos testes (miniaturas de fotos e pôster de vídeos).
+
+Gerados em background depois do upload e gravados ao lado dos originais, em
+<dir da mídia>/thumbs/, servidos pelos mesmos StaticFiles de /uploads/testes-*.
+Dependências opcionais: Pillow (miniaturas) e o binário ffmpeg (pôster de vídeo);
+sem elas os derivados simplesmente não são gerados e as URLs ficam nulas.
+"""
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except ImportError:  # Pillow não instalado
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+THUMB_DIRNAME = "thumbs"
+MEDIA_THUMB_SIZE = int(os.getenv("MEDIA_THUMB_SIZE", "320"))  # lado maior, em px
+MEDIA_THUMB_QUALITY = int(os.getenv("MEDIA_THUMB_QUALITY", "80"))
+FFMPEG_BIN = os.getenv("FFMPEG_BIN") or shutil.which("ffmpeg")
+FFMPEG_TIMEOUT_SECONDS = int(os.getenv("FFMPEG_TIMEOUT_SECONDS", "30"))
+
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+VIDEO_EXTS = {".mp4", ".mov", ".m4v", ".webm", ".avi", ".mkv", ".3gp"}
+
+# kind → sufixo do arquivo derivado
+_SUFFIX = {"thumb": ".jpg", "poster": ".poster.jpg"}
+
+
+def derivative_name(filename: str, kind: str) -> str:
+    return os.path.splitext(filename)[0] + _SUFFIX[kind]
+
+
+def derivative_path(media_dir: str, filename: str, kind: str) -> str:
+    return os.path.join(media_dir, THUMB_DIRNAME, derivative_name(filename, kind))
+
+
+def derivative_url(media_dir: str, url_prefix: str, filename: str | None, kind: str) -> str | None:
+    """URL relativa do derivado (ex.: /uploads/testes-loja/thumbs/<uuid>.jpg) se já existir."""
+    if not filename:
+        return None
+    if not os.path.exists(derivative_path(media_dir, filename, kind)):
+        return None
+    return f"{url_prefix}/{THUMB_DIRNAME}/{derivative_name(filename, kind)}"
+
+
+def _kind_for(filename: str) -> str | None:
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in IMAGE_EXTS:
+        return "thumb" if Image is not None else None
+    if ext in VIDEO_EXTS:
+        return "poster" if FFMPEG_BIN else None
+    return None
+
+
+def _make_image_thumb(src: str, dest: str) -> None:
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)  # fotos de celular vêm rotacionadas via EXIF
+        im.thumbnail((MEDIA_THUMB_SIZE, MEDIA_THUMB_SIZE))
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        im.save(dest, "JPEG", quality=MEDIA_THUMB_QUALITY, optimize=True, progressive=True)
+
+
+def _make_video_poster(src: str, dest: str) -> None:
+    size = MEDIA_THUMB_SIZE
+    subprocess.run(
+        [
+            FFMPEG_BIN, "-nostdin", "-loglevel", "error", "-y",
+            "-i", src,
+            "-frames:v", "1",
+            "-vf", f"scale='min({size},iw)':-2",
+            "-f", "image2", "-c:v", "mjpeg",
+            dest,
+        ],
+        check=True,
+        timeout=FFMPEG_TIMEOUT_SECONDS,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+
+def generate_derivatives(media_dir: str, filename: str) -> str | None:
+    """Gera o derivado de uma mídia (idempotente). Retorna o caminho gerado ou None."""
+    kind = _kind_for(filename)
+    if kind is None:
+        return None
+    src = os.path.join(media_dir, filename)
+    dest = derivative_path(media_dir, filename, kind)
+    if os.path.exists(dest) or not os.path.exists(src):
+        return None
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".thumb-", suffix=".jpg", dir=os.path.dirname(dest))
+    os.close(fd)
+    try:
+        if kind == "thumb":
+            _make_image_thumb(src, tmp)
+        else:
+            _make_video_poster(src, tmp)
+        os.replace(tmp, dest)
+        return dest
+    except Exception as e:
+        logger.warning("[MEDIA] Falha ao gerar %s de %s: %s", kind, filename, e)
+        return None
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def remove_derivatives(media_dir: str, filename: str | None) -> None:
+    if not filename:
+        return
+    for kind in _SUFFIX:
+        try:
+            os.remove(derivative_path(media_dir, filename, kind))
+        except OSError:
+            pass
+
+
+def missing_derivatives(media_dir: str) -> list[str]:
+    """Mídias do diretório que ainda não têm derivado (para o backfill na inicialização)."""
+    try:
+        names = os.listdir(media_dir)
+    except OSError:
+        return []
+    out = []
+    for fn in names:
+        if fn.startswith(".") or not os.path.isfile(os.path.join(media_dir, fn)):
+            continue
+        kind = _kind_for(fn)
+        if kind and not os.path.exists(derivative_path(media_dir, fn, kind)):
+            out.append(fn)
+    return out
+
+
+def sweep_orphans(media_dir: str, referenced: set[str], grace_seconds: int, dry_run: bool = True) -> dict:
+    """Varredura do GC de mídias: arquivos do diretório (e derivados em thumbs/) sem referência no banco.
+
+    Órfãos com mtime mais antigo que grace_seconds são apagados (exceto em dry_run); os mais
+    novos ficam como "pending" (podem ser de um upload cuja linha ainda não foi gravada).
+    Também recolhe temporários .part abandonados.
+    """
+    cutoff = time.time() - grace_seconds
+    report = {"orphans": [], "pending": [], "deleted": [], "bytes_freed": 0}
+
+    def _visit(path: str, rel: str, is_orphan: bool) -> None:
+        if not is_orphan:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if st.st_mtime > cutoff:
+            report["pending"].append(rel)
+            return
+        report["orphans"].append(rel)
+        if dry_run:
+            return
+        try:
+            os.remove(path)
+            report["deleted"].append(rel)
+            report["bytes_freed"] += st.st_size
+        except OSError as e:
+            logger.warning("[MEDIA GC] Falha ao remover %s: %s", path, e)
+
+    try:
+        entries = list(os.scandir(media_dir))
+    except OSError:
+        return report
+    for entry in entries:
+        if entry.is_dir():
+            continue
+        name = entry.name
+        if name.startswith("."):
+            # .<nome>.part de ingestão interrompida
+            _visit(entry.path, name, name.endswith(".part"))
+            continue
+        _visit(entry.path, name, name not in referenced)
+
+    thumbs_dir = os.path.join(media_dir, THUMB_DIRNAME)
+    live_derivatives = {derivative_name(fn, kind) for fn in referenced for kind in _SUFFIX}
+    try:
+        thumb_entries = list(os.scandir(thumbs_dir))
+    except OSError:
+        thumb_entries = []
+    for entry in thumb_entries:
+        if entry.is_file():
+            _visit(entry.path, f"{THUMB_DIRNAME}/{entry.name}", entry.name not in live_derivatives)
+    return report
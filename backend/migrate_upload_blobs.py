@@ -0,0 +1,36 @@
+from sqlalchemy import text
+
+import blobstore
+from database import DB_PATH, engine
+
+
+def migrate_upload_blobs(vacuum: bool = True):
+    """Move o conteúdo de arquivos_importados.conteudo para o blob store e compacta o banco.
+
+    A API já faz a migração ao iniciar; este script permite rodá-la fora do servidor
+    e executar o VACUUM (que devolve o espaço dos blobs ao sistema de arquivos).
+    """
+    print(f"Banco: {DB_PATH}")
+    print(f"Blob store: {blobstore.BLOB_STORE_DIR}")
+    with engine.begin() as conn:
+        cols = [row[1] for row in conn.execute(text("PRAGMA table_info(arquivos_importados)")).fetchall()]
+        if not cols:
+            print("Tabela arquivos_importados não encontrada.")
+            return
+        if "sha256" not in cols:
+            print("Adicionando coluna 'sha256' em arquivos_importados...")
+            conn.execute(text("ALTER TABLE arquivos_importados ADD COLUMN sha256 VARCHAR(64)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_arquivos_importados_sha256 ON arquivos_importados(sha256)"))
+
+    moved = blobstore.migrate_db_blobs(engine)
+    print(f"{moved} arquivo(s) movido(s) para o blob store.")
+
+    if vacuum and moved:
+        print("Executando VACUUM...")
+        with engine.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+        print("VACUUM concluído.")
+
+
+if __name__ == "__main__":
+    migrate_upload_blobs()
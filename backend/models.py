@@ -1,7 +1,7 @@
 
 from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, DECIMAL, Boolean, LargeBinary, DateTime, Text, Time
 from datetime import datetime
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.orm import declarative_base, relationship, deferred
 
 Base = declarative_base()
 
@@ -175,7 +175,9 @@ class ArquivoImportado(Base):
     id = Column(Integer, primary_key=True, index=True)
     nome = Column(String, nullable=False)
     entidade = Column(String, nullable=False)
-    conteudo = Column(LargeBinary, nullable=False)
+    # Legado: conteúdo agora fica no blob store (blobstore.py); a coluna fica vazia (x'')
+    conteudo = deferred(Column(LargeBinary, nullable=True))
+    sha256 = Column(String(64), nullable=True, index=True)
     tamanho = Column(Integer, nullable=False)
     criado_em = Column(DateTime, default=datetime.utcnow)
 
@@ -249,14 +251,62 @@ class RelatorioObras(Base):
     tempo = Column(String, nullable=True)  # 'manha', 'tarde', 'noite'
     condicao = Column(String, nullable=True)  # 'manha', 'tarde', 'noite' (condição climática)
     indice_pluviometrico = Column(Float, nullable=True)  # Quantidade em mm
-    mao_de_obra = Column(Text, nullable=True)  # JSON string array
-    equipamentos = Column(Text, nullable=True)  # JSON string array
-    atividades = Column(Text, nullable=True)  # JSON string array
+    # Colunas legadas (JSON string array): os itens ficam nas tabelas filhas abaixo; o
+    # conteúdo antigo é migrado na inicialização e a coluna volta a NULL
+    mao_de_obra_json = Column("mao_de_obra", Text, nullable=True)
+    equipamentos_json = Column("equipamentos", Text, nullable=True)
+    atividades_json = Column("atividades", Text, nullable=True)
     criado_em = Column(DateTime, default=datetime.utcnow)
     criado_por = Column(Integer, ForeignKey("usuarios.id"), nullable=True)
     
     # Relacionamento com cliente
     cliente = relationship("Cliente")
+    mao_de_obra_itens = relationship(
+        "RelatorioObrasMaoDeObra", order_by="RelatorioObrasMaoDeObra.posicao", cascade="all, delete-orphan"
+    )
+    equipamentos_itens = relationship(
+        "RelatorioObrasEquipamento", order_by="RelatorioObrasEquipamento.posicao", cascade="all, delete-orphan"
+    )
+    atividades_itens = relationship(
+        "RelatorioObrasAtividade", order_by="RelatorioObrasAtividade.posicao", cascade="all, delete-orphan"
+    )
+
+    # Listas de texto (formato da API)
+    @property
+    def mao_de_obra(self):
+        return [i.nome for i in self.mao_de_obra_itens] or None
+
+    @property
+    def equipamentos(self):
+        return [i.nome for i in self.equipamentos_itens] or None
+
+    @property
+    def atividades(self):
+        return [i.descricao for i in self.atividades_itens] or None
+
+# Itens dos relatórios de obras (um por linha, na ordem informada). NOCASE: buscas por nome
+# ignoram maiúsculas/minúsculas usando o próprio índice.
+
+class RelatorioObrasMaoDeObra(Base):
+    __tablename__ = "relatorios_obras_mao_de_obra"
+    id = Column(Integer, primary_key=True)
+    relatorio_id = Column(Integer, ForeignKey("relatorios_obras.id", ondelete="CASCADE"), nullable=False, index=True)
+    posicao = Column(Integer, nullable=False, default=0)
+    nome = Column(String(collation="NOCASE"), nullable=False, index=True)
+
+class RelatorioObrasEquipamento(Base):
+    __tablename__ = "relatorios_obras_equipamentos"
+    id = Column(Integer, primary_key=True)
+    relatorio_id = Column(Integer, ForeignKey("relatorios_obras.id", ondelete="CASCADE"), nullable=False, index=True)
+    posicao = Column(Integer, nullable=False, default=0)
+    nome = Column(String(collation="NOCASE"), nullable=False, index=True)
+
+class RelatorioObrasAtividade(Base):
+    __tablename__ = "relatorios_obras_atividades"
+    id = Column(Integer, primary_key=True)
+    relatorio_id = Column(Integer, ForeignKey("relatorios_obras.id", ondelete="CASCADE"), nullable=False, index=True)
+    posicao = Column(Integer, nullable=False, default=0)
+    descricao = Column(Text(collation="NOCASE"), nullable=False, index=True)
 
 # Tabelas de histórico/templates para autocompletar
 
@@ -265,6 +315,7 @@ class MaoDeObraHistorico(Base):
     id = Column(Integer, primary_key=True, index=True)
     nome = Column(String, nullable=False)
     cargo = Column(String, nullable=True)
+    chave = Column(String, nullable=True, unique=True, index=True)  # texto normalizado (dedupe)
     cliente_id = Column(Integer, ForeignKey("clientes.id"), nullable=True)  # Opcional: vincular a cliente
     criado_em = Column(DateTime, default=datetime.utcnow)
     criado_por = Column(Integer, ForeignKey("usuarios.id"), nullable=True)
@@ -277,6 +328,7 @@ class EquipamentoHistorico(Base):
     id = Column(Integer, primary_key=True, index=True)
     nome = Column(String, nullable=False)
     descricao = Column(Text, nullable=True)
+    chave = Column(String, nullable=True, unique=True, index=True)  # texto normalizado (dedupe)
     cliente_id = Column(Integer, ForeignKey("clientes.id"), nullable=True)  # Opcional: vincular a cliente
     criado_em = Column(DateTime, default=datetime.utcnow)
     criado_por = Column(Integer, ForeignKey("usuarios.id"), nullable=True)
@@ -289,6 +341,7 @@ class AtividadeHistorico(Base):
     id = Column(Integer, primary_key=True, index=True)
     descricao = Column(String, nullable=False)
     categoria = Column(String, nullable=True)  # Ex: "Estrutura", "Acabamento", "Instalações"
+    chave = Column(String, nullable=True, unique=True, index=True)  # texto normalizado (dedupe)
     cliente_id = Column(Integer, ForeignKey("clientes.id"), nullable=True)  # Opcional: vincular a cliente
     criado_em = Column(DateTime, default=datetime.utcnow)
     criado_por = Column(Integer, ForeignKey("usuarios.id"), nullable=True)
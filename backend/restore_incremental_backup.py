@@ -0,0 +1,36 @@
+import argparse
+import os
+
+import incremental_backup
+
+
+def main():
+    """Remonta um ponto no tempo do backup incremental em um diretório.
+
+    Uso:
+      python restore_incremental_backup.py --list
+      python restore_incremental_backup.py manifest_2025-01-31_22-00-00.json /tmp/restore
+    """
+    data_dir = os.getenv("DATA_DIR") or os.getenv("DB_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    parser = argparse.ArgumentParser(description="Restore de backup incremental")
+    parser.add_argument("manifest", nargs="?", help="Nome do manifesto (ou 'latest')")
+    parser.add_argument("dest", nargs="?", help="Diretório de destino (não precisa existir)")
+    parser.add_argument("--backup-dir", default=os.path.join(data_dir, "backups"))
+    parser.add_argument("--list", action="store_true", help="Lista os manifestos disponíveis")
+    args = parser.parse_args()
+
+    names = incremental_backup.list_manifests(args.backup_dir)
+    if args.list or not args.manifest:
+        for name in names:
+            m = incremental_backup.load_manifest(args.backup_dir, name)
+            print(f"{name}  arquivos={m.get('file_count')}  novos={m.get('new_files')}  bytes_novos={m.get('new_bytes')}")
+        return
+    manifest = names[0] if args.manifest == "latest" and names else args.manifest
+    if not args.dest:
+        parser.error("informe o diretório de destino")
+    count = incremental_backup.restore_to_dir(args.backup_dir, manifest, args.dest)
+    print(f"{count} arquivo(s) restaurado(s) de {manifest} em {args.dest}")
+
+
+if __name__ == "__main__":
+    main()
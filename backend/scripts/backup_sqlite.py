@@ -1,34 +1,34 @@
 """Gera um backup do banco SQLite atual.
 
-Cria diretório `backups/` na raiz do projeto (um nível acima de backend/) e copia o arquivo DB.
+Cria diretório `backups/` na raiz do projeto (um nível acima de backend/) e grava um snapshot
+consistente do DB via API de backup online do SQLite (pode rodar com a API no ar).
 Nome do arquivo: gestao_obras_YYYYMMDD_HHMMSS.db (ou baseado em DB_FILE se definido).
-Também gera uma versão compactada .zip opcionalmente (flag --zip).
+Também gera uma versão compactada .zip opcionalmente (flag --zip), ou só o .db.gz (flag --gzip).
 
 Uso:
-    python backend/scripts/backup_sqlite.py [--zip]
+    python backend/scripts/backup_sqlite.py [--zip | --gzip]
 """
 from __future__ import annotations
 import argparse
 import datetime as dt
 import os
-import shutil
 import zipfile
 from pathlib import Path
 
 try:
-    from backend.database import DB_PATH  # type: ignore
+    from backend.database import DB_PATH, snapshot_sqlite  # type: ignore
 except Exception:
     try:
         # Fallback: adicionar pasta backend ao sys.path
         import sys
         from pathlib import Path as _P
         sys.path.append(str(_P(__file__).resolve().parents[1]))
-        from database import DB_PATH  # type: ignore
+        from database import DB_PATH, snapshot_sqlite  # type: ignore
     except Exception:
         DB_PATH = None
 
 
-def backup(sqlite_path: str, do_zip: bool = False) -> tuple[str, str | None]:
+def backup(sqlite_path: str, do_zip: bool = False, do_gzip: bool = False) -> tuple[str, str | None]:
     root = Path(__file__).resolve().parent.parent.parent  # raiz do repo
     backups_dir = root / "backups"
     backups_dir.mkdir(exist_ok=True)
@@ -36,7 +36,11 @@ def backup(sqlite_path: str, do_zip: bool = False) -> tuple[str, str | None]:
     base_name = os.getenv("DB_FILE", "gestao_obras.db").rsplit(".", 1)[0]
     ts = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
     dest_file = backups_dir / f"{base_name}_{ts}.db"
-    shutil.copy2(sqlite_path, dest_file)
+    if do_gzip:
+        gz_path = backups_dir / f"{dest_file.name}.gz"
+        snapshot_sqlite(str(gz_path), src_path=sqlite_path, compress="gzip")
+        return str(gz_path), None
+    snapshot_sqlite(str(dest_file), src_path=sqlite_path)
 
     zip_path = None
     if do_zip:
@@ -48,14 +52,16 @@ def backup(sqlite_path: str, do_zip: bool = False) -> tuple[str, str | None]:
 
 def main():
     parser = argparse.ArgumentParser(description="Backup do SQLite da aplicação")
-    parser.add_argument("--zip", action="store_true", help="Também gerar arquivo compactado .zip")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--zip", action="store_true", help="Também gerar arquivo compactado .zip")
+    group.add_argument("--gzip", action="store_true", help="Gerar apenas o snapshot compactado .db.gz")
     args = parser.parse_args()
 
     if not DB_PATH or not os.path.exists(DB_PATH):
         print("[ERRO] DB_PATH não disponível ou arquivo inexistente.")
         raise SystemExit(1)
 
-    dest, zip_dest = backup(DB_PATH, args.zip)
+    dest, zip_dest = backup(DB_PATH, args.zip, args.gzip)
     print(f"Backup criado: {dest}")
     if zip_dest:
         print(f"Zip criado: {zip_dest}")
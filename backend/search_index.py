@@ -0,0 +1,163 @@
+"""Busca textual (SQLite FTS5) em clientes, fornecedores, materiais, atividades e relatórios.
+
+Uma única tabela virtual busca_fts guarda título + conteúdo de cada registro indexado;
+triggers nas tabelas de origem a mantêm sincronizada dentro da mesma transação da escrita
+(inclusive para inserts feitos fora da API, como os importadores). O rowid do FTS é
+ref_id * 8 + código da entidade, então atualizar/remover um registro é um acesso por rowid.
+
+Tokenizer unicode61 com remove_diacritics: "concreto" encontra "Concretagem" (prefixo) e
+"acao" encontra "Ação". Sem dependência de main.py: funções recebem engine/conexão.
+"""
+import re
+from typing import Iterable, Optional
+
+from sqlalchemy import text
+
+FTS_TABLE = "busca_fts"
+_TRIGGER_PREFIX = "busca_fts_"
+_SNIPPET_TOKENS = 12
+
+# entidade → (código do rowid, tabela, cliente_id, título, colunas do conteúdo); "{r}" é a
+# linha (new/old nos triggers, alias da tabela na reconstrução)
+ENTIDADES = {
+    "cliente": (1, "clientes", "{r}.id", "{r}.nome", ("cnpj", "email", "contato", "endereco")),
+    "fornecedor": (2, "fornecedores", "NULL", "{r}.nome", ("cnpj", "contato")),
+    "material": (3, "valor_materiais", "{r}.cliente_id", "{r}.descricao_produto", ("marca", "fornecedor", "localizacao", "observacoes")),
+    "atividade": (4, "atividades_historico", "{r}.cliente_id", "{r}.descricao", ("categoria",)),
+}
+# Relatórios de obras: uma linha por relatório com o texto de todas as suas atividades
+RELATORIO_CODE = 5
+_RELATORIO_SELECT = (
+    "SELECT r.id * 8 + 5, 'relatorio', r.id, r.cliente_id, "
+    "'Relatório de obra ' || strftime('%d/%m/%Y', r.data_relatorio), "
+    "(SELECT group_concat(descricao, ' | ') FROM "
+    "(SELECT descricao FROM relatorios_obras_atividades WHERE relatorio_id = r.id ORDER BY posicao)) "
+    "FROM relatorios_obras r "
+    "WHERE EXISTS (SELECT 1 FROM relatorios_obras_atividades a WHERE a.relatorio_id = r.id)"
+)
+_COLUMNS = "rowid, entidade, ref_id, cliente_id, titulo, conteudo"
+
+
+def _entity_select(entidade: str, alias: str) -> str:
+    code, _, cliente, titulo, colunas = ENTIDADES[entidade]
+    # Colunas não vazias separadas por espaço (o trecho do snippet não começa com brancos)
+    conteudo = "trim(" + " || ".join(f"coalesce(nullif({alias}.{c}, '') || ' ', '')" for c in colunas) + ")"
+    return (
+        f"SELECT {alias}.id * 8 + {code}, '{entidade}', {alias}.id, {cliente.format(r=alias)}, "
+        f"{titulo.format(r=alias)}, {conteudo}"
+    )
+
+
+def _ddl() -> list[str]:
+    stmts = [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "entidade UNINDEXED, ref_id UNINDEXED, cliente_id UNINDEXED, titulo, conteudo, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    ]
+    for entidade, (code, table, *_rest) in ENTIDADES.items():
+        insert_new = f"INSERT INTO {FTS_TABLE}({_COLUMNS}) {_entity_select(entidade, 'new')};"
+        delete_old = f"DELETE FROM {FTS_TABLE} WHERE rowid = old.id * 8 + {code};"
+        stmts += [
+            f"CREATE TRIGGER IF NOT EXISTS {_TRIGGER_PREFIX}{table}_ai AFTER INSERT ON {table} BEGIN {insert_new} END",
+            f"CREATE TRIGGER IF NOT EXISTS {_TRIGGER_PREFIX}{table}_au AFTER UPDATE ON {table} BEGIN {delete_old} {insert_new} END",
+            f"CREATE TRIGGER IF NOT EXISTS {_TRIGGER_PREFIX}{table}_ad AFTER DELETE ON {table} BEGIN {delete_old} END",
+        ]
+    # Relatório: recalculado quando as atividades mudam; cabeçalho (cliente/data) no update
+    refresh = (
+        f"DELETE FROM {FTS_TABLE} WHERE rowid = {{r}}.relatorio_id * 8 + {RELATORIO_CODE}; "
+        f"INSERT INTO {FTS_TABLE}({_COLUMNS}) {_RELATORIO_SELECT} AND r.id = {{r}}.relatorio_id;"
+    )
+    stmts += [
+        f"CREATE TRIGGER IF NOT EXISTS {_TRIGGER_PREFIX}relatorios_obras_atividades_ai AFTER INSERT ON relatorios_obras_atividades "
+        f"BEGIN {refresh.format(r='new')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {_TRIGGER_PREFIX}relatorios_obras_atividades_au AFTER UPDATE ON relatorios_obras_atividades "
+        f"BEGIN {refresh.format(r='old')} {refresh.format(r='new')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {_TRIGGER_PREFIX}relatorios_obras_atividades_ad AFTER DELETE ON relatorios_obras_atividades "
+        f"BEGIN {refresh.format(r='old')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {_TRIGGER_PREFIX}relatorios_obras_au AFTER UPDATE OF cliente_id, data_relatorio ON relatorios_obras "
+        f"BEGIN DELETE FROM {FTS_TABLE} WHERE rowid = old.id * 8 + {RELATORIO_CODE}; "
+        f"INSERT INTO {FTS_TABLE}({_COLUMNS}) {_RELATORIO_SELECT} AND r.id = new.id; END",
+        f"CREATE TRIGGER IF NOT EXISTS {_TRIGGER_PREFIX}relatorios_obras_ad AFTER DELETE ON relatorios_obras "
+        f"BEGIN DELETE FROM {FTS_TABLE} WHERE rowid = old.id * 8 + {RELATORIO_CODE}; END",
+    ]
+    return stmts
+
+
+def rebuild(conn) -> int:
+    """Repovoa busca_fts a partir das tabelas de origem. Retorna a quantidade de linhas."""
+    conn.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    for entidade, (_, table, *_rest) in ENTIDADES.items():
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({_COLUMNS}) {_entity_select(entidade, 't')} FROM {table} t"))
+    conn.execute(text(f"INSERT INTO {FTS_TABLE}({_COLUMNS}) {_RELATORIO_SELECT}"))
+    conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')"))
+    return conn.execute(text(f"SELECT count(*) FROM {FTS_TABLE}")).scalar() or 0
+
+
+def ensure_search_index(engine, force_rebuild: bool = False) -> Optional[int]:
+    """Cria tabela FTS + triggers (idempotente) e popula quando a tabela é nova.
+
+    Retorna a quantidade de linhas indexadas quando houve (re)construção, senão None.
+    """
+    with engine.begin() as conn:
+        existed = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :n"), {"n": FTS_TABLE}
+        ).first() is not None
+        for stmt in _ddl():
+            conn.execute(text(stmt))
+        if existed and not force_rebuild:
+            return None
+        return rebuild(conn)
+
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def to_match_query(q: str) -> Optional[str]:
+    """Texto livre → consulta FTS5: todos os termos (E), cada um como prefixo."""
+    tokens = _TOKEN_RE.findall(q or "")
+    if not tokens:
+        return None
+    return " ".join(f'"{t}"*' for t in tokens[:16])
+
+
+def search(
+    conn,
+    q: str,
+    entidades: Iterable[str],
+    cliente_ids: Optional[Iterable[int]] = None,
+    limit: int = 20,
+) -> list[dict]:
+    """Resultados ordenados por relevância (bm25, título pesa mais que conteúdo).
+
+    cliente_ids=None não restringe; com lista, só registros sem cliente ou desses clientes.
+    """
+    match = to_match_query(q)
+    entidades = [e for e in entidades if e in ENTIDADES or e == "relatorio"]
+    if not match or not entidades:
+        return []
+    params: dict = {"match": match, "limit": limit}
+    ent_params = []
+    for i, e in enumerate(entidades):
+        params[f"e{i}"] = e
+        ent_params.append(f":e{i}")
+    where = f"{FTS_TABLE} MATCH :match AND entidade IN ({', '.join(ent_params)})"
+    if cliente_ids is not None:
+        ids = ",".join(str(int(c)) for c in cliente_ids)
+        where += f" AND (cliente_id IS NULL OR cliente_id IN ({ids}))"
+    sql = (
+        f"SELECT entidade, ref_id, cliente_id, titulo, "
+        f"snippet({FTS_TABLE}, -1, '<mark>', '</mark>', '…', {_SNIPPET_TOKENS}) AS trecho, "
+        f"bm25({FTS_TABLE}, 0, 0, 0, 10.0, 1.0) AS score "
+        f"FROM {FTS_TABLE} WHERE {where} ORDER BY score LIMIT :limit"
+    )
+    return [
+        {
+            "entidade": r.entidade,
+            "id": r.ref_id,
+            "cliente_id": r.cliente_id,
+            "titulo": r.titulo,
+            "trecho": r.trecho,
+            "score": round(-r.score, 4),
+        }
+        for r in conn.execute(text(sql), params)
+    ]
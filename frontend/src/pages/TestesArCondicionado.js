@@ -526,7 +526,11 @@ export default function TestesArCondicionado() {
                 {teste.foto && (
                   <Box sx={{ mt: 2, mb: 2 }}>
                     <Avatar
-                      src={`${API_BASE}/uploads/testes-ar-condicionado/${teste.foto}`}
+                      src={
+                        teste.foto_thumb_url
+                          ? `${API_BASE}${teste.foto_thumb_url}`
+                          : `${API_BASE}/uploads/testes-ar-condicionado/${teste.foto}`
+                      }
                       sx={{ width: 60, height: 60, mx: 'auto', cursor: 'pointer' }}
                       variant="rounded"
                       onClick={() =>
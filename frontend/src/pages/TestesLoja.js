@@ -614,7 +614,11 @@ export default function TestesLoja() {
                 {teste.foto && (
                   <Box sx={{ mt: 2, mb: 2 }}>
                     <Avatar
-                      src={`${API_BASE}/uploads/testes-loja/${teste.foto}`}
+                      src={
+                        teste.foto_thumb_url
+                          ? `${API_BASE}${teste.foto_thumb_url}`
+                          : `${API_BASE}/uploads/testes-loja/${teste.foto}`
+                      }
                       sx={{ width: 60, height: 60, mx: 'auto', cursor: 'pointer' }}
                       variant="rounded"
                       onClick={() =>